@@ -30,6 +30,8 @@ logger.debug("Flask modules loaded")
 
 app = Flask(__name__)
 import requests
+## (connect, read) timeout for the requests to the meta container - the read timeout should be a little over its max_processing_duration, so it can answer with its own timeout first
+meta_timeout = (5, float(os.getenv("META_TIMEOUT", 660)))
 
 @app.route('/')
 def index():
@@ -68,9 +70,11 @@ def updatemeta(source_id:str = None):
     #     )
     # logger.debug("Forwarding request to responsible container: {}".format(meta_update_endpoint))
     # meta_response = requests.get(meta_update_endpoint)
-    meta_fetch = "http://{meta_server}:5000/fetch-and-generate-csv?source_id={source_id}".format(
+    ## force=true fetches and loads even when the source's dataset hasn't changed since the last import
+    meta_fetch = "http://{meta_server}:5000/fetch-and-generate-csv?source_id={source_id}&force={force}".format(
         meta_server = os.getenv("META_SERVER"),
-        source_id = source_id
+        source_id = source_id,
+        force = request.args.get('force', "false")
         )
     meta_flush = "http://{meta_server}:5000/flush-metadata?source_id={source_id}".format(
         meta_server = os.getenv("META_SERVER"),
@@ -85,16 +89,25 @@ def updatemeta(source_id:str = None):
         )
 
     result = [False, "No results"]
-    meta_response = requests.get(meta_fetch)
-    ## For subsequent "result"s, do not override "False" if the latest response is true. Append text instead of overwrite 
-    result = [meta_response.ok, meta_response.text]
-    if meta_response:
-        meta_response = requests.get(meta_flush)
-        result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
-        meta_response = requests.get(meta_load)
-        result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
-    meta_response = requests.get(meta_count_patients)
-    result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
+    try:
+        meta_response = requests.get(meta_fetch, timeout = meta_timeout)
+        ## For subsequent "result"s, do not override "False" if the latest response is true. Append text instead of overwrite 
+        result = [meta_response.ok, meta_response.text]
+        ## When the source is unchanged since its last import there is nothing to flush, load or count
+        skipped = meta_response.ok and meta_response.json().get("skipped", False)
+        if skipped:
+            logger.info("Source '{}' is unchanged, skipping flush, load and patient count".format(source_id))
+        if meta_response and not skipped:
+            meta_response = requests.get(meta_flush, timeout = meta_timeout)
+            result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
+            meta_response = requests.get(meta_load, timeout = meta_timeout)
+            result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
+        if not skipped:
+            meta_response = requests.get(meta_count_patients, timeout = meta_timeout)
+            result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
+    except requests.exceptions.RequestException as e:
+        logger.error("Request to the meta container failed or timed out: {}".format(e))
+        result = [False, "{}\nRequest to the meta container failed or timed out: {}".format(result[1], e)]
 
     # result = [meta_response.ok, meta_response.text]
     logger.debug("Updade of meta data complete: {}".format(result))
@@ -118,8 +131,12 @@ def flushmeta(source_id:str = None):
         source_id = source_id
         )
     logger.debug("Forwarding request to responsible container: {}".format(meta_update_endpoint))
-    meta_response = requests.get(meta_update_endpoint)
-    result = [meta_response.ok, meta_response.text]
+    try:
+        meta_response = requests.get(meta_update_endpoint, timeout = meta_timeout)
+        result = [meta_response.ok, meta_response.text]
+    except requests.exceptions.RequestException as e:
+        logger.error("Request to the meta container failed or timed out: {}".format(e))
+        result = [False, "Request to the meta container failed or timed out: {}".format(e)]
     logger.debug("Flushing/clearing of meta with source_id '{}' in i2b2 data complete: {}".format(source_id, result))
     return "<html><body><p>Success: {endpoint_status}</p><p>Message Log:<br/>{endpoint_messages}</p></body></html>\n".format(
         endpoint_status = str(result[0]),
@@ -135,8 +152,12 @@ def update_patient_counts():
         meta_server = os.getenv("META_SERVER")
         )
     logger.debug("Forwarding request to responsible container: {}".format(meta_update_endpoint))
-    meta_response = requests.get(meta_update_endpoint)
-    result = [meta_response.ok, meta_response.text]
+    try:
+        meta_response = requests.get(meta_update_endpoint, timeout = meta_timeout)
+        result = [meta_response.ok, meta_response.text]
+    except requests.exceptions.RequestException as e:
+        logger.error("Request to the meta container failed or timed out: {}".format(e))
+        result = [False, "Request to the meta container failed or timed out: {}".format(e)]
     logger.debug("Patient counts updated: {}".format(result))
     return "<html><body><p>Success: {endpoint_status}</p><p>Message Log:<br/>{endpoint_messages}</p></body></html>\n".format(
         endpoint_status = str(result[0]),
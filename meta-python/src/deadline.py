@@ -0,0 +1,43 @@
+""" deadline.py
+Time limit for processing a request (see max_processing_duration in the user config)
+The long running stages check it between units of work (nodes, batches, rows, tables) and stop cleanly once it has passed
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+class DeadlineExceeded(Exception):
+    """The processing took longer than allowed, raised by Deadline.check"""
+
+class Deadline:
+    """The point in time by which the processing has to be finished"""
+
+    def __init__(self, seconds:float = None):
+        """Start the clock - no limit when seconds is None (or 0)"""
+        self.seconds = float(seconds) if seconds else None
+        self.expires_at = time.monotonic() + self.seconds if self.seconds else None
+
+    def remaining(self) -> float:
+        """Seconds left (never below 0), None when there is no limit"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self, stage:str = "Processing") -> None:
+        """Raise DeadlineExceeded if the time is up - called between units of work"""
+        if self.expired():
+            logger.warn("{} stopped, the max processing duration of {} seconds was exceeded".format(stage, self.seconds))
+            raise DeadlineExceeded("{} exceeded the max processing duration of {} seconds".format(stage, self.seconds))
+
+    def timeout(self, timeout:tuple) -> tuple:
+        """Limit a (connect, read) request timeout to the time remaining"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        ## A timeout of 0 would make the request non-blocking instead, so keep a little above it
+        remaining = max(remaining, 0.001)
+        return (min(timeout[0], remaining), min(timeout[1], remaining))
@@ -6,6 +6,8 @@ from flask import current_app as app
 import logging
 app.logger = logging.getLogger(__name__)
 
+from queries import namespaces
+
 def write_sql_for_node(c_hlevel, notations, concept_long, label, datatypexml, description, isModifier, appliedPath, current_timestamp, visualAttribute, isRootElement, displayLabel, children):
     """Write statements for concept. In case of not exactly one concept notation, String notation will be "NULL"."""
 
@@ -63,16 +65,13 @@ def _demo_concept():
 def _getShortNotationPrefix(notation:str) -> str:
     """Use mapping to get the shorthand prefix of the notation"""
     app.logger.info("Getting prefix for notation: {}".format(notation))
-    notation_prefix = notation.split(":")[0]
-    prefix = app.config["generator_mappings"][notation_prefix]
+    prefix = namespaces.resolver().prefix(notation)
     app.logger.debug("Selected prefix: {}".format(prefix))
     return prefix
 
 def _getLongNotationPrefix(notation:str) -> str:
     """Use mapping to get the full prefix of the notation"""
     app.logger.info("Getting prefix for notation: {}".format(notation))
-    notation_prefix = notation.split(":")[0]
-    prefixes = {v: k for k, v in app.config["generator_mappings"][notation_prefix]}
-    prefix = prefixes[notation_prefix]
+    prefix = namespaces.resolver().namespace(notation)
     app.logger.debug("Selected prefix: {}".format(prefix))
-    return prefix
\ No newline at end of file
+    return prefix
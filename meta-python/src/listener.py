@@ -8,6 +8,7 @@ from asyncio.log import logger
 import logging
 import logging.config
 import os
+from queries import cache
 from queries import connection
 import yaml
 print("Basic imports done")
@@ -52,6 +53,7 @@ app.logger.debug("Flask app loaded and configured with: {}".format(os.getenv('AP
 ## TODO: Or maybe better to mount the yaml config?
 
 import meta
+from deadline import Deadline, DeadlineExceeded
 
 ## Global var(s)
 ## TODO: Track state for each source_id?
@@ -87,6 +89,7 @@ def flush(source_id:str = None):
             )
             if meta.clean_sources_in_database(db_conn, [source_id]):
                 db_conn.commit()
+                meta.forget_dataset_import(source_id)
                 response['status_code'] = 200
                 response['content'] = "Source data removed from database for source_id: '{}'".format(source_id)
             else:
@@ -103,6 +106,27 @@ def flush(source_id:str = None):
         response['content'] = "source_id not provided: '{}'".format(source_id)
     return response
 
+@app.route('/purge-cache')
+@app.route('/purge-cache/<source_id>')
+def purge_cache(source_id:str = None):
+    """Remove the cached sparql results of the source, so the next fetch queries fuseki for everything"""
+    app.logger.info("Running purge route to remove cached query results for source_id '{}'...".format(source_id))
+    response = {}
+    response['status_code'] = 500
+    response['content'] = ""
+    if source_id is None:
+        source_id = request.args.get('source_id')
+    if source_id:
+        if cache.purge(source_id):
+            response['content'] = "Cached query results removed for source_id: '{}'".format(source_id)
+        else:
+            response['content'] = "No cached query results for source_id: '{}'".format(source_id)
+        response['status_code'] = 200
+    else:
+        response['status_code'] = 400
+        response['content'] = "source_id not provided: '{}'".format(source_id)
+    return response
+
 @app.route('/fetch-and-generate-csv')
 @app.route('/fetch-and-generate-csv/<source_id>')
 def fetch(fuseki_endpoint:str = None, source_id:str = None):
@@ -111,6 +135,7 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
     NOTE: This does not fully prepare the CSV files for the database - source_id, current_timestamps and other checks are still required
     """
     app.logger.info("Running fetch route to fetch metadata from the fuseki_endpoint '{}' and write to CSV files...".format(fuseki_endpoint))
+    deadline = Deadline(app.config.get("max_processing_duration"))
     ## TODO: Allow fetching from multiple sources
         ## TODO: Protect against concurrent fetching from the same source/source_id
     ## For when params are supplied via query string eg ?param1=value1&param2=value2
@@ -132,8 +157,11 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
     response['content'] = ""
     source_type, source_dir, source_file_paths, source_update = meta.source_info(source_id)
     if source_type == "fuseki":
-        fuseki_endpoint = app.config["fuseki_sources"][source_id]
+        fuseki_endpoint = meta.source_config(source_id)["endpoint"]
         app.logger.debug("Set endpoint based on recognised source ({}): {}".format(source_id, fuseki_endpoint))
+    elif source_type == "rdf_dump":
+        rdf_dump_path = app.config["rdf_dump_sources"][source_id]
+        app.logger.debug("Set RDF dump file based on recognised source ({}): {}".format(source_id, rdf_dump_path))
     elif source_type == "local_files":
         response["content"] = "source_id '{}' is a local file based source, so there is nothing to fetch, CSV already exists".format(source_id)
         response['status_code'] = 200
@@ -152,29 +180,144 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
     #     fuseki_endpoint = "http://dwh.proxy/fuseki/cometar_live/query"
     #     source_id = "test"
 
-    result = meta.pull_fuseki_datatree(fuseki_endpoint, source_id)
+    ## Skip everything when the dataset is the same as the one last imported and the CSV files were written with the current settings (unless forced)
+        ## The dataset version only changes with the dates of the dataset (see queries.dataset_version), other changes need force
+    force = str(request.args.get('force', "")).lower() in ["1", "true", "yes"]
+    if source_type == "fuseki":
+        dataset_version = meta.fuseki_dataset_version(fuseki_endpoint, source_id)
+    else:
+        dataset_version = meta.rdf_dump_version(rdf_dump_path)
+    if not force and dataset_version is not None and source_file_paths and dataset_version == meta.imported_dataset_version(source_dir):
+        if not meta.csv_config_changed(source_dir):
+            response['content'] += "Dataset and CSV settings unchanged since the last import (version: {}), nothing to fetch - use force=1 for changes which don't update the dataset's modification dates\n".format(dataset_version)
+            response['status_code'] = 200
+            response['skipped'] = True
+            app.logger.info(response['content'])
+            return response
+        response['content'] += "Dataset unchanged since the last import (version: {}), but the CSV settings have changed\n".format(dataset_version)
+    response['skipped'] = False
+
+    ## The trees of the same dataset version are built from their snapshot instead (unless refetching is requested)
+    refetch = str(request.args.get('refetch', "")).lower() in ["1", "true", "yes"]
+    snapshot = meta.load_tree_snapshot(source_id) if not refetch and dataset_version is not None else None
+    if snapshot is not None and snapshot.get("dataset_version") != dataset_version:
+        snapshot = None
+    fetch_report:dict = {}
+    try:
+        if snapshot is not None:
+            result = meta.pull_snapshot_datatree(snapshot, report = fetch_report, deadline = deadline)
+        elif source_type == "fuseki":
+            result = meta.pull_fuseki_datatree(fuseki_endpoint, source_id, dataset_version, report = fetch_report, deadline = deadline)
+        else:
+            result = meta.pull_rdf_dump_datatree(rdf_dump_path, source_id, dataset_version, report = fetch_report, deadline = deadline)
+    except DeadlineExceeded as e:
+        return _timed_out(response, e)
+    response['from_snapshot'] = snapshot is not None
+    response['shared_nodes'] = fetch_report.get("shared_nodes", 0)
+    response['cycles'] = fetch_report.get("cycles", [])
+    if len(response['cycles']) > 0:
+        response['content'] += "Skipped {} cycles in the tree: {}\n".format(len(response['cycles']), response['cycles'])
     if result:
-        response['content'] += "{} - {}\n".format("Data retrieved from fuseki", fuseki_endpoint)
+        if snapshot is not None:
+            response['content'] += "{} - {}\n".format("Trees built from the snapshot of dataset version", dataset_version)
+        elif source_type == "fuseki":
+            response['content'] += "{} - {}\n".format("Data retrieved from fuseki", fuseki_endpoint)
+        else:
+            response['content'] += "{} - {}\n".format("Data read from RDF dump", rdf_dump_path)
         response['status_code'] = 200
     else:
         response['content'] += "{}\n".format("Error in retrieving or processing fuseki data!")
         response['status_code'] = 500
         return response
 
+    ## Only freshly fetched trees have a pending snapshot
+    response = _write_trees(response, source_id, source_dir, result[source_id], dataset_version, deadline, keep_snapshot = snapshot is None)
+    if response['status_code'] == 200:
+        response = _tree_changes(response, source_id, source_dir, result[source_id], deadline)
+    logger.debug("Fetching complete, response: {}".format(response))
+    return response
+
+def _tree_changes(response:dict, source_id:str, source_dir:str, trees:list, deadline:Deadline) -> dict:
+    """Compare the fetched trees with the ones last loaded into the database, add the changes to the response and write them next to the CSV files"""
+    response['tree_changes'] = None
+    previous_snapshot = meta.load_tree_snapshot(source_id, imported = True)
+    current_snapshot = meta.load_tree_snapshot(source_id)
+    if previous_snapshot is None or current_snapshot is None:
+        response['content'] += "{}\n".format("No imported trees to compare with")
+        return response
+    try:
+        response['tree_changes'] = meta.tree_changes(previous_snapshot, current_snapshot, trees, deadline = deadline)
+    except DeadlineExceeded as e:
+        return _timed_out(response, e)
+    meta.write_tree_changes(response['tree_changes'], source_dir)
+    node_changes = response['tree_changes']["nodes"]
+    response['content'] += "Changes since the last import: {} added, {} removed, {} moved, {} changed nodes\n".format(
+        len(node_changes["added"]), len(node_changes["removed"]), len(node_changes["moved"]), len(node_changes["changed"]))
+    return response
+
+@app.route('/regenerate-csv')
+@app.route('/regenerate-csv/<source_id>')
+def regenerate(source_id:str = None):
+    """Write the CSV files again from the snapshot of the last fetched trees, without fetching - eg after changing the csv settings"""
+    app.logger.info("Running regenerate route to write the CSV files of source_id '{}' from its tree snapshot...".format(source_id))
+    deadline = Deadline(app.config.get("max_processing_duration"))
+    response = {}
+    response['status_code'] = 500
+    response['content'] = ""
+    if source_id is None:
+        source_id = request.args.get('source_id')
+    source_type, source_dir, source_file_paths, source_update = meta.source_info(source_id)
+    if source_type not in ["fuseki", "rdf_dump"]:
+        response["content"] = "source_id '{}' is not a fuseki or RDF dump source, so there are no fetched trees".format(source_id)
+        response['status_code'] = 400
+        app.logger.warn(response["content"])
+        return response
+    snapshot = meta.load_tree_snapshot(source_id)
+    if snapshot is None:
+        response["content"] = "No tree snapshot for source_id '{}', fetch it first".format(source_id)
+        response['status_code'] = 404
+        app.logger.warn(response["content"])
+        return response
+    fetch_report:dict = {}
+    try:
+        result = meta.pull_snapshot_datatree(snapshot, report = fetch_report, deadline = deadline)
+    except DeadlineExceeded as e:
+        return _timed_out(response, e)
+    response['content'] += "{} - {}\n".format("Trees built from the snapshot of dataset version", snapshot["dataset_version"])
+    response = _write_trees(response, source_id, source_dir, result[source_id], snapshot["dataset_version"], deadline, keep_snapshot = False)
+    logger.debug("Regenerating complete, response: {}".format(response))
+    return response
+
+def _write_trees(response:dict, source_id:str, source_dir:str, trees:list, dataset_version:str, deadline:Deadline, keep_snapshot:bool = False) -> dict:
+    """Write the trees to the source's CSV files and add the outcome to the response
+
+    :param keep_snapshot: The pending snapshot of the trees (see meta.keep_tree_snapshot) becomes the source's snapshot once the files are written, it's discarded otherwise
+    """
     ## Write objects to flat structured CSV files - 1 per table
         ## Filename includes source_id
-    all_trees = []
-    for tree in result[source_id]:
-        all_trees.append(tree.whole_tree_csv())
-    app.logger.debug("All trees for source '{}': {}".format(source_id, len(all_trees)))
-    combined_tree = meta.combine_csv_trees(all_trees)
-    if meta.write_csv(combined_tree, source_id, source_dir):
+        ## Only the lines of trees which changed since the last time are generated
+    app.logger.debug("All trees for source '{}': {}".format(source_id, len(trees)))
+    csv_report:dict = {}
+    try:
+        csv_written = meta.write_trees_csv(trees, source_id, source_dir, deadline = deadline, report = csv_report)
+    except DeadlineExceeded as e:
+        meta.discard_tree_snapshot(source_id)
+        return _timed_out(response, e)
+    response['regenerated_trees'] = csv_report.get("regenerated", [])
+    response['unchanged_trees'] = csv_report.get("unchanged", [])
+    if csv_written:
+        response['content'] += "Trees regenerated: {}, unchanged: {}\n".format(len(response['regenerated_trees']), len(response['unchanged_trees']))
+        meta.save_dataset_version(source_dir, dataset_version)
+        if keep_snapshot:
+            meta.keep_tree_snapshot(source_id)
+        else:
+            meta.discard_tree_snapshot(source_id)
         response['content'] += "{}\n".format("CSV written")
         response['status_code'] = 200
     else:
+        meta.discard_tree_snapshot(source_id)
         response['content'] += "{}\n".format("CSV writing FAILED!")
         response['status_code'] = 500
-    logger.debug("Fetching complete, response: {}".format(response))
     return response
 
 @app.route('/load-csv-to-postgres')
@@ -186,6 +329,7 @@ def load_data(source_id:list = None):
     Temporary files are named on the convention <db_prepared_directory>/<db_prepared_prefix>.<source_id>.<schema_name>.<table_name>.csv
     """
     app.logger.info("Running update route to update i2b2 with pre-fetched metadata...")
+    deadline = Deadline(app.config.get("max_processing_duration"))
     ## TODO: Check serialised data exists - else skip
         ## TODO: use source_id list to update only the given ids, default to none, allow "all"?
     ## TODO: Read serialised data, convert to SQL, push to i2b2 database
@@ -210,9 +354,11 @@ def load_data(source_id:list = None):
     source_type, source_dir, source_file_paths, source_update = meta.source_info(source_id)
     ## TODO: Adjust these next lines for this function
     if source_type == "fuseki":
-        fuseki_endpoint = app.config["fuseki_sources"][source_id]
+        fuseki_endpoint = meta.source_config(source_id)["endpoint"]
         response['content'] = "Set endpoint based on recognised source ({}): {}".format(source_id, fuseki_endpoint)
         # app.logger.info(response['content'])
+    elif source_type == "rdf_dump":
+        response["content"] = "source_id '{}' is an RDF dump based source.".format(source_id)
     elif source_type == "local_files":
         response["content"] = "source_id '{}' is a local file based source.".format(source_id)
         # app.logger.info(response["content"])
@@ -239,13 +385,33 @@ def load_data(source_id:list = None):
         os.getenv("DB_ADMIN_USER"),
         os.getenv("DB_ADMIN_PASS")
     )
-    if source_type == "fuseki":
+    if source_type in ["fuseki", "rdf_dump"]:
         delim = ","
+        ## Check the csv files for paths and codes which the inserts would skip, before loading anything
+            ## With strict, nothing is loaded when there are conflicts
+        strict = str(request.args.get('strict', "")).lower() in ["1", "true", "yes"]
+        try:
+            response['conflicts'] = meta.load_conflicts(db_conn, source_id, source_file_paths, delim, deadline = deadline)
+        except DeadlineExceeded as e:
+            return _timed_out(response, e)
+        response['content'] += "\nConflicts found before loading: {}".format(len(response['conflicts']))
+        if strict and len(response['conflicts']) > 0:
+            response['content'] += "\n{}".format("Nothing loaded, resolve the conflicts or load without strict")
+            response['status_code'] = 409
+            app.logger.warn(response['content'])
+            return response
     else:
         delim = ";"
     # if meta.push_csv_to_database(db_conn, prepared_file_paths):
-    if meta.push_csv_to_database(db_conn, source_id, source_file_paths, delim):
+    try:
+        pushed = meta.push_csv_to_database(db_conn, source_id, source_file_paths, delim, deadline = deadline)
+    except DeadlineExceeded as e:
+        ## The inserts are already rolled back
+        return _timed_out(response, e)
+    if pushed:
         db_conn.commit()
+        if source_type in ["fuseki", "rdf_dump"]:
+            meta.mark_dataset_imported(source_dir)
         new_message = "Pushing CSV metadata to database has succeeded!"
         response['content'] += "\n{}".format(new_message)
         app.logger.info(new_message)
@@ -260,6 +426,14 @@ def load_data(source_id:list = None):
     app.logger.debug(response)
     return response
 
+def _timed_out(response:dict, e:Exception) -> dict:
+    """Fill the response for processing which was stopped at the max_processing_duration"""
+    response['content'] += "{}\n".format(e)
+    response['status_code'] = 504
+    response['timed_out'] = True
+    app.logger.warn(response['content'])
+    return response
+
 @app.route('/update-patient-counts')
 def update_patient_counts():
     """Update the patient counts (in parenthesis in the tree)"""
@@ -7,17 +7,25 @@ from flask import current_app as app
 import logging
 logger = logging.getLogger(__name__)
 
+import concurrent.futures
 import csv
 import datetime
+import hashlib
+from deadline import DeadlineExceeded
 from queries import connection
 from datetime import date, datetime as dt
 from queries import queries
+import json
 import model
+from model import MetaNode, TreeIndex
 import os
+import pickle
 import psycopg2
 import psycopg2.sql
+import shutil
 import time
 from typing import Tuple
+import zlib
 
 ## TODO: Make a "source" class for these functions?
 def source_info(source_id:str) -> Tuple[str, str, list[str], dt]:
@@ -36,13 +44,15 @@ def _source_type(source_id:str) -> str:
     source_type = "unknown"
     if source_id in app.config["fuseki_sources"].keys():
         source_type = "fuseki"
+    elif source_id in (app.config.get("rdf_dump_sources") or {}).keys():
+        source_type = "rdf_dump"
     elif source_id in os.listdir(app.config["local_file_sources"]):
         source_type = "local_files"
     return source_type
 
 def _source_location(source_id:str, source_type:str) -> Tuple[str, list[str]]:
     """Check if the source has local files and return directory and each file path"""
-    dynamic_sources = ["fuseki"] ## TODO: Get from config
+    dynamic_sources = ["fuseki", "rdf_dump"] ## TODO: Get from config
     source_dir = None
     source_file_paths = None
     if source_type in dynamic_sources:
@@ -66,39 +76,685 @@ def _source_update(source_file_paths:list[str]) -> dt:
     ## TODO: If source_file_paths not None, stat each file and find most recent date
     return last_update
 
-def pull_fuseki_datatree(fuseki_endpoint:str, source_id:str) -> dict:
-    """Pull the full tree, build objects and serialise data"""
+def source_config(source_id:str) -> dict:
+    """Settings for a fuseki source, using "fuseki_source_defaults" for anything the source doesn't set itself
+
+    A source in "fuseki_sources" is either just its endpoint url, or a dict with the "endpoint" and any settings to override
+    """
+    settings = dict(app.config.get("fuseki_source_defaults") or {})
+    source = app.config["fuseki_sources"].get(source_id)
+    if isinstance(source, dict):
+        settings.update(source)
+    else:
+        settings["endpoint"] = source
+    return settings
+
+def fuseki_dataset_version(fuseki_endpoint:str, source_id:str) -> str:
+    """Get the current version (fingerprint) of the dataset from fuseki, None if it isn't available"""
+    conn = connection.get_fuseki_connection(fuseki_endpoint, "requests", source_id = source_id)
+    try:
+        return queries.dataset_version(conn)
+    except Exception as e:
+        logger.warn("Could not get the dataset version for source '{}': {}".format(source_id, e))
+        return None
+
+def imported_dataset_version(source_dir:str) -> str:
+    """The dataset version of the last successful import into the database (None if unknown)"""
+    version_file = os.path.join(source_dir, ".dataset-version") if source_dir else None
+    if version_file is None or not os.path.isfile(version_file):
+        return None
+    with open(version_file, "r") as f:
+        return f.read().strip()
+
+def csv_config_changed(source_dir:str, output_delim:str = ",") -> bool:
+    """The csv settings are different from the ones the source's csv files were written with (see write_trees_csv), the files have to be written again"""
+    fingerprints = _read_json(os.path.join(source_dir, ".fingerprints.json")) if source_dir else None
+    return fingerprints is None or fingerprints.get("config") != _csv_config_fingerprint(output_delim)
+
+def save_dataset_version(source_dir:str, dataset_version:str) -> None:
+    """Keep the dataset version of the freshly written CSV files, until they are imported (see mark_dataset_imported)"""
+    pending_file = os.path.join(source_dir, ".dataset-version.pending")
+    if dataset_version is None:
+        ## Don't leave an older version pending for these files
+        if os.path.isfile(pending_file):
+            os.remove(pending_file)
+        return
+    with open(pending_file, "w") as f:
+        f.write(dataset_version)
+
+def mark_dataset_imported(source_dir:str) -> None:
+    """The pending CSV files are now in the database, so their dataset version is the imported one
+
+    The tree snapshot they were written from is kept as the imported one, the next fetch is compared with it (see tree_changes)
+    """
+    pending_file = os.path.join(source_dir, ".dataset-version.pending") if source_dir else None
+    if pending_file and os.path.isfile(pending_file):
+        os.replace(pending_file, os.path.join(source_dir, ".dataset-version"))
+    snapshot_file = os.path.join(source_dir, ".tree-snapshot.bin") if source_dir else None
+    if snapshot_file and os.path.isfile(snapshot_file):
+        shutil.copyfile(snapshot_file, snapshot_file + ".tmp")
+        os.replace(snapshot_file + ".tmp", os.path.join(source_dir, ".tree-snapshot.imported.bin"))
+
+def forget_dataset_import(source_id:str) -> None:
+    """The source's data has been removed from the database, so the next fetch must not be skipped"""
+    version_file = os.path.join(app.config["dynamic_metadata_directory"], source_id, ".dataset-version")
+    if os.path.isfile(version_file):
+        os.remove(version_file)
+    imported_snapshot_file = _tree_snapshot_file(source_id, imported = True)
+    if os.path.isfile(imported_snapshot_file):
+        os.remove(imported_snapshot_file)
+
+def pull_fuseki_datatree(fuseki_endpoint:str, source_id:str, dataset_version:str = None, report:dict = None, deadline:object = None) -> dict:
+    """Pull the full tree, build objects and serialise data
+
+    :param dataset_version: Current version of the dataset if already known, it is queried again when needed otherwise
+    :param report: If supplied, filled with details of the fetch (see _fetch_report)
+    :param deadline: If supplied, DeadlineExceeded is raised once it has passed (checked between queries and nodes)
+    """
     logger.debug("fetching all fuseki data for endpoint (managed by queries module, using config)")
     ## Save the fuseki tree data - could have multiple sources - TODO: naming scheme needs more thought
     metadata_trees:dict = {}
     metadata_trees[source_id] = []
     conn = connection.get_fuseki_connection(fuseki_endpoint, "requests", source_id = source_id)
+    conn["deadline"] = deadline
+    conn["fetch_timestamp"] = MetaNode.current_fetch_timestamp()
+    settings = source_config(source_id)
+    conn["result_format"] = settings.get("result_format", "json")
+    checkpoint_seconds = int(settings.get("checkpoint_seconds", 0))
+    if dataset_version is None and (settings.get("response_cache", False) or checkpoint_seconds > 0):
+        dataset_version = queries.dataset_version(conn)
+    if settings.get("response_cache", False):
+        if dataset_version is not None:
+            conn["response_cache"] = {"version": dataset_version, "max_bytes": int(settings.get("response_cache_max_mb", 500)) * 1024 * 1024}
+            logger.info("Using cached query results for source '{}' (dataset version: {})".format(source_id, dataset_version))
+        else:
+            logger.warn("Not using cached query results for source '{}', the dataset version is unknown".format(source_id))
     top_elements:dict = queries.top_elements(conn)
-    for node_uri, node_type in top_elements.items():
-        metadata_trees[source_id].append(get_tree(conn, node_uri, node_type))
+    fetch_modes = {"crawl": _fetch_crawl, "bulk": _fetch_bulk, "batched": _fetch_batched, "concurrent": _fetch_concurrent}
+    fetch_mode = settings.get("fetch_mode", "crawl")
+    if fetch_mode not in fetch_modes:
+        logger.warn("Unknown fetch_mode '{}' for source '{}', using 'crawl'".format(fetch_mode, source_id))
+        fetch_mode = "crawl"
+    ## The bulk queries are all or nothing, there is nothing to resume from
+    if checkpoint_seconds > 0 and fetch_mode != "bulk":
+        if dataset_version is not None:
+            _load_checkpoint(conn, top_elements, dataset_version, checkpoint_seconds)
+        else:
+            logger.warn("Not saving fetch checkpoints for source '{}', the dataset version is unknown".format(source_id))
+    logger.info("Fetching trees for source '{}' with fetch_mode: {}".format(source_id, fetch_mode))
+    _use_tree_backend(conn, settings)
+    try:
+        metadata_trees[source_id] = _finished_trees(conn, fetch_modes[fetch_mode](conn, top_elements))
+    except Exception:
+        ## Keep what was fetched so far, a retry resumes from it
+        _save_checkpoint(conn, force = True)
+        raise
+    _remove_checkpoint(conn)
+    _save_tree_snapshot(conn, top_elements, *_fetched_nodes(conn), dataset_version)
+    _fetch_report(conn, report)
     return metadata_trees
 
-def get_tree(conn, node_uri:str, node_type:str, parent_node:object = None):
-    """Get all children under a single node"""
-    from queries import queries
-    node_uri = node_uri.strip("<>")
-    new_parent = _element(conn, node_uri, node_type, parent_node = parent_node, )
-    children = queries.getChildren(conn, node_uri)
-    for node_uri, node_type in children.items():
-        get_tree(conn, node_uri, node_type, new_parent)
-    return new_parent
-
-def _element(conn, node_uri:str, node_type:str = "concept", parent_node:object = None) -> object:
-    """Get a single node - with all its details"""
-    logger.info("Fetching the node data for '{}'".format(node_uri))
+def _load_checkpoint(conn, top_elements:dict, dataset_version:str, checkpoint_seconds:int) -> None:
+    """Enable checkpoints for the fetch, starting with the nodes of the last checkpoint if it was saved for the same dataset version
+
+    The checkpoint holds the attributes and children of every fetched node, and the frontier of known nodes still to fetch
+    """
+    checkpoint_file = os.path.join(app.config["dynamic_metadata_directory"], conn["source_id"], ".fetch-checkpoint.json")
+    conn["checkpoint"] = {"file": checkpoint_file, "version": dataset_version, "seconds": checkpoint_seconds, "saved": time.time(), "top_elements": top_elements}
+    if not os.path.isfile(checkpoint_file):
+        return
+    try:
+        with open(checkpoint_file, "r") as f:
+            checkpoint:dict = json.load(f)
+    except Exception as e:
+        logger.warn("Could not read the fetch checkpoint '{}', starting from the beginning: {}".format(checkpoint_file, e))
+        return
+    if checkpoint.get("version") != dataset_version:
+        logger.info("Ignoring the fetch checkpoint for source '{}', the dataset has changed since (version: {})".format(conn["source_id"], checkpoint.get("version")))
+        return
+    conn["node_attributes"] = checkpoint["attributes"]
+    conn["node_children"] = checkpoint["children"]
+    logger.info("Resuming the fetch for source '{}' from its checkpoint: {} nodes fetched, {} in the frontier".format(conn["source_id"], len(conn["node_children"]), len(checkpoint["frontier"])))
+
+def _save_checkpoint(conn, force:bool = False) -> None:
+    """Save the fetched nodes (see _fetched_nodes) if checkpoints are enabled and "checkpoint_seconds" have passed since the last save"""
+    checkpoint:dict = conn.get("checkpoint")
+    if checkpoint is None or (not force and time.time() - checkpoint["saved"] < checkpoint["seconds"]):
+        return
+    attributes, children = _fetched_nodes(conn)
+    frontier = _frontier(checkpoint["top_elements"], attributes, children)
+    try:
+        os.makedirs(os.path.dirname(checkpoint["file"]), exist_ok = True)
+        with open(checkpoint["file"] + ".tmp", "w") as f:
+            json.dump({"version": checkpoint["version"], "attributes": attributes, "children": children, "frontier": frontier}, f)
+        os.replace(checkpoint["file"] + ".tmp", checkpoint["file"])
+        logger.info("Saved fetch checkpoint for source '{}': {} nodes fetched, {} in the frontier".format(conn["source_id"], len(children), len(frontier)))
+    except Exception as e:
+        logger.warn("Could not save the fetch checkpoint '{}': {}".format(checkpoint["file"], e))
+    checkpoint["saved"] = time.time()
+
+def _remove_checkpoint(conn) -> None:
+    """The fetch is complete, so the checkpoint isn't needed anymore"""
+    checkpoint:dict = conn.get("checkpoint")
+    if checkpoint is not None and os.path.isfile(checkpoint["file"]):
+        os.remove(checkpoint["file"])
+
+def _fetched_nodes(conn) -> tuple:
+    """The attributes ({uri: element}) and children ({uri: {child_uri: type}}) of the nodes fetched so far in this run
+
+    A node is fetched once it has an entry in both (see _is_fetched), they are kept in the connection so they can be checkpointed
+    """
+    return conn.setdefault("node_attributes", {}), conn.setdefault("node_children", {})
+
+def _is_fetched(node_uri:str, attributes:dict, children:dict) -> bool:
+    """The node's attributes and children (even if empty) are both there - a node with only one of them is fetched again"""
+    return node_uri in children and node_uri in attributes
+
+def _frontier(top_elements:dict, attributes:dict, children:dict) -> list:
+    """Known nodes (top elements and children of fetched nodes) which haven't been fetched yet"""
+    known = [node_uri.strip("<>") for node_uri in top_elements.keys()] + [child_uri.strip("<>") for node_children in children.values() for child_uri in node_children.keys()]
+    return list(dict.fromkeys([node_uri for node_uri in known if not _is_fetched(node_uri, attributes, children)]))
+
+def rdf_dump_version(dump_path:str) -> str:
+    """Version of an RDF dump file - changes whenever the file is replaced or modified"""
+    if not os.path.isfile(dump_path):
+        return None
+    dump_stat = os.stat(dump_path)
+    return "{}-{}".format(dump_stat.st_size, dump_stat.st_mtime_ns)
+
+def pull_rdf_dump_datatree(dump_path:str, source_id:str, dataset_version:str = None, report:dict = None, deadline:object = None) -> dict:
+    """Read the full tree from an RDF dump file of CoMetaR and build the objects, without any queries to fuseki
+
+    :param dataset_version: Version of the dump (see rdf_dump_version), kept with the tree snapshot
+    :param report: If supplied, filled with details of the fetch (see _fetch_report)
+    :param deadline: If supplied, DeadlineExceeded is raised once it has passed (checked between nodes)
+    """
+    from queries import rdf_graph
+    logger.debug("reading all data for source '{}' from the RDF dump: {}".format(source_id, dump_path))
+    metadata_trees:dict = {}
+    graph = rdf_graph.load_graph(dump_path)
+    children:dict = rdf_graph.all_children(graph)
+    attributes:dict = rdf_graph.all_attributes(graph)
+    ## There is no fuseki connection, only the source is needed to build the nodes
+    conn = {"source_id": source_id, "deadline": deadline, "fetch_timestamp": MetaNode.current_fetch_timestamp()}
+    _use_tree_backend(conn, source_config(source_id))
+    top_elements:dict = rdf_graph.top_elements(graph)
+    metadata_trees[source_id] = _finished_trees(conn, [_assemble_tree(conn, node_uri, node_type, children, attributes) for node_uri, node_type in top_elements.items()])
+    _save_tree_snapshot(conn, top_elements, attributes, children, dataset_version)
+    _fetch_report(conn, report)
+    return metadata_trees
+
+## Tree snapshots start with this, followed by the format version - the rest is compressed
+_SNAPSHOT_MAGIC = b"I2B2TREE"
+_SNAPSHOT_VERSION = 2
+## Nodes in each pickle of a snapshot (pickling remembers every object of a pickle until it is done)
+_SNAPSHOT_NODES_PER_PICKLE = 1000
+## Compressed bytes read from a snapshot at once
+_SNAPSHOT_CHUNK_SIZE = 1024 * 1024
+
+class _CompressedWriter(object):
+    """Compresses whatever is written before passing it on to the file, so the pickles of a snapshot are never held in memory"""
+
+    def __init__(self, f) -> None:
+        self.f = f
+        self.compressor = zlib.compressobj()
+
+    def write(self, data:bytes) -> int:
+        self.f.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        self.f.write(self.compressor.flush())
+
+class _CompressedReader(object):
+    """Decompresses the file a chunk at a time for the unpickler (which only needs read and readline)"""
+
+    def __init__(self, f) -> None:
+        self.f = f
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+        self.position = 0
+
+    def _fill(self, size:int) -> bool:
+        """Decompress more of the file until size bytes are buffered, False if the file has ended before"""
+        if self.position > 0:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+        while len(self.buffer) < size:
+            chunk = self.f.read(_SNAPSHOT_CHUNK_SIZE)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                return len(self.buffer) >= size
+            self.buffer += self.decompressor.decompress(chunk)
+        return True
+
+    def read(self, size:int = -1) -> bytes:
+        if size < 0:
+            while self._fill(len(self.buffer) + _SNAPSHOT_CHUNK_SIZE):
+                pass
+            size = len(self.buffer) - self.position
+        elif len(self.buffer) - self.position < size:
+            self._fill(size)
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self) -> bytes:
+        while True:
+            end = self.buffer.find(b"\n", self.position)
+            if end >= 0:
+                return self.read(end + 1 - self.position)
+            if not self._fill(len(self.buffer) - self.position + _SNAPSHOT_CHUNK_SIZE):
+                ## The last line, the rest of the file might still have been decompressed into the buffer
+                end = self.buffer.find(b"\n", self.position)
+                return self.read(end + 1 - self.position if end >= 0 else -1)
+
+def _tree_snapshot_file(source_id:str, imported:bool = False, pending:bool = False) -> str:
+    snapshot_name = ".tree-snapshot.imported.bin" if imported else ".tree-snapshot.pending.bin" if pending else ".tree-snapshot.bin"
+    return os.path.join(app.config["dynamic_metadata_directory"], source_id, snapshot_name)
+
+def _save_tree_snapshot(conn, top_elements:dict, attributes:dict, children:dict, dataset_version:str = None) -> None:
+    """Keep the data the trees were built from, so they can be built again without fetching (see load_tree_snapshot)
+
+    The snapshot is pending until the CSV files of the trees are written (see keep_tree_snapshot), a failed run never replaces the last one
+    The snapshot is a pickle of its details, followed by pickles of ("attributes" or "children", {node_uri: ...}) for every _SNAPSHOT_NODES_PER_PICKLE nodes
+    Each is compressed and written as it is made, only the fetched data itself is in memory
+    """
+    snapshot_file = _tree_snapshot_file(conn["source_id"], pending = True)
+    snapshot = {
+        "source_id": conn["source_id"],
+        "dataset_version": dataset_version,
+        "fetch_timestamp": conn.get("fetch_timestamp"),
+        "top_elements": top_elements
+    }
+    try:
+        os.makedirs(os.path.dirname(snapshot_file), exist_ok = True)
+        with open(snapshot_file + ".tmp", "wb") as f:
+            f.write(_SNAPSHOT_MAGIC)
+            f.write(_SNAPSHOT_VERSION.to_bytes(2, "big"))
+            writer = _CompressedWriter(f)
+            pickle.dump(snapshot, writer, protocol = pickle.HIGHEST_PROTOCOL)
+            for part, nodes in [("attributes", attributes), ("children", children)]:
+                node_uris = list(nodes.keys())
+                for i in range(0, len(node_uris), _SNAPSHOT_NODES_PER_PICKLE):
+                    pickle.dump((part, {node_uri: nodes[node_uri] for node_uri in node_uris[i : i + _SNAPSHOT_NODES_PER_PICKLE]}), writer, protocol = pickle.HIGHEST_PROTOCOL)
+            writer.close()
+        os.replace(snapshot_file + ".tmp", snapshot_file)
+        logger.info("Saved the pending tree snapshot for source '{}': {} nodes (dataset version: {})".format(conn["source_id"], len(attributes), dataset_version))
+    except Exception as e:
+        logger.warn("Could not save the tree snapshot '{}': {}".format(snapshot_file, e))
+
+def keep_tree_snapshot(source_id:str) -> None:
+    """The CSV files of the fetched trees are written, so their pending snapshot (see _save_tree_snapshot) is now the source's snapshot"""
+    pending_file = _tree_snapshot_file(source_id, pending = True)
+    if os.path.isfile(pending_file):
+        os.replace(pending_file, _tree_snapshot_file(source_id))
+
+def discard_tree_snapshot(source_id:str) -> None:
+    """The CSV files of the fetched trees weren't written, so their pending snapshot (see _save_tree_snapshot) doesn't describe anything"""
+    pending_file = _tree_snapshot_file(source_id, pending = True)
+    if os.path.isfile(pending_file):
+        os.remove(pending_file)
+
+def load_tree_snapshot(source_id:str, imported:bool = False) -> dict:
+    """The data of the source's last fetched trees (see _save_tree_snapshot), None if there isn't a usable snapshot
+
+    :param imported: The snapshot of the trees last loaded into the database instead (see mark_dataset_imported)
+    """
+    snapshot_file = _tree_snapshot_file(source_id, imported)
+    if not os.path.isfile(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, "rb") as f:
+            header = f.read(len(_SNAPSHOT_MAGIC) + 2)
+            if header[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC or int.from_bytes(header[len(_SNAPSHOT_MAGIC):], "big") != _SNAPSHOT_VERSION:
+                logger.warn("Ignoring the tree snapshot '{}', it isn't a snapshot of this version".format(snapshot_file))
+                return None
+            reader = _CompressedReader(f)
+            snapshot:dict = pickle.load(reader)
+            snapshot["attributes"] = {}
+            snapshot["children"] = {}
+            while True:
+                try:
+                    part, nodes = pickle.load(reader)
+                except EOFError:
+                    return snapshot
+                snapshot[part].update(nodes)
+    except Exception as e:
+        logger.warn("Could not read the tree snapshot '{}': {}".format(snapshot_file, e))
+        return None
+
+def pull_snapshot_datatree(snapshot:dict, report:dict = None, deadline:object = None) -> dict:
+    """Build the trees again from a snapshot (see load_tree_snapshot), without fetching anything
+
+    The nodes keep the fetch time of the snapshot, it's when their data was fetched
+    """
+    source_id = snapshot["source_id"]
+    logger.info("Building the trees for source '{}' from its snapshot (dataset version: {})".format(source_id, snapshot["dataset_version"]))
+    metadata_trees:dict = {}
+    conn = {"source_id": source_id, "deadline": deadline, "fetch_timestamp": snapshot["fetch_timestamp"]}
+    _use_tree_backend(conn, source_config(source_id))
+    attributes, children = snapshot["attributes"], snapshot["children"]
+    metadata_trees[source_id] = _finished_trees(conn, [_assemble_tree(conn, node_uri, node_type, children, attributes) for node_uri, node_type in snapshot["top_elements"].items()])
+    _fetch_report(conn, report)
+    return metadata_trees
+
+def tree_changes(previous:dict, current:dict, trees:list = None, deadline:object = None) -> dict:
+    """Changes of a source's trees between two snapshots (see load_tree_snapshot), eg since the last import
+
+    :param trees: The trees built from the current snapshot, if already built
+    :return: dict with the "previous" and "current" dataset version and fetch time, and the changes:
+        "nodes" - URIs of the "added" and "removed" nodes, the "moved" nodes (with their previous and current parent URIs) and the "changed" nodes (with the names of the changed attributes)
+        "paths" - the "added" and "removed" i2b2 paths (c_fullname), and the "changed" paths (a different node, or the node has changed)
+    """
+    source_id = current["source_id"]
+    previous_index = TreeIndex.TreeIndex(pull_snapshot_datatree(previous, deadline = deadline)[source_id])
+    current_index = TreeIndex.TreeIndex(trees if trees is not None else pull_snapshot_datatree(current, deadline = deadline)[source_id])
+    previous_parents = _node_parents(previous["children"])
+    current_parents = _node_parents(current["children"])
+    kept_uris = set(previous_index.uris.keys()) & set(current_index.uris.keys())
+    moved = []
+    changed = []
+    for node_uri in sorted(kept_uris):
+        if previous_parents.get(node_uri, []) != current_parents.get(node_uri, []):
+            moved.append({"node_uri": node_uri, "previous_parents": previous_parents.get(node_uri, []), "parents": current_parents.get(node_uri, [])})
+        previous_attributes = previous["attributes"].get(node_uri) or {}
+        current_attributes = current["attributes"].get(node_uri) or {}
+        changed_attributes = sorted(name for name in set(previous_attributes.keys()) | set(current_attributes.keys()) if previous_attributes.get(name) != current_attributes.get(name))
+        if len(changed_attributes) > 0:
+            changed.append({"node_uri": node_uri, "attributes": changed_attributes})
+    changed_uris = set(node["node_uri"] for node in changed)
+    ## The nodes' lines are indexed with their URIs
+    previous_paths = previous_index.paths
+    current_paths = current_index.paths
+    changes = {
+        "previous": {"dataset_version": previous.get("dataset_version"), "fetch_timestamp": previous.get("fetch_timestamp")},
+        "current": {"dataset_version": current.get("dataset_version"), "fetch_timestamp": current.get("fetch_timestamp")},
+        "nodes": {
+            "added": sorted(set(current_index.uris.keys()) - kept_uris),
+            "removed": sorted(set(previous_index.uris.keys()) - kept_uris),
+            "moved": moved,
+            "changed": changed
+        },
+        "paths": {
+            "added": sorted(current_paths.keys() - previous_paths.keys()),
+            "removed": sorted(previous_paths.keys() - current_paths.keys()),
+            "changed": sorted(path for path in current_paths.keys() & previous_paths.keys() if current_paths[path] != previous_paths[path] or current_paths[path] in changed_uris)
+        }
+    }
+    logger.info("Changes of the trees of source '{}': {}".format(source_id, {part: {kind: len(items) for kind, items in kinds.items()} for part, kinds in changes.items() if part in ["nodes", "paths"]}))
+    return changes
+
+def _node_parents(children:dict) -> dict:
+    """{node_uri: [parent URIs]} from the fetched children of each node"""
+    parents:dict = {}
+    for node_uri, node_children in children.items():
+        for child_uri in node_children or {}:
+            parents.setdefault(child_uri, []).append(node_uri)
+    return {node_uri: sorted(node_parents) for node_uri, node_parents in parents.items()}
+
+def write_tree_changes(changes:dict, out_dir:str) -> str:
+    """Write the changes (see tree_changes) next to the source's CSV files, return the file path"""
+    changes_file = os.path.join(out_dir, ".tree-changes.json")
+    with open(changes_file + ".tmp", "w") as f:
+        json.dump(changes, f, indent = 1)
+    os.replace(changes_file + ".tmp", changes_file)
+    return changes_file
+
+def _fetch_report(conn, report:dict = None) -> None:
+    """Log (and add to the report) the nodes reached through more than one parent and any cycles found while building the trees"""
+    cycles:list = conn.get("cycles", [])
+    shared_nodes:dict = {node_uri: count for node_uri, count in conn.get("node_visits", {}).items() if count > 1}
+    logger.info("Built trees for source '{}': {} nodes reached from more than one parent, {} cycles skipped".format(conn["source_id"], len(shared_nodes), len(cycles)))
+    if report is not None:
+        report["shared_nodes"] = len(shared_nodes)
+        report["cycles"] = cycles
+
+def _fetch_crawl(conn, top_elements:dict) -> list:
+    """Crawl each tree node by node (2 queries per node)"""
+    return [get_tree(conn, node_uri, node_type) for node_uri, node_type in top_elements.items()]
+
+def _fetch_bulk(conn, top_elements:dict) -> list:
+    """Pull every relation and every node's attributes with a few large queries, then build the trees locally
+
+    NOTE: Nothing is checkpointed (or resumed) in this mode, the queries are all or nothing (see pull_fuseki_datatree)
+    """
+    ## Kept with the connection like the fetched nodes of the other modes (see _fetched_nodes)
+    conn["node_children"] = children = queries.all_children(conn)
+    conn["node_attributes"] = attributes = queries.all_attributes(conn)
+    return [_assemble_tree(conn, node_uri, node_type, children, attributes) for node_uri, node_type in top_elements.items()]
+
+def _fetch_batched(conn, top_elements:dict) -> list:
+    """Fetch the trees level by level, each level (split into batches, see _batches) with 1 attributes and 1 children query per batch"""
+    settings = source_config(conn["source_id"])
+    batch_size = int(settings.get("batch_size", 100))
+    batch_max_bytes = int(settings.get("batch_max_bytes", 4096))
+    attributes, children = _fetched_nodes(conn)
+    fetched:set = {node_uri for node_uri in children.keys() if _is_fetched(node_uri, attributes, children)}
+    ## Top elements, or the nodes left from the checkpoint
+    frontier:list = _frontier(top_elements, attributes, children)
+    depth = 0
+    while len(frontier) > 0:
+        logger.info("Fetching level {} of the trees: {} nodes in batches of up to {} ({} bytes)".format(depth, len(frontier), batch_size, batch_max_bytes))
+        for batch in _batches(frontier, batch_size, batch_max_bytes):
+            attributes.update(queries.all_attributes(conn, batch))
+            batch_children:dict = queries.all_children(conn, batch)
+            ## Nodes without children are fetched too
+            for node_uri in batch:
+                children[node_uri] = batch_children.get(node_uri, {})
+            _save_checkpoint(conn)
+        fetched.update(frontier)
+        ## Next level is every child not yet fetched (deduplicated, but keeping the order)
+        frontier = list(dict.fromkeys([child_uri for node_uri in frontier for child_uri in children.get(node_uri, {}) if child_uri not in fetched]))
+        depth += 1
+    return [_assemble_tree(conn, node_uri, node_type, children, attributes) for node_uri, node_type in top_elements.items()]
+
+def _batches(node_uris:list, batch_size:int, max_bytes:int):
+    """Split the nodes into batches of at most batch_size nodes, with at most max_bytes of URIs in the query (see queries.values_size)
+
+    The queries are sent in the URL, which fuseki (and any proxy in front of it) only accepts up to a limit
+    """
+    batch:list = []
+    batch_bytes = 0
+    for node_uri in node_uris:
+        uri_bytes = queries.values_size(node_uri)
+        if len(batch) > 0 and (len(batch) >= batch_size or batch_bytes + uri_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(node_uri)
+        batch_bytes += uri_bytes
+    if len(batch) > 0:
+        yield batch
+
+def _fetch_concurrent(conn, top_elements:dict) -> list:
+    """Fetch node by node like "crawl", but with up to "max_workers" nodes being fetched at the same time
+
+    The trees are only built once everything is fetched, so the result is the same as "crawl" regardless of which request finishes first
+    """
+    max_workers = int(source_config(conn["source_id"]).get("max_workers", 4))
+    ## The worker threads need the app context for the config
+    flask_app = app._get_current_object()
+    def fetch_node(node_uri:str) -> tuple:
+        with flask_app.app_context():
+            logger.info("Fetching the node data for '{}'".format(node_uri))
+            return node_uri, queries.getAttributes(conn, node_uri), queries.getChildren(conn, node_uri)
+
+    attributes, children = _fetched_nodes(conn)
+    fetched:set = {node_uri for node_uri in children.keys() if _is_fetched(node_uri, attributes, children)}
+    logger.info("Fetching trees with {} workers".format(max_workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending:set = set()
+        try:
+            ## Top elements, or the nodes left from the checkpoint
+            for node_uri in _frontier(top_elements, attributes, children):
+                fetched.add(node_uri)
+                pending.add(executor.submit(fetch_node, node_uri))
+            while len(pending) > 0:
+                done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for job in done:
+                    node_uri, attributes[node_uri], children[node_uri] = job.result()
+                    for child_uri in children[node_uri].keys():
+                        if child_uri not in fetched:
+                            fetched.add(child_uri)
+                            pending.add(executor.submit(fetch_node, child_uri))
+                _save_checkpoint(conn)
+                _check_deadline(conn, "Fetching the trees")
+        except BaseException:
+            ## Don't start the queued nodes, only the requests already running are waited for
+            executor.shutdown(wait = False, cancel_futures = True)
+            raise
+    return [_assemble_tree(conn, node_uri, node_type, children, attributes) for node_uri, node_type in top_elements.items()]
+
+def get_tree(conn, node_uri:str, node_type:str, parent_node:object = None, ancestors:set = None):
+    """Get all children under a single node
+
+    Each node's attributes and children are only fetched the first time it is reached (see _node_data), later parents reuse them
+
+    :param ancestors: URIs of the nodes above this one, a child which is also an ancestor is a cycle and is skipped
+    """
+    return _build_tree(conn, node_uri, node_type, _node_data, parent_node, ancestors)
+
+def _build_tree(conn, node_uri:str, node_type:str, node_data, parent_node:object = None, ancestors:set = None):
+    """Build the node and everything under it, depth first with the children in order
+
+    Iterative with an explicit stack of the nodes being built (and their remaining children), very deep trees don't reach the recursion limit
+
+    :param node_data: function(conn, node_uri) returning the node's attributes and children
+    :param ancestors: URIs of the nodes above this one, a child which is also an ancestor is a cycle and is skipped
+    """
+    if ancestors is None:
+        ancestors = set()
+    stack = []
+    def start_node(node_uri:str, node_type:str, parent_node:object) -> object:
+        node_uri = node_uri.strip("<>")
+        element, children = node_data(conn, node_uri)
+        new_node = _new_node(conn, element, node_uri, node_type, parent_node)
+        ancestors.add(node_uri)
+        stack.append((node_uri, new_node, iter(children.items())))
+        return new_node
+    top_node = start_node(node_uri, node_type, parent_node)
+    while len(stack) > 0:
+        node_uri, new_node, remaining_children = stack[-1]
+        for child_uri, child_type in remaining_children:
+            if child_uri.strip("<>") in ancestors:
+                _cycle_found(conn, node_uri, child_uri.strip("<>"))
+                continue
+            start_node(child_uri, child_type, new_node)
+            break
+        else:
+            ## All children done
+            ancestors.discard(node_uri)
+            stack.pop()
+    return top_node
+
+def _node_data(conn, node_uri:str) -> tuple:
+    """Attributes and children of a node - fetched once per run and kept with the connection's fetched nodes (nodes can have several parents)"""
     from queries import queries
+    attributes, children = _fetched_nodes(conn)
+    node_visits:dict = conn.setdefault("node_visits", {})
+    node_visits[node_uri] = node_visits.get(node_uri, 0) + 1
+    if not _is_fetched(node_uri, attributes, children):
+        _check_deadline(conn, "Fetching the trees")
+        logger.info("Fetching the node data for '{}'".format(node_uri))
+        attributes[node_uri] = queries.getAttributes(conn, node_uri)
+        logger.debug("Node data: {}".format(attributes[node_uri]))
+        children[node_uri] = queries.getChildren(conn, node_uri)
+        _save_checkpoint(conn)
+    else:
+        logger.debug("Reusing the node data for '{}' (reached from another parent or the checkpoint)".format(node_uri))
+    return attributes[node_uri], children[node_uri]
+
+def _check_deadline(conn, stage:str) -> None:
+    """Raise DeadlineExceeded if the connection's deadline (if any) has passed"""
+    if conn.get("deadline") is not None:
+        conn["deadline"].check(stage)
 
-    node_uri = node_uri.strip("<>")
-    element:dict = queries.getAttributes(conn, node_uri)
-    logger.debug("Node data: {}".format(element))
+def _cycle_found(conn, node_uri:str, child_uri:str) -> None:
+    """Record a child which is already one of the node's ancestors - it is left out of the tree"""
+    logger.warn("Cycle in the tree: '{}' has its ancestor '{}' as a child, skipping it".format(node_uri, child_uri))
+    conn.setdefault("cycles", []).append({"parent": node_uri, "child": child_uri})
 
+def _assemble_tree(conn, node_uri:str, node_type:str, children:dict, attributes:dict, parent_node:object = None, ancestors:set = None):
+    """Build all children under a single node from already fetched relations and attributes
+
+    :param ancestors: URIs of the nodes above this one, a child which is also an ancestor is a cycle and is skipped
+    """
+    return _build_tree(conn, node_uri, node_type, lambda conn, node_uri: _fetched_node_data(conn, node_uri, children, attributes), parent_node, ancestors)
+
+def _fetched_node_data(conn, node_uri:str, children:dict, attributes:dict) -> tuple:
+    """Attributes and children of a node from the already fetched ones
+
+    A node missing from the attributes is fetched alone from fuseki, the trees of other sources (RDF dumps, snapshots) can't be built without it
+    """
+    node_visits:dict = conn.setdefault("node_visits", {})
+    node_visits[node_uri] = node_visits.get(node_uri, 0) + 1
+    _check_deadline(conn, "Building the trees")
+    if node_uri not in attributes:
+        ## Only fuseki connections (see connection.get_fuseki_connection) can be queried
+        if "session" not in conn:
+            raise ValueError("Node '{}' of source '{}' has no attributes in the data the trees are built from, it can't be fetched alone".format(node_uri, conn["source_id"]))
+        logger.warning("Node '{}' was missing from the fetched attributes, fetching it alone".format(node_uri))
+        from queries import queries
+        attributes[node_uri] = queries.getAttributes(conn, node_uri)
+    return attributes[node_uri], children.get(node_uri, {})
+
+def _new_node(conn, element:dict, node_uri:str, node_type:str, parent_node:object) -> object:
+    """Add the node to the connection's tree store (its number is returned) when there is one, otherwise create its MetaNode object"""
+    tree_store = conn.get("tree_store")
+    if tree_store is None:
+        return _new_element(element, node_uri, node_type, parent_node, conn["source_id"], conn.get("fetch_timestamp"))
+    return tree_store.add_node(
+        node_uri = node_uri,
+        name = element["name"],
+        node_type = node_type,
+        parent_index = parent_node,
+        pref_labels = {element["prefLabel"]: "en"},
+        display_labels = {element["displayLabel"]: "en"},
+        notations = element["notations"],
+        descriptions = {element["description"]: "en"},
+        datatype = element["datatype"],
+        dwh_display_status = element["display"],
+        units = element["units"],
+        sourcesystem_cd = conn["source_id"]
+    )
+
+def _use_tree_backend(conn, settings:dict) -> None:
+    """Set up the store for the nodes of the source's tree_backend:
+        "objects" - a MetaNode object per node, created in batches by a MetaNodeStore
+        "columnar" - all nodes in the columns of a ColumnarTree, smaller and faster to build for very large ontologies
+        "sqlite" - all nodes in an SqliteTree database under the source's dynamic metadata directory, only a few blocks of nodes are kept in memory
+            NOTE: This bounds the memory of the built trees only, the fetched attributes and children of every node are still held for the whole run (the memory of a fetch grows with the ontology)
+    """
+    tree_backend = settings.get("tree_backend", "objects")
+    if tree_backend == "objects":
+        conn["tree_store"] = MetaNode.MetaNodeStore(conn.get("fetch_timestamp"))
+    elif tree_backend == "columnar":
+        from model.ColumnarTree import ColumnarTree
+        conn["tree_store"] = ColumnarTree(conn.get("fetch_timestamp"))
+    elif tree_backend == "sqlite":
+        from model.SqliteTree import SqliteTree
+        store_dir = os.path.join(app.config["dynamic_metadata_directory"], conn["source_id"])
+        os.makedirs(store_dir, exist_ok = True)
+        ## Unique per store, several trees of the same source can be built at once
+        store_file = os.path.join(store_dir, ".tree-store-{}-{}.sqlite".format(os.getpid(), id(conn)))
+        conn["tree_store"] = SqliteTree(store_file, conn.get("fetch_timestamp"), hot_nodes = int(settings.get("tree_store_hot_nodes", 8192)))
+    else:
+        logger.warn("Unknown tree_backend '{}' for source '{}', using 'objects'".format(tree_backend, conn["source_id"]))
+        conn["tree_store"] = MetaNode.MetaNodeStore(conn.get("fetch_timestamp"))
+
+def _finished_trees(conn, trees:list) -> list:
+    """The built trees, which are used like their top MetaNode (a tree store's node numbers become its trees)"""
+    tree_store = conn.get("tree_store")
+    if tree_store is None:
+        return trees
+    tree_store.finish()
+    logger.info("Stored {} nodes for source '{}' in a {}".format(len(tree_store), conn["source_id"], type(tree_store).__name__))
+    return [tree_store.tree(top_index) for top_index in trees]
+
+def _new_element(element:dict, node_uri:str, node_type:str, parent_node:object, source_id:str, fetch_timestamp:str = None) -> object:
+    """Create the node object from its fetched attributes"""
     logger.debug("element[\"notations\"]: {}".format(element["notations"]))
-    from model import MetaNode
     new_elem = MetaNode.MetaNode(
         node_uri = node_uri,
         name = element["name"],
@@ -111,7 +767,8 @@ def _element(conn, node_uri:str, node_type:str = "concept", parent_node:object =
         datatype = element["datatype"],
         units = element["units"],
         descriptions = {element["description"]: "en"},
-        sourcesystem_cd = conn["source_id"]
+        sourcesystem_cd = source_id,
+        fetch_timestamp = fetch_timestamp
     )
     return new_elem
 
@@ -132,24 +789,168 @@ def combine_csv_trees(trees:list) -> dict:
                     combined_tree[schema][table].extend(data)
     return combined_tree
 
-def write_csv(csv_tree:dict, sourcesystem_id:str, out_dir:str, output_delim:str = ","):
-    """Take a dict which has a list of lists for each table - write each dict entry as a csv file"""
+def write_csv(csv_tree:dict, sourcesystem_id:str, out_dir:str, output_delim:str = ",", deadline:object = None):
+    """Take a dict which has a list of lists for each table - write each dict entry as a csv file (see write_csv_rows)"""
     logger.debug("Writing csv_tree to files under '{}': (length {})".format(out_dir, len(csv_tree)))
+    tables = [(schema_name, table_name) for schema_name, schema_tables in csv_tree.items() for table_name in schema_tables.keys()]
+    rows = ((schema_name, table_name, row) for schema_name, schema_tables in csv_tree.items() for table_name, data_structure in schema_tables.items() for row in data_structure)
+    return write_csv_rows(rows, sourcesystem_id, out_dir, output_delim, deadline, tables)
+
+def write_csv_rows(rows, sourcesystem_id:str, out_dir:str, output_delim:str = ",", deadline:object = None, tables:list = None):
+    """Write (schema, table, row) tuples, as they come, to a csv file per table (e.g. from MetaNode.iter_tree_rows)
+
+    The files are written to temporary files first and only replace the existing ones once all of them are complete
+
+    :param tables: (schema, table) of the files to write, even without any rows - all i2b2 tables when not supplied
+    :param deadline: If supplied, DeadlineExceeded is raised once it has passed (checked between rows), no files are replaced
+    """
+    if tables is None:
+        tables = list(MetaNode.table_cols.keys())
+    written_files:dict = {}
+    open_files:dict = {}
     try:
         if not os.path.isdir(out_dir):
             os.makedirs(out_dir)
-        for schema_name, tables in csv_tree.items():
-            for table_name, data_structure in tables.items():
-                filename = os.path.join(out_dir, "{sourcesystem_id}.{schema_name}.{table_name}.csv".format(sourcesystem_id=sourcesystem_id, schema_name=schema_name, table_name=table_name))
-                logger.debug("Writing csv data to file: {}".format(filename))
-                with open(filename, 'w') as f: 
-                    write = csv.writer(f, delimiter = output_delim)
-                    write.writerows(data_structure)
+        for schema_name, table_name in tables:
+            filename = os.path.join(out_dir, _csv_file_name(sourcesystem_id, schema_name, table_name))
+            ## Temp files are dot-prefixed, so they're never taken for the source's CSV files
+            temp_filename = os.path.join(out_dir, ".{}.tmp".format(os.path.basename(filename)))
+            logger.debug("Writing csv data to file: {}".format(temp_filename))
+            written_files[temp_filename] = filename
+            f = open(temp_filename, 'w')
+            open_files[(schema_name, table_name)] = (f, csv.writer(f, delimiter = output_delim))
+        for schema_name, table_name, row in rows:
+            if deadline is not None:
+                deadline.check("Writing the CSV files")
+            open_files[(schema_name, table_name)][1].writerow(row)
+        _close_files(open_files)
+        for temp_filename, filename in written_files.items():
+            os.replace(temp_filename, filename)
         return True
+    except DeadlineExceeded:
+        _close_files(open_files)
+        _remove_files(written_files.keys())
+        raise
     except Exception as e:
+        _close_files(open_files)
+        _remove_files(written_files.keys())
         logger.error("Failed to write CSV data: {}".format(e))
         return False
 
+def write_trees_csv(trees:list, sourcesystem_id:str, out_dir:str, output_delim:str = ",", deadline:object = None, report:dict = None) -> bool:
+    """Write the csv files of the source from the top level trees, only generating the lines of the trees which changed since the last time
+
+    Each tree's lines are kept in fragment files of their own (under .trees/<c_table_cd>), with the tree's fingerprint (see MetaNode.fingerprint)
+    A tree with the same fingerprint and csv settings as its fragments is not generated again, the source's csv files are all fragments one after the other
+    The fingerprints of all trees are also kept in .fingerprints.json, next to the source's csv files
+
+    :param deadline: If supplied, DeadlineExceeded is raised once it has passed, no files of the source are replaced
+    :param report: If supplied, the c_table_cd of the "regenerated" and "unchanged" trees are added
+    """
+    config_fingerprint = _csv_config_fingerprint(output_delim)
+    fingerprints:dict = {}
+    fragment_dirs:list = []
+    regenerated:list = []
+    unchanged:list = []
+    for tree in trees:
+        if deadline is not None:
+            deadline.check("Generating the CSV data")
+        tree_id = tree.c_table_cd
+        if tree_id in fingerprints:
+            ## Trees with the same top path, rare but not to be mixed up
+            tree_id = "{}-{}".format(tree_id, len(fragment_dirs))
+        fingerprint = tree.fingerprint
+        fragment_dir = os.path.join(out_dir, ".trees", tree_id)
+        fragment_fingerprint = {"config": config_fingerprint, "fingerprint": fingerprint}
+        if _read_json(os.path.join(fragment_dir, ".fingerprint.json")) == fragment_fingerprint and _fragments_complete(fragment_dir, sourcesystem_id):
+            logger.info("Tree '{}' ({}) is unchanged, reusing its csv lines".format(tree.name, tree_id))
+            unchanged.append(tree_id)
+        else:
+            logger.info("Generating the csv lines of tree '{}' ({})".format(tree.name, tree_id))
+            ## Never leave a fingerprint with fragments which don't match it
+            _remove_files([os.path.join(fragment_dir, ".fingerprint.json")])
+            if not write_csv_rows(tree.iter_tree_rows(), sourcesystem_id, fragment_dir, output_delim, deadline):
+                return False
+            with open(os.path.join(fragment_dir, ".fingerprint.json"), "w") as f:
+                json.dump(fragment_fingerprint, f)
+            regenerated.append(tree_id)
+        fingerprints[tree_id] = fingerprint
+        fragment_dirs.append(fragment_dir)
+    if not _combine_fragments(fragment_dirs, sourcesystem_id, out_dir, deadline):
+        return False
+    with open(os.path.join(out_dir, ".fingerprints.json"), "w") as f:
+        json.dump({"config": config_fingerprint, "trees": fingerprints}, f)
+    ## Trees which are gone (there are no fragments at all for a source without trees)
+    for tree_id in os.listdir(os.path.join(out_dir, ".trees")) if os.path.isdir(os.path.join(out_dir, ".trees")) else []:
+        if tree_id not in fingerprints:
+            shutil.rmtree(os.path.join(out_dir, ".trees", tree_id), ignore_errors = True)
+    logger.info("CSV files written for source '{}': {} trees regenerated, {} unchanged".format(sourcesystem_id, len(regenerated), len(unchanged)))
+    if report is not None:
+        report["regenerated"] = regenerated
+        report["unchanged"] = unchanged
+    return True
+
+def _csv_config_fingerprint(output_delim:str) -> str:
+    """Fingerprint of the settings the csv lines are made with, a tree's lines have to be generated again when they change"""
+    settings = {k: app.config.get(k) for k in ["i2b2_path_prefix", "i2b2_path_separator", "i2b2_multipath_container", "ontology_tablename", "sql_col_object_property_map", "fixed_value_cols"]}
+    settings["output_delim"] = output_delim
+    settings["table_cols"] = [[schema_name, table_name, cols] for (schema_name, table_name), cols in MetaNode.table_cols.items()]
+    return hashlib.sha1(json.dumps(settings, sort_keys = True).encode()).hexdigest()
+
+def _read_json(file_path:str):
+    """Content of a json file, None if it doesn't exist or can't be read"""
+    try:
+        with open(file_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _csv_file_name(sourcesystem_id:str, schema_name:str, table_name:str) -> str:
+    return "{sourcesystem_id}.{schema_name}.{table_name}.csv".format(sourcesystem_id=sourcesystem_id, schema_name=schema_name, table_name=table_name)
+
+def _fragments_complete(fragment_dir:str, sourcesystem_id:str) -> bool:
+    """Whether the fragment files of all tables exist"""
+    return all(os.path.isfile(os.path.join(fragment_dir, _csv_file_name(sourcesystem_id, schema_name, table_name))) for schema_name, table_name in MetaNode.table_cols.keys())
+
+def _combine_fragments(fragment_dirs:list, sourcesystem_id:str, out_dir:str, deadline:object = None) -> bool:
+    """Write each csv file of the source as the same file of all fragments, one after the other - replacing the existing files once all are complete"""
+    written_files:dict = {}
+    try:
+        ## Not created by any fragments when the source has no trees
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        for schema_name, table_name in MetaNode.table_cols.keys():
+            filename = os.path.join(out_dir, _csv_file_name(sourcesystem_id, schema_name, table_name))
+            temp_filename = os.path.join(out_dir, ".{}.tmp".format(os.path.basename(filename)))
+            written_files[temp_filename] = filename
+            with open(temp_filename, "wb") as f:
+                for fragment_dir in fragment_dirs:
+                    if deadline is not None:
+                        deadline.check("Writing the CSV files")
+                    with open(os.path.join(fragment_dir, os.path.basename(filename)), "rb") as fragment:
+                        shutil.copyfileobj(fragment, f)
+        for temp_filename, filename in written_files.items():
+            os.replace(temp_filename, filename)
+        return True
+    except DeadlineExceeded:
+        _remove_files(written_files.keys())
+        raise
+    except Exception as e:
+        _remove_files(written_files.keys())
+        logger.error("Failed to combine the CSV data of the trees: {}".format(e))
+        return False
+
+def _close_files(open_files:dict) -> None:
+    """Close the files (and writers) of write_csv_rows"""
+    for f, _ in open_files.values():
+        f.close()
+
+def _remove_files(file_paths:list) -> None:
+    """Remove the (partially written) files which exist"""
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
 def update_col_limits(db_conn, schema:str, table:str, limits:dict = None) -> bool:
     """Set limits for any defined cols the schema/table
     :param limits: {col_name: col_type} - where an entry exists in this dict, it will be updated
@@ -275,7 +1076,59 @@ def update_headers(row:dict, table_headers:list) -> tuple[dict, bool]:
         changed = True
     return new_row, changed
 
-def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim:str = ","):
+def load_conflicts(db_conn, source_id:str, csv_file_paths:list, delim:str = ",", deadline:object = None) -> list:
+    """Check the csv files of a source for conflicts before loading them - which the inserts would silently skip (ON CONFLICT DO NOTHING)
+
+    The lines are indexed by path and notation (see TreeIndex), then all rows of other sources with any of the paths or codes are read in a single query
+    Nothing is changed in the database, the read is rolled back so loading starts a new transaction
+    :param csv_file_paths: The files which are loaded (see push_csv_to_database), written without a header line (see write_csv_rows)
+    :return: list of conflicts (see TreeIndex.conflicts), the lines are referenced as "<csv file>:<line number>"
+    """
+    tree_index = TreeIndex.TreeIndex()
+    for csv_filepath in csv_file_paths:
+        csv_filename = os.path.basename(csv_filepath)
+        _, table_name = _csv_schema_table(csv_filename, source_id)
+        if table_name not in TreeIndex._col_positions:
+            continue
+        with open(csv_filepath, "r", newline = "") as f:
+            for line_number, line in enumerate(csv.reader(f, delimiter = delim), start = 1):
+                if deadline is not None and line_number % 1000 == 0:
+                    deadline.check("Checking for conflicts")
+                tree_index.add_line(table_name, line, "{}:{}".format(csv_filename, line_number))
+    logger.info("Indexed the csv files of source '{}': {} paths, {} notations".format(source_id, len(tree_index.paths), len(tree_index.notations)))
+    loaded_rows = loaded_paths_and_codes(db_conn, source_id, list(tree_index.paths.keys()), list(tree_index.notations.keys()))
+    conflicts = tree_index.conflicts(loaded_rows)
+    if len(conflicts) > 0:
+        logger.warn("Conflicts for source '{}' found before loading: {}".format(source_id, len(conflicts)))
+    return conflicts
+
+def _csv_schema_table(csv_filename:str, source_id:str) -> tuple:
+    """Schema and table of a csv file, from its name (<source_id>.<schema_name>.<table_name>.csv or <schema_name>.<table_name>.csv)"""
+    ## TOOD: More sanity checks, this is making dangerous assumptions about the file naming policy
+    if source_id in csv_filename:
+        return csv_filename.split(".")[1], csv_filename.split(".")[2]
+    return csv_filename.split(".")[0], csv_filename.split(".")[1]
+
+def loaded_paths_and_codes(db_conn, source_id:str, paths:list, codes:list) -> list:
+    """(table_name, path, code, sourcesystem_cd) of every row loaded from other sources with any of the paths (i2b2 and dimension tables) or codes (dimension tables)"""
+    loaded_query = """
+        SELECT 'i2b2', c_fullname, c_basecode, sourcesystem_cd FROM i2b2metadata.i2b2 WHERE c_fullname = ANY(%(paths)s) AND sourcesystem_cd IS DISTINCT FROM %(source_id)s
+        UNION ALL
+        SELECT 'concept_dimension', concept_path, concept_cd, sourcesystem_cd FROM i2b2demodata.concept_dimension WHERE (concept_path = ANY(%(paths)s) OR concept_cd = ANY(%(codes)s)) AND sourcesystem_cd IS DISTINCT FROM %(source_id)s
+        UNION ALL
+        SELECT 'modifier_dimension', modifier_path, modifier_cd, sourcesystem_cd FROM i2b2demodata.modifier_dimension WHERE (modifier_path = ANY(%(paths)s) OR modifier_cd = ANY(%(codes)s)) AND sourcesystem_cd IS DISTINCT FROM %(source_id)s;
+    """
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(loaded_query, {"paths": paths, "codes": codes, "source_id": source_id})
+        loaded_rows = cursor.fetchall()
+        logger.debug("Rows loaded from other sources with the same paths or codes: {}".format(len(loaded_rows)))
+        return loaded_rows
+    finally:
+        cursor.close()
+        db_conn.rollback()
+
+def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim:str = ",", deadline:object = None):
     """Push any csv data which is listed to the database
     
     Sniffs for header line so should work with or without heading line - using database columns if no header
@@ -285,6 +1138,7 @@ def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim
     Also does some fixing of NULL and empty data
 
     :param prepared_file_paths: list of full filepaths
+    :param deadline: If supplied, DeadlineExceeded is raised once it has passed (checked between tables and rows), after rolling back
     :return: Boolean success/failure
     """
     ## TODO: Work with unknown delimiters (mostly , or ;)? Or always with ,?
@@ -302,14 +1156,10 @@ def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim
         try:
             cursor = db_conn.cursor()
             for csv_filepath in prepared_file_paths:
+                if deadline is not None:
+                    deadline.check("Loading into the database")
                 csv_filename = os.path.basename(csv_filepath)
-                ## TOOD: More sanity checks, this is making dangerous assumptions about the file naming policy
-                if source_id in csv_filename:
-                    current_schema = csv_filename.split(".")[1]
-                    current_table = csv_filename.split(".")[2]
-                else:
-                    current_schema = csv_filename.split(".")[0]
-                    current_table = csv_filename.split(".")[1]
+                current_schema, current_table = _csv_schema_table(csv_filename, source_id)
                 logger.debug("Interpreting CSV file '{}' (schema: {}, table: {}) with delimiter '{}'...".format(
                     csv_filename,
                     current_schema,
@@ -358,6 +1208,8 @@ def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim
                         ## Skip header
                         next(reader)
                     for data in reader:
+                        if deadline is not None:
+                            deadline.check("Loading into the database")
                         # logger.debug("data line: {}".format(data))
                         ## Add columns such as "sourcesystem_cd" if they are not in the CSV file
                         data, changed = update_headers(data, table_headers)
@@ -381,6 +1233,9 @@ def push_csv_to_database(db_conn, source_id:str, prepared_file_paths:list, delim
                 ## NOTE: Changed is updated per function each line, so this will only see if the last function applied to the last line made a change
                 logger.info("INSERTed values for '{}.{}' Added source: {}".format(current_schema, current_table, changed))
             return True
+        except DeadlineExceeded:
+            db_conn.rollback()
+            raise
         except Exception as e:
             db_conn.rollback()
             logger.error("Failed to complete database INSERTs...\n{}".format(e))
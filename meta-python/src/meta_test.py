@@ -9,11 +9,19 @@ logger = logging.getLogger(__name__)
 
 # from flask import current_app as app
 
+import csv
 from datetime import datetime as dt
+from deadline import Deadline, DeadlineExceeded
+from flask import Flask
+import meta
 import model
+from model import TreeIndex
+import json
 import os
 import psycopg2
+from queries import cache, namespaces, queries
 import requests
+import tempfile
 import time
 import yaml
 from sqlalchemy import sql as sqlalch
@@ -202,3 +210,399 @@ def insert_sql_test():
 #             return False
 #         pass
 
+
+## Unit tests (pytest), run with the same APP_CONF_PATH and USER_CONF_PATH as the listener:
+## ```APP_CONF_PATH=../support/config/config.yaml USER_CONF_PATH=../support/config/i2b2meta_user_config.yaml python -m pytest meta_test.py```
+
+_test_source_id = "test-source"
+_test_fetch_timestamp = "2022-01-01 00:00:00.0"
+_ont = "http://data.dzl.de/ont/dwh#"
+
+def _test_app(dynamic_dir:str) -> Flask:
+    """App with the settings of the listener (see listener.load_settings), with a single fuseki source and the dynamic metadata under dynamic_dir"""
+    test_app = Flask(__name__)
+    for conf_path in [os.getenv("USER_CONF_PATH"), os.getenv("APP_CONF_PATH")]:
+        with open(conf_path, "r") as yaml_file:
+            test_app.config.update(yaml.safe_load(yaml_file))
+    test_app.config["dynamic_metadata_directory"] = dynamic_dir
+    test_app.config["fuseki_sources"] = {_test_source_id: "http://localhost:3030/test/query"}
+    test_app.config["fuseki_source_defaults"] = dict(test_app.config.get("fuseki_source_defaults") or {})
+    return test_app
+
+def _test_element(name:str, notations:dict = None, display:str = None, datatype:str = None, units:dict = None) -> dict:
+    """Attributes of a node, as fetched (see queries._element_attributes)"""
+    return {"name": name, "prefLabel": "Label of {}".format(name), "displayLabel": None, "description": "Description of {}".format(name), "display": display, "datatype": datatype, "notations": notations, "units": units}
+
+def _test_snapshot(dataset_version:str = "12-2022-01-01") -> dict:
+    """Snapshot (see meta.load_tree_snapshot) of a concept tree and a collection, with modifiers, a hidden node, a node with several notations and a node below both trees"""
+    attributes = {
+        _ont + "A": _test_element("A"),
+        _ont + "B": _test_element("B", {"S:1": None}, datatype = "integer", units = {"mg": None, "g": None}),
+        _ont + "C": _test_element("C", {"S:2": None, "L:3-4": None}),
+        _ont + "D": _test_element("D", {"S:5": None}, datatype = "string"),
+        _ont + "H": _test_element("H", {"S:6": None}, display = "i2b2hidden"),
+        _ont + "E": _test_element("E", {"S:7": None}),
+        _ont + "M": _test_element("M", {"dzl:M": None}),
+        _ont + "M2": _test_element("M2", {"dzl:M2": None, "dzl:M3": None}, datatype = "float"),
+        _ont + "Coll": _test_element("Coll"),
+        _ont + "Coll2": _test_element("Coll2"),
+        _ont + "F": _test_element("F", {"S:8": None})
+    }
+    children = {
+        _ont + "A": {_ont + "B": "concept", _ont + "C": "concept", _ont + "H": "concept", _ont + "E": "concept"},
+        _ont + "B": {},
+        _ont + "C": {_ont + "D": "concept", _ont + "M": "modifier"},
+        _ont + "D": {},
+        _ont + "H": {},
+        _ont + "E": {},
+        _ont + "M": {_ont + "M2": "modifier"},
+        _ont + "M2": {},
+        _ont + "Coll": {_ont + "E": "concept", _ont + "Coll2": "collection"},
+        _ont + "Coll2": {_ont + "F": "concept"},
+        _ont + "F": {}
+    }
+    return {
+        "source_id": _test_source_id,
+        "dataset_version": dataset_version,
+        "fetch_timestamp": _test_fetch_timestamp,
+        "top_elements": {_ont + "A": "concept", _ont + "Coll": "collection"},
+        "attributes": attributes,
+        "children": children
+    }
+
+def _test_trees(snapshot:dict, tree_backend:str = "objects") -> list:
+    """Trees built from the snapshot with the tree_backend (app context needed)"""
+    app.config["fuseki_source_defaults"]["tree_backend"] = tree_backend
+    return meta.pull_snapshot_datatree(snapshot)[_test_source_id]
+
+def _test_rows(trees:list) -> list:
+    """csv lines of all trees, as lists (the backends use lists or tuples)"""
+    return [(schema_name, table_name, list(line)) for tree in trees for schema_name, table_name, line in tree.iter_tree_rows()]
+
+class _TestResponse(object):
+    """Streamed response of a sparql query (see queries._text_lines), split into chunks which cut through the lines"""
+
+    def __init__(self, text:str, chunk_size:int = 7) -> None:
+        self.text = text
+        self.chunk_size = chunk_size
+
+    def iter_content(self, chunk_size:int = 1, decode_unicode:bool = False):
+        for i in range(0, len(self.text), self.chunk_size):
+            yield self.text[i : i + self.chunk_size]
+
+class _TestDatabase(object):
+    """Database connection (and cursor) which returns the given rows for any query (see meta.loaded_paths_and_codes)"""
+
+    def __init__(self, rows:list) -> None:
+        self.rows = rows
+        self.params = None
+        self.rolled_back = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query:str, params:dict = None) -> None:
+        self.params = params
+
+    def fetchall(self) -> list:
+        return self.rows
+
+    def close(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        self.rolled_back = True
+
+def test_is_fetched_and_frontier():
+    """A node is only fetched with both its attributes and children, the frontier is every known node which isn't"""
+    top_elements = {_ont + "A": "concept", _ont + "Coll": "collection"}
+    attributes = {_ont + "A": _test_element("A"), _ont + "B": _test_element("B")}
+    children = {_ont + "A": {_ont + "B": "concept", _ont + "C": "concept"}, _ont + "C": {}}
+    assert meta._is_fetched(_ont + "A", attributes, children)
+    ## Only attributes or only children, eg from an interrupted bulk fetch
+    assert not meta._is_fetched(_ont + "B", attributes, children)
+    assert not meta._is_fetched(_ont + "C", attributes, children)
+    assert meta._frontier(top_elements, attributes, children) == [_ont + "Coll", _ont + "B", _ont + "C"]
+
+def test_checkpoint_resume():
+    """A saved checkpoint is resumed for the same dataset version only"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        snapshot = _test_snapshot()
+        conn = {"source_id": _test_source_id}
+        meta._load_checkpoint(conn, snapshot["top_elements"], "v1", 60)
+        assert "node_children" not in conn
+        attributes, children = meta._fetched_nodes(conn)
+        attributes[_ont + "A"] = snapshot["attributes"][_ont + "A"]
+        children[_ont + "A"] = snapshot["children"][_ont + "A"]
+        ## Not saved again before checkpoint_seconds have passed
+        meta._save_checkpoint(conn)
+        assert not os.path.isfile(conn["checkpoint"]["file"])
+        meta._save_checkpoint(conn, force = True)
+        with open(conn["checkpoint"]["file"], "r") as f:
+            checkpoint = json.load(f)
+        assert checkpoint["frontier"] == [_ont + "Coll", _ont + "B", _ont + "C", _ont + "H", _ont + "E"]
+
+        resumed = {"source_id": _test_source_id}
+        meta._load_checkpoint(resumed, snapshot["top_elements"], "v1", 60)
+        assert meta._fetched_nodes(resumed) == (attributes, children)
+        changed = {"source_id": _test_source_id}
+        meta._load_checkpoint(changed, snapshot["top_elements"], "v2", 60)
+        assert "node_children" not in changed
+
+        meta._remove_checkpoint(resumed)
+        assert not os.path.isfile(conn["checkpoint"]["file"])
+
+def test_response_cache():
+    """Results are cached once all rows are read, for the same endpoint, dataset version and query"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        cache.purge(_test_source_id)
+        connection = {"source_id": _test_source_id, "prepared_request": requests.Request("GET", "http://localhost:3030/test/query").prepare(), "response_cache": {"version": "v1", "max_bytes": 1024 * 1024}}
+        rows = [{"element": _ont + "A", "type": "concept"}, {"element": _ont + "Coll", "type": "collection"}]
+        assert cache.get(connection, "SELECT 1") is None
+        ## Stopped before the last row, so not cached
+        partial = cache.store(connection, "SELECT 1", iter(rows))
+        next(partial)
+        partial.close()
+        assert cache.get(connection, "SELECT 1") is None
+        assert list(cache.store(connection, "SELECT 1", iter(rows))) == rows
+        assert list(cache.get(connection, "SELECT 1")) == rows
+        assert cache.get(connection, "SELECT 2") is None
+        assert cache.get(dict(connection, response_cache = {"version": "v2", "max_bytes": 1024 * 1024}), "SELECT 1") is None
+        assert cache.get(dict(connection, response_cache = None), "SELECT 1") is None
+        assert cache.purge(_test_source_id)
+        assert cache.get(connection, "SELECT 1") is None
+
+def test_response_cache_eviction():
+    """The least recently used results are removed once the source's cache is over its size"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        cache.purge(_test_source_id)
+        rows = [{"element": _ont + "A", "type": "concept"}]
+        connection = {"source_id": _test_source_id, "prepared_request": requests.Request("GET", "http://localhost:3030/test/query").prepare(), "response_cache": {"version": "v1", "max_bytes": 1024 * 1024}}
+        list(cache.store(connection, "SELECT 1", iter(rows)))
+        list(cache.store(connection, "SELECT 2", iter(rows)))
+        result_bytes = os.path.getsize(cache._cache_file(connection, "SELECT 1"))
+        ## SELECT 1 is used again, so SELECT 2 is the least recently used
+        os.utime(cache._cache_file(connection, "SELECT 2"), (time.time() - 60, time.time() - 60))
+        list(cache.get(connection, "SELECT 1"))
+        connection["response_cache"]["max_bytes"] = 2 * result_bytes
+        list(cache.store(connection, "SELECT 3", iter(rows)))
+        assert cache.get(connection, "SELECT 2") is None
+        assert list(cache.get(connection, "SELECT 1")) == rows
+        assert list(cache.get(connection, "SELECT 3")) == rows
+        cache.purge(_test_source_id)
+
+def test_tsv_term_value():
+    """URIs, literals (with a language tag or datatype and escapes), blank nodes and bare numbers"""
+    assert queries._tsv_term_value("<{}A>".format(_ont)) == _ont + "A"
+    assert queries._tsv_term_value("\"Label\"@en") == "Label"
+    assert queries._tsv_term_value("\"2022-01-01\"^^<http://www.w3.org/2001/XMLSchema#date>") == "2022-01-01"
+    assert queries._tsv_term_value("\"say \\\"hi\\\"\"@en") == "say \"hi\""
+    assert queries._tsv_term_value("\"a\\tb\\nc\\\\d\"") == "a\tb\nc\\d"
+    assert queries._tsv_term_value("\"caf\\u00E9 \\U0001F600\"") == "caf\u00e9 \U0001f600"
+    assert queries._tsv_term_value("_:b0") == "b0"
+    assert queries._tsv_term_value("42") == "42"
+
+def test_tsv_and_csv_rows():
+    """Rows parsed from streamed tsv and csv results, unbound variables are left out"""
+    tsv = "?element\t?type\t?label\n<{0}A>\t\"concept\"\t\"A\\tB\"@en\n<{0}B>\t\"modifier\"\t\n\n".format(_ont)
+    assert list(queries._tsv_rows(_TestResponse(tsv))) == [
+        {"element": _ont + "A", "type": "concept", "label": "A\tB"},
+        {"element": _ont + "B", "type": "modifier"}
+    ]
+    csv_text = "element,type,label\r\n{0}A,concept,\"A, \"\"B\"\"\nC\"\r\n{0}B,modifier,\r\n".format(_ont)
+    assert list(queries._csv_rows(_TestResponse(csv_text))) == [
+        {"element": _ont + "A", "type": "concept", "label": "A, \"B\"\nC"},
+        {"element": _ont + "B", "type": "modifier"}
+    ]
+
+def test_batches():
+    """Batches are limited by the number of nodes and by the bytes of their URIs"""
+    node_uris = [_ont + "node{}".format(i) for i in range(10)]
+    assert [len(batch) for batch in meta._batches(node_uris, 4, 1024 * 1024)] == [4, 4, 2]
+    uri_bytes = queries.values_size(node_uris[0])
+    assert [len(batch) for batch in meta._batches(node_uris, 100, 3 * uri_bytes)] == [3, 3, 3, 1]
+    ## A single URI over the limit is still fetched
+    assert [len(batch) for batch in meta._batches(node_uris[:2], 100, 1)] == [1, 1]
+
+def test_tree_snapshot_round_trip():
+    """The snapshot is pending until kept, read back unchanged, and ignored when it's another version"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        snapshot = _test_snapshot()
+        ## More nodes than in a single pickle of the snapshot
+        for i in range(2500):
+            snapshot["attributes"][_ont + "filler{}".format(i)] = _test_element("filler{}".format(i), {"S:f{}".format(i): None})
+            snapshot["children"][_ont + "filler{}".format(i)] = {}
+        conn = {"source_id": _test_source_id, "fetch_timestamp": _test_fetch_timestamp}
+        meta._save_tree_snapshot(conn, snapshot["top_elements"], snapshot["attributes"], snapshot["children"], snapshot["dataset_version"])
+        assert meta.load_tree_snapshot(_test_source_id) is None
+        meta.keep_tree_snapshot(_test_source_id)
+        assert meta.load_tree_snapshot(_test_source_id) == snapshot
+
+        ## A failed run leaves the kept snapshot
+        meta._save_tree_snapshot(conn, {}, {}, {}, "other")
+        meta.discard_tree_snapshot(_test_source_id)
+        assert meta.load_tree_snapshot(_test_source_id) == snapshot
+
+        snapshot_file = meta._tree_snapshot_file(_test_source_id)
+        with open(snapshot_file, "r+b") as f:
+            f.seek(len(meta._SNAPSHOT_MAGIC))
+            f.write((meta._SNAPSHOT_VERSION + 1).to_bytes(2, "big"))
+        assert meta.load_tree_snapshot(_test_source_id) is None
+
+def test_tree_backends_same_rows():
+    """The columnar and sqlite backends give the same csv lines as MetaNode objects built one at a time"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        snapshot = _test_snapshot()
+        conn = {"source_id": _test_source_id, "fetch_timestamp": _test_fetch_timestamp}
+        baseline_trees = [meta._assemble_tree(conn, node_uri, node_type, snapshot["children"], snapshot["attributes"]) for node_uri, node_type in snapshot["top_elements"].items()]
+        baseline_rows = _test_rows(baseline_trees)
+        tables = set(table_name for _, table_name, _ in baseline_rows)
+        assert tables == {"table_access", "i2b2", "concept_dimension", "modifier_dimension"}
+        for tree_backend in ["objects", "columnar", "sqlite"]:
+            trees = _test_trees(snapshot, tree_backend)
+            assert _test_rows(trees) == baseline_rows, tree_backend
+            assert [tree.fingerprint for tree in trees] == [tree.fingerprint for tree in baseline_trees], tree_backend
+
+def test_write_trees_csv_reuses_fragments():
+    """Only the trees which changed are generated again, the csv files are the same either way"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        out_dir = os.path.join(dynamic_dir, _test_source_id)
+        snapshot = _test_snapshot()
+        report = {}
+        assert meta.write_trees_csv(_test_trees(snapshot), _test_source_id, out_dir, report = report)
+        assert len(report["regenerated"]) == 2 and report["unchanged"] == []
+        csv_files = sorted(file_name for file_name in os.listdir(out_dir) if file_name.endswith(".csv"))
+        assert len(csv_files) == len(model.MetaNode.table_cols)
+        written = {file_name: open(os.path.join(out_dir, file_name)).read() for file_name in csv_files}
+        assert not meta.csv_config_changed(out_dir)
+        assert meta.csv_config_changed(out_dir, ";")
+
+        report = {}
+        assert meta.write_trees_csv(_test_trees(snapshot), _test_source_id, out_dir, report = report)
+        assert report["regenerated"] == [] and len(report["unchanged"]) == 2
+        assert {file_name: open(os.path.join(out_dir, file_name)).read() for file_name in csv_files} == written
+
+        snapshot["attributes"][_ont + "F"]["prefLabel"] = "Changed label"
+        report = {}
+        trees = _test_trees(snapshot)
+        assert meta.write_trees_csv(trees, _test_source_id, out_dir, report = report)
+        assert report["regenerated"] == [trees[1].c_table_cd] and report["unchanged"] == [trees[0].c_table_cd]
+
+        ## A source without any trees has empty csv files
+        empty_dir = os.path.join(dynamic_dir, "empty-source")
+        assert meta.write_trees_csv([], "empty-source", empty_dir)
+        assert all(os.path.getsize(os.path.join(empty_dir, file_name)) == 0 for file_name in os.listdir(empty_dir) if file_name.endswith(".csv"))
+
+def test_tree_index_conflicts():
+    """Duplicate paths, and paths and notations already loaded from other sources, with the references of the lines"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        tree_index = TreeIndex.TreeIndex(_test_trees(_test_snapshot()))
+        assert len(tree_index.uris) == 11
+        assert tree_index.duplicate_paths == []
+        ## The node below both trees has a line in each
+        assert tree_index.notations["S:7"] == [_ont + "E"]
+        assert tree_index.notations["L:3-4"] == [_ont + "C"]
+        path_b = next(path for path, reference in tree_index.paths.items() if reference == _ont + "B")
+        loaded_rows = [("i2b2", path_b, "S:1", "other-source"), ("concept_dimension", "\\other\\", "S:2", "other-source"), ("i2b2", "\\other\\", "S:2", "other-source")]
+        assert tree_index.conflicts(loaded_rows) == [
+            {"conflict": "path_loaded", "table": "i2b2", "path": path_b, "reference": _ont + "B", "sourcesystem_cd": "other-source"},
+            {"conflict": "notation_loaded", "table": "concept_dimension", "notation": "S:2", "references": [_ont + "C"], "sourcesystem_cd": "other-source"}
+        ]
+
+        line = [None] * len(model.MetaNode.table_cols[("i2b2metadata", "i2b2")])
+        line[TreeIndex._col_positions["i2b2"][0]] = path_b
+        tree_index.add_line("i2b2", line, "file.csv:3")
+        tree_index.add_line("table_access", line, "file.csv:4")
+        assert tree_index.conflicts([]) == [{"conflict": "duplicate_path", "path": path_b, "reference": _ont + "B", "other_reference": "file.csv:3"}]
+
+def test_load_conflicts_from_csv():
+    """The written csv files are checked, their lines referenced by file and line number"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        out_dir = os.path.join(dynamic_dir, _test_source_id)
+        assert meta.write_trees_csv(_test_trees(_test_snapshot()), _test_source_id, out_dir)
+        csv_file_paths = sorted(os.path.join(out_dir, file_name) for file_name in os.listdir(out_dir) if file_name.endswith(".csv"))
+        db_conn = _TestDatabase([("concept_dimension", "\\other\\", "S:1", "other-source")])
+        conflicts = meta.load_conflicts(db_conn, _test_source_id, csv_file_paths)
+        assert db_conn.rolled_back and db_conn.params["source_id"] == _test_source_id
+        assert "S:1" in db_conn.params["codes"] and len(db_conn.params["paths"]) > 0
+        assert len(conflicts) == 1 and conflicts[0]["conflict"] == "notation_loaded"
+        concept_csv = "{}.i2b2demodata.concept_dimension.csv".format(_test_source_id)
+        with open(os.path.join(out_dir, concept_csv), "r", newline = "") as f:
+            line_number = next(line_number for line_number, line in enumerate(csv.reader(f), start = 1) if "S:1" in line)
+        assert conflicts[0]["references"] == ["{}:{}".format(concept_csv, line_number)]
+
+def test_namespace_resolver():
+    """The longest matching namespace is used, and a prefix of several namespaces resolves to the first one"""
+    resolver = namespaces.NamespaceResolver({
+        "http://sekmi.de/histream/dwh#": "dwh:",
+        "http://sekmi.de/histream/dwh#snomed": "S:",
+        "http://purl.bioontology.org/ontology/SNOMEDCT/": "S:"
+    })
+    assert resolver.curie("http://sekmi.de/histream/dwh#snomed123") == "S:123"
+    assert resolver.curie("http://sekmi.de/histream/dwh#loinc1") == "dwh:loinc1"
+    assert resolver.curie("http://purl.bioontology.org/ontology/SNOMEDCT/418715001") == "S:418715001"
+    assert resolver.curie("http://example.org/unmapped") == "http://example.org/unmapped"
+    assert resolver.uri("S:123") == "http://sekmi.de/histream/dwh#snomed123"
+    assert resolver.uri("X:123") == "X:123"
+    assert resolver.prefix("dwh:A") == "dwh:" and resolver.prefix("X:1") is None and resolver.prefix("plain") is None
+    ## Memoized values are dropped once there are too many, the results stay the same
+    resolver.memo_size = 2
+    assert [resolver.curie("http://sekmi.de/histream/dwh#n{}".format(i)) for i in range(5)] == ["dwh:n{}".format(i) for i in range(5)]
+    assert len(resolver._curies) <= 2
+    assert namespaces.NamespaceResolver({}).curie("http://example.org/A") == "http://example.org/A"
+
+def test_deadline():
+    """No limit without seconds, otherwise checks raise once the time is up and request timeouts are limited to the time left"""
+    unlimited = Deadline()
+    assert unlimited.remaining() is None and not unlimited.expired()
+    unlimited.check()
+    assert unlimited.timeout((5, 60)) == (5, 60)
+    deadline = Deadline(30)
+    assert 0 < deadline.remaining() <= 30
+    assert deadline.timeout((5, 60))[0] == 5 and deadline.timeout((5, 60))[1] <= 30
+    expired = Deadline(0.01)
+    time.sleep(0.02)
+    assert expired.expired() and expired.remaining() == 0.0
+    assert expired.timeout((5, 60)) == (0.001, 0.001)
+    try:
+        expired.check("Testing")
+        assert False, "DeadlineExceeded not raised"
+    except DeadlineExceeded as e:
+        assert "Testing" in str(e)
+
+def test_tree_changes():
+    """Added, removed, moved and changed nodes and the paths they affect"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        previous = _test_snapshot("1-2022-01-01")
+        current = _test_snapshot("2-2022-02-01")
+        ## B is removed, N is added, H is moved below C and D is changed
+        del current["attributes"][_ont + "B"]
+        del current["children"][_ont + "B"]
+        current["attributes"][_ont + "N"] = _test_element("N", {"S:9": None})
+        current["children"][_ont + "N"] = {}
+        current["children"][_ont + "A"] = {_ont + "C": "concept", _ont + "E": "concept", _ont + "N": "concept"}
+        current["children"][_ont + "C"] = {_ont + "D": "concept", _ont + "M": "modifier", _ont + "H": "concept"}
+        current["attributes"][_ont + "D"] = dict(current["attributes"][_ont + "D"], prefLabel = "Changed label", datatype = "integer")
+        changes = meta.tree_changes(previous, current)
+        assert changes["previous"]["dataset_version"] == "1-2022-01-01" and changes["current"]["dataset_version"] == "2-2022-02-01"
+        assert changes["nodes"]["added"] == [_ont + "N"]
+        assert changes["nodes"]["removed"] == [_ont + "B"]
+        assert changes["nodes"]["moved"] == [{"node_uri": _ont + "H", "previous_parents": [_ont + "A"], "parents": [_ont + "C"]}]
+        assert changes["nodes"]["changed"] == [{"node_uri": _ont + "D", "attributes": ["datatype", "prefLabel"]}]
+        previous_index = TreeIndex.TreeIndex(_test_trees(previous))
+        current_index = TreeIndex.TreeIndex(_test_trees(current))
+        assert changes["paths"]["removed"] == sorted(path for path, reference in previous_index.paths.items() if reference in [_ont + "B", _ont + "H"])
+        assert changes["paths"]["added"] == sorted(path for path, reference in current_index.paths.items() if reference in [_ont + "N", _ont + "H"])
+        assert changes["paths"]["changed"] == sorted(path for path, reference in current_index.paths.items() if reference == _ont + "D")
+        assert meta.tree_changes(previous, previous)["nodes"] == {"added": [], "removed": [], "moved": [], "changed": []}
+
+def test_fetched_node_data_missing_node():
+    """A node missing from a snapshot (or RDF dump) can't be fetched alone, the trees aren't built without it"""
+    with tempfile.TemporaryDirectory() as dynamic_dir, _test_app(dynamic_dir).app_context():
+        snapshot = _test_snapshot()
+        del snapshot["attributes"][_ont + "F"]
+        try:
+            _test_trees(snapshot)
+            assert False, "ValueError not raised"
+        except ValueError as e:
+            assert _ont + "F" in str(e)
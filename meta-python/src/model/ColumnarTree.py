@@ -0,0 +1,451 @@
+""" ColumnarTree.py
+Column based store for the metadata trees of a source, an alternative to linked MetaNode objects for very large ontologies
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+from array import array
+import base64
+import hashlib
+import sys
+
+from . import MetaNode
+from .MetaNode import NodeType, RowView
+
+## Codes of the node types in the node_type column
+_TYPE_CODES = {NodeType.CONCEPT: 1, NodeType.MODIFIER: 2, NodeType.COLLECTION: 3}
+_CONCEPT = _TYPE_CODES[NodeType.CONCEPT]
+_MODIFIER = _TYPE_CODES[NodeType.MODIFIER]
+_COLLECTION = _TYPE_CODES[NodeType.COLLECTION]
+_TYPE_NAMES = {code: node_type._name_.lower() for node_type, code in _TYPE_CODES.items()}
+
+def _hash8(path:str) -> str:
+    """Short hash of a path, the same as MetaNode.concept_long_hash8"""
+    return base64.urlsafe_b64encode(hashlib.sha1(path.encode()).digest()[:8]).decode('ascii')[:8]
+
+def _clean_path(path:str) -> str:
+    """Remove duplicate separators, the same as the MetaNode paths"""
+    return path.replace("\\\\", "\\").replace("//", "/")
+
+def _label(labels:dict, choose, *args) -> str:
+    """The label chosen from the tagged labels by choose (see MetaNode.pref_label) - without any work for the usual single English label"""
+    if labels and len(labels) == 1:
+        (label, tag), = labels.items()
+        if label is None:
+            return ""
+        if tag == "en":
+            return label
+    return choose(MetaNode._compact_tagged(labels), *args)
+
+def _node_paths(name:str, type_code:int, parent_type:int, parent_path:str, parent_hlevel:int, parent_applied_path:str, depth:int, sep:str, ipp:str) -> tuple:
+    """element_path, c_hlevel and applied_path of a node (see MetaNode), from the same of its parent (parent_type None for a top node)"""
+    if parent_type is None:
+        element_path = _clean_path("{sep}{ipp}{sep}{np}{sep}".format(ipp = ipp, np = name, sep = sep))
+    elif type_code == _MODIFIER and parent_type != _MODIFIER:
+        ## "Parent" modifier
+        element_path = _clean_path("{sep}{np}{sep}".format(np = name, sep = sep))
+    else:
+        element_path = _clean_path("{pnp}{sep}{np}{sep}".format(pnp = parent_path, np = name, sep = sep))
+    if type_code == _MODIFIER and parent_type is not None:
+        c_hlevel = 1 if parent_type == _CONCEPT else parent_hlevel + 1
+    else:
+        c_hlevel = depth + 2
+    if type_code != _MODIFIER:
+        applied_path = "@"
+    elif parent_type == _MODIFIER:
+        applied_path = parent_applied_path
+    elif parent_type is not None:
+        applied_path = _clean_path("{parent_path}{sep}%".format(parent_path = parent_path, sep = sep))
+    else:
+        applied_path = None
+    return element_path, c_hlevel, applied_path
+
+def _visual_attribute(top_node:bool, type_code:int, child_count:int, notation_count:int, hidden:int) -> str:
+    """See MetaNode.visual_attribute"""
+    if top_node:
+        return "FA"
+    if type_code == _COLLECTION:
+        va_part1 = "C"
+    elif child_count > 0:
+        va_part1 = "D" if type_code == _MODIFIER else "F"
+    elif type_code == _MODIFIER and notation_count <= 1:
+        va_part1 = "R"
+    else:
+        va_part1 = "L"
+    return va_part1 + ("H" if hidden else "A")
+
+class ColumnarTree(object):
+    """All nodes of a source's trees as columns (arrays and lists indexed by the node number) instead of a MetaNode object per node
+
+    Nodes are added parent first (see meta._build_tree), each tree's nodes are then contiguous, in the same order as MetaNode.iter_tree_nodes
+    The paths, levels, visual attributes and hashes are calculated for all nodes at once, level by level (see finish)
+    The csv lines are the same as those of the equivalent MetaNode trees
+    """
+
+    def __init__(self, fetch_timestamp:str = None) -> None:
+        self.fetch_timestamp = fetch_timestamp if fetch_timestamp is not None else MetaNode.current_fetch_timestamp()
+        ## Structure
+        self.parent = array("l")
+        self.depth = array("l")
+        self.node_type = array("b")
+        self.child_count = array("l")
+        ## Node number of each tree's top node
+        self.top_nodes = []
+        ## Values of each node (strings shared where they repeat)
+        self.node_uri = []
+        self.name = []
+        self.pref_label = []
+        self.display_label = []
+        self.description = []
+        self.datatype_xml = []
+        ## datatype_xml without the fetch time (for the fingerprints)
+        self.value_metadata = []
+        self.hidden = array("b")
+        self.sourcesystem_cd = []
+        ## The notations of node i are notation_values[notation_offset[i]:notation_offset[i + 1]]
+        self.notation_offset = array("l", [0])
+        self.notation_values = []
+        ## Calculated by finish
+        self.element_path = None
+        self.c_hlevel = None
+        self.applied_path = None
+        self.visual_attribute = None
+        self.concept_long_hash8 = None
+        ## datatype_xml is the same for every node with the same datatype and units
+        self._datatype_xml_cache = {}
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def add_node(self, node_uri:str, name:str, node_type:str, parent_index:int, pref_labels:dict, display_labels:dict, notations:dict, descriptions:dict, datatype:str = None, dwh_display_status:str = None, units:dict = None, sourcesystem_cd:str = "UNKNOWN") -> int:
+        """Add a node under the parent (None for a top node) with the same data as a new MetaNode, return its number"""
+        index = len(self.parent)
+        if parent_index is None:
+            self.top_nodes.append(index)
+            self.parent.append(-1)
+            self.depth.append(0)
+        else:
+            self.parent.append(parent_index)
+            self.depth.append(self.depth[parent_index] + 1)
+            self.child_count[parent_index] += 1
+        type_code, name, pref_label, display_label, description, node_datatype_xml, node_value_metadata, hidden, sourcesystem_cd = self._node_values(
+            name, node_type, self.node_type[parent_index] if parent_index is not None else None, pref_labels, display_labels, descriptions, datatype, dwh_display_status, units, sourcesystem_cd)
+        self.node_type.append(type_code)
+        self.child_count.append(0)
+        self.node_uri.append(node_uri)
+        self.name.append(name)
+        self.pref_label.append(pref_label)
+        self.display_label.append(display_label)
+        self.description.append(description)
+        self.datatype_xml.append(node_datatype_xml)
+        self.value_metadata.append(node_value_metadata)
+        self.hidden.append(hidden)
+        self.sourcesystem_cd.append(sourcesystem_cd)
+        if notations:
+            self.notation_values.extend(notations.keys())
+        self.notation_offset.append(len(self.notation_values))
+        return index
+
+    def _node_values(self, name:str, node_type:str, parent_type:int, pref_labels:dict, display_labels:dict, descriptions:dict, datatype:str, dwh_display_status:str, units:dict, sourcesystem_cd:str) -> tuple:
+        """The values kept for a node (see add_node): type code, name, pref_label, display_label, description, datatype_xml, value_metadata, hidden, sourcesystem_cd
+
+        :param parent_type: Type code of the parent node, None for a top node
+        """
+        ## Like MetaNode.node_type, everything below a modifier is a modifier
+        if parent_type == _MODIFIER:
+            type_code = _MODIFIER
+        elif node_type is None or node_type.lower() not in ["concept", "modifier", "collection"]:
+            logger.error("Node ({}) must have a type! {}".format(name, node_type))
+            type_code = 0
+        else:
+            type_code = _TYPE_CODES[NodeType[node_type.upper()]]
+        node_datatype_xml, node_value_metadata = self._datatype_xml(datatype, units, name)
+        return (
+            type_code,
+            sys.intern(name) if type(name) is str else name,
+            _label(pref_labels, MetaNode.choose_pref_label),
+            _label(display_labels, MetaNode.choose_display_label, name),
+            next(iter(descriptions)) if descriptions and any(k is not None for k in descriptions) else None,
+            node_datatype_xml,
+            node_value_metadata,
+            1 if dwh_display_status and dwh_display_status.lower() == "i2b2hidden" else 0,
+            sys.intern(sourcesystem_cd) if sourcesystem_cd else sourcesystem_cd
+        )
+
+    def _datatype_xml(self, datatype:str, units:dict, name:str) -> tuple:
+        """The node's c_metadataxml (see MetaNode.datatype_xml), with and without the fetch time
+
+        Only worked out once for each datatype and units (an invalid datatype is only logged for the first node)
+        """
+        key = (datatype, tuple(units.keys()) if units else None)
+        if key not in self._datatype_xml_cache:
+            parsed_datatype = MetaNode.parse_datatype(datatype, name)
+            self._datatype_xml_cache[key] = (MetaNode.datatype_xml(parsed_datatype, units, self.fetch_timestamp), MetaNode.datatype_xml(parsed_datatype, units, ""))
+        return self._datatype_xml_cache[key]
+
+    def notations(self, index:int) -> list:
+        """The notations of a node"""
+        return self.notation_values[self.notation_offset[index]:self.notation_offset[index + 1]]
+
+    def tree_end(self, top_index:int) -> int:
+        """Number after the last node of the tree starting at top_index"""
+        position = self.top_nodes.index(top_index)
+        if position + 1 < len(self.top_nodes):
+            return self.top_nodes[position + 1]
+        return len(self.parent)
+
+    def levels(self) -> list:
+        """Node numbers of each level, top nodes first"""
+        levels = []
+        for index, depth in enumerate(self.depth):
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(index)
+        return levels
+
+    def finish(self) -> None:
+        """Calculate the derived columns for all nodes, level by level (each level only needs the one above it)"""
+        sep = app.config["i2b2_path_separator"]
+        ipp = app.config["i2b2_path_prefix"]
+        node_count = len(self.parent)
+        element_path = [None] * node_count
+        c_hlevel = array("l", [0]) * node_count
+        applied_path = [None] * node_count
+        parent = self.parent
+        node_type = self.node_type
+        name = self.name
+        for level in self.levels():
+            for i in level:
+                p = parent[i]
+                if p < 0:
+                    element_path[i], c_hlevel[i], applied_path[i] = _node_paths(name[i], node_type[i], None, None, None, None, self.depth[i], sep, ipp)
+                else:
+                    element_path[i], c_hlevel[i], applied_path[i] = _node_paths(name[i], node_type[i], node_type[p], element_path[p], c_hlevel[p], applied_path[p], self.depth[i], sep, ipp)
+        self.element_path = element_path
+        self.c_hlevel = c_hlevel
+        self.applied_path = applied_path
+        self.concept_long_hash8 = [_hash8(path) for path in element_path]
+        self.visual_attribute = [self._visual_attribute(i) for i in range(node_count)]
+
+    def _visual_attribute(self, i:int) -> str:
+        return _visual_attribute(self.parent[i] < 0, self.node_type[i], self.child_count[i], self.notation_offset[i + 1] - self.notation_offset[i], self.hidden[i])
+
+    def fingerprint_values(self, i:int) -> list:
+        """Everything the node's own csv lines are made from, the same as MetaNode.fingerprint_values"""
+        return [
+            self.node_uri[i], self.name[i], _TYPE_NAMES.get(self.node_type[i]), self.pref_label[i], self.display_label[i], self.description[i],
+            self.value_metadata[i], bool(self.hidden[i]), self.sourcesystem_cd[i], self.notations(i)
+        ]
+
+    def fingerprint(self, index:int) -> str:
+        """Fingerprint of a node and everything below it, the same as MetaNode.fingerprint"""
+        ## The nodes below are the ones after it, until the depth is back to its own
+        end = index + 1
+        while end < len(self.parent) and self.depth[end] > self.depth[index]:
+            end += 1
+        child_fingerprints = {}
+        for i in range(end - 1, index - 1, -1):
+            fingerprint = MetaNode.node_fingerprint(self.fingerprint_values(i), child_fingerprints.pop(i, [])[::-1])
+            child_fingerprints.setdefault(self.parent[i], []).append(fingerprint)
+        return fingerprint
+
+    def tree(self, top_index:int) -> "ColumnarTreeNode":
+        """The tree starting at a top node, used like its top MetaNode"""
+        return ColumnarTreeNode(self, top_index)
+
+    def iter_rows(self, start:int, end:int):
+        """Generator of the csv lines of the nodes start to end (excluding), see MetaNode.iter_tree_rows"""
+        i2b2_cols = MetaNode.table_cols[("i2b2metadata", "i2b2")]
+        ta_cols = MetaNode.table_cols[("i2b2metadata", "table_access")]
+        impc = app.config["i2b2_multipath_container"]
+        csv_row = MetaNode.MetaNode._csv_row
+        for i in range(start, end):
+            d = RowView(_NodeRow(self, i))
+            notations = self.notations(i)
+            notation_rows = []
+            if len(notations) >= 2:
+                notation_rows = [RowView(_NotationRow(self, i, notation, notation_index)) for notation_index, notation in enumerate(notations)]
+                ## Like MetaNode.notations, the hidden multi container comes first and is only needed when there are child nodes (a notation with its name takes its place)
+                if self.child_count[i] > 0:
+                    if impc in notations:
+                        notation_rows.insert(0, notation_rows.pop(notations.index(impc)))
+                    else:
+                        notation_rows.insert(0, RowView(_NotationRow(self, i, None, None)))
+            yield ("i2b2metadata", "i2b2", csv_row(ordered_cols = i2b2_cols, d = d, table_name = "i2b2", schema_name = "i2b2metadata"))
+            for notation_d in notation_rows:
+                yield ("i2b2metadata", "i2b2", csv_row(ordered_cols = i2b2_cols, d = notation_d, table_name = "i2b2", schema_name = "i2b2metadata"))
+            if self.parent[i] < 0:
+                d["c_hlevel"] = 1
+                yield ("i2b2metadata", "table_access", csv_row(ordered_cols = ta_cols, d = d, table_name = "table_access", schema_name = "i2b2metadata"))
+            if len(notations) == 0:
+                continue
+            if self.node_type[i] == _CONCEPT:
+                data_table = "concept_dimension"
+            elif self.node_type[i] == _MODIFIER:
+                data_table = "modifier_dimension"
+            else:
+                logger.error("This node ({}) should be a concept or modifier, its niether! {}".format(self.node_uri[i], self.node_type[i]))
+                continue
+            data_cols = MetaNode.table_cols[("i2b2demodata", data_table)]
+            if len(notations) == 1:
+                yield ("i2b2demodata", data_table, csv_row(ordered_cols = data_cols, d = d, table_name = data_table, schema_name = "i2b2demodata"))
+            else:
+                for notation_d in notation_rows:
+                    if notation_d.get("notation") != "":
+                        yield ("i2b2demodata", data_table, csv_row(ordered_cols = data_cols, d = notation_d, table_name = data_table, schema_name = "i2b2demodata"))
+
+class ColumnarTreeNode(object):
+    """A tree of a ColumnarTree, with the methods of its top MetaNode which are used for the whole tree"""
+    __slots__ = ("store", "index")
+
+    def __init__(self, store:ColumnarTree, index:int) -> None:
+        self.store = store
+        self.index = index
+
+    @property
+    def name(self) -> str:
+        return self.store.name[self.index]
+    @property
+    def node_uri(self) -> str:
+        return self.store.node_uri[self.index]
+    @property
+    def c_table_cd(self) -> str:
+        return _NodeRow(self.store, self.index).c_table_cd
+    @property
+    def fingerprint(self) -> str:
+        """Fingerprint of the whole tree, see MetaNode.fingerprint"""
+        return self.store.fingerprint(self.index)
+
+    def iter_tree_nodes(self):
+        """Generator of this node and every node below it, each parent before its children, see MetaNode.iter_tree_nodes
+
+        NOTE: Only the methods of the node itself (eg node_uri, iter_node_rows) can be used for the nodes below the top node
+        """
+        for i in range(self.index, self.store.tree_end(self.index)):
+            yield ColumnarTreeNode(self.store, i)
+
+    def iter_tree_rows(self):
+        """Generator of the csv lines of the whole tree as (schema, table, line) tuples, see MetaNode.iter_tree_rows"""
+        return self.store.iter_rows(self.index, self.store.tree_end(self.index))
+
+    def iter_node_rows(self):
+        """Generator of the csv lines of only this node, see MetaNode.iter_node_rows"""
+        return self.store.iter_rows(self.index, self.index + 1)
+
+    def whole_tree_csv(self, lines:dict = None) -> dict:
+        """dict with 4 lists for each table, see MetaNode.whole_tree_csv"""
+        if lines is None:
+            lines = {"i2b2metadata":{"table_access": [], "i2b2": []},"i2b2demodata":{"concept_dimension": [], "modifier_dimension": []}}
+        for schema_name, table_name, line in self.iter_tree_rows():
+            lines[schema_name][table_name].append(line)
+        return lines
+
+class _NodeRow(object):
+    """The properties of a node for its csv lines (see MetaNode.RowView), from the columns"""
+    __slots__ = ("store", "i")
+    ## As MetaNode.row_attributes, without the dicts of descriptions and notations which aren't kept
+    row_attributes = frozenset([
+        "c_table_cd", "c_hlevel", "concept_long", "concept_long_hash8", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname",
+        "description", "applied_path", "fetch_timestamp", "notation", "sourcesystem_cd", "display_label"
+    ])
+
+    def __init__(self, store:ColumnarTree, i:int) -> None:
+        self.store = store
+        self.i = i
+
+    def _row_value(self, key:str):
+        return getattr(self, key)
+
+    @property
+    def c_table_cd(self) -> str:
+        return "i2b2_{}".format(self.store.concept_long_hash8[self.i]) if self.store.parent[self.i] < 0 else None
+    @property
+    def c_hlevel(self) -> int:
+        return self.store.c_hlevel[self.i]
+    @property
+    def concept_long(self) -> str:
+        return self.store.element_path[self.i]
+    @property
+    def concept_long_hash8(self) -> str:
+        return self.store.concept_long_hash8[self.i]
+    @property
+    def pref_label(self) -> str:
+        return self.store.pref_label[self.i]
+    @property
+    def display_label(self) -> str:
+        return self.store.display_label[self.i]
+    @property
+    def visual_attribute(self) -> str:
+        return self.store.visual_attribute[self.i]
+    @property
+    def datatype_xml(self) -> str:
+        return self.store.datatype_xml[self.i]
+    @property
+    def c_facttablecolumn(self) -> str:
+        return "modifier_cd" if self.store.node_type[self.i] == _MODIFIER else "concept_cd"
+    @property
+    def c_tablename(self) -> str:
+        return "modifier_dimension" if self.store.node_type[self.i] == _MODIFIER else "concept_dimension"
+    @property
+    def c_columnname(self) -> str:
+        return "modifier_path" if self.store.node_type[self.i] == _MODIFIER else "concept_path"
+    @property
+    def description(self) -> str:
+        return self.store.description[self.i]
+    @property
+    def applied_path(self) -> str:
+        return self.store.applied_path[self.i]
+    @property
+    def fetch_timestamp(self) -> str:
+        return self.store.fetch_timestamp
+    @property
+    def notation(self) -> str:
+        """Only a real notation if there is only 1"""
+        notations = self.store.notations(self.i)
+        return notations[0] if len(notations) == 1 else ""
+    @property
+    def sourcesystem_cd(self) -> str:
+        return self.store.sourcesystem_cd[self.i]
+
+class _NotationRow(_NodeRow):
+    """The properties of one of a node's multiple notations (see MetaNode.NotationNode), the rest are the node's own - except sourcesystem_cd and c_table_cd"""
+    __slots__ = ("_notation", "index")
+    row_attributes = frozenset([
+        "c_hlevel", "concept_long", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description",
+        "applied_path", "fetch_timestamp", "concept_long_hash8", "notation", "display_label"])
+
+    def __init__(self, store:ColumnarTree, i:int, notation:str, index:int) -> None:
+        super().__init__(store, i)
+        self._notation = notation
+        self.index = index
+
+    @property
+    def notation(self) -> str:
+        return "" if self._notation is None else self._notation
+    @property
+    def visual_attribute(self) -> str:
+        return "MH" if self.notation == "" else "LH"
+    @property
+    def concept_long(self) -> str:
+        sep = app.config["i2b2_path_separator"]
+        impc = app.config["i2b2_multipath_container"]
+        pnp = self.store.element_path[self.i]
+        if self.notation == "":
+            notation_path = r"{pnp}{impc}{sep}".format(pnp = pnp, impc = impc, sep = sep)
+        elif self.store.child_count[self.i] == 0:
+            notation_path = r"{pnp}{sep}{ni}{sep}".format(pnp = pnp, sep = sep, ni = self.index)
+        else:
+            notation_path = r"{pnp}{impc}{sep}{ni}{sep}".format(pnp = pnp, sep = sep, impc = impc, ni = self.index)
+        return _clean_path(notation_path)
+    @property
+    def concept_long_hash8(self) -> str:
+        return _hash8(self.concept_long)
+    @property
+    def c_hlevel(self) -> int:
+        if self.notation == "" or self.store.child_count[self.i] == 0:
+            return self.store.c_hlevel[self.i] + 1
+        return self.store.c_hlevel[self.i] + 2
+
+##End
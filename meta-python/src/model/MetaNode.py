@@ -8,6 +8,10 @@ logger = logging.getLogger(__name__)
 
 import datetime
 from enum import Enum
+import functools
+import hashlib
+import json
+import sys
 
 class NodeType(Enum):
     """Possible types of node"""
@@ -28,6 +32,172 @@ class NodeStatus(Enum):
     """Possible status of node"""
     DRAFT = 1
 
+def current_fetch_timestamp() -> str:
+    """Timestamp for the nodes fetched now - create it once per fetch and share it between all of its nodes"""
+    ## TODO: take time format from config
+    return sys.intern(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.0"))
+
+def _compact_tagged(tagged:dict) -> dict:
+    """Copy of a tagged attribute dict without the "None" key and with interned tags (they're mostly the same few languages)
+    None if nothing is left, the properties treat that the same as an empty dict
+    """
+    if not tagged:
+        return None
+    if len(tagged) == 1:
+        ## Usually a single (English) label
+        (k, v), = tagged.items()
+        return None if k is None else {k: (sys.intern(v) if type(v) is str else v)}
+    compact = {k: (sys.intern(v) if type(v) is str else v) for k, v in tagged.items() if k is not None}
+    if len(compact) == 0:
+        return None
+    return compact
+
+def choose_pref_label(pref_labels:dict) -> str:
+    """ Get English pref_label (or German if no English) """
+    # logger.debug("Searching for the right display label from dict: {}".format(pref_labels))
+    if not pref_labels or len(pref_labels) == 0:
+        single_label = ""
+    elif "en" in pref_labels.values():
+        keys_with_en = [k for k, v in pref_labels.items() if v == "en"]
+        if len(keys_with_en) == 1:
+            single_label = keys_with_en[0]
+        else:
+            logger.warn("More than 1 @en pref labels! '{}'".format(pref_labels))
+            single_label = keys_with_en[0]
+    else:
+        single_label = pref_labels.keys()[0]
+    # logger.debug("Decided on pref_label: {}".format(single_label))
+    return single_label
+
+def choose_display_label(display_labels:dict, name:str = None) -> str:
+    """ Get English display_label (or German if no English) """
+    ## TODO: The preferred language should be configurable - so might not be English
+    logger.debug("Searching for the right display label for '{}' from dict: {}".format(name, display_labels))
+    if not display_labels or len(display_labels) == 0:
+        # logger.debug("Empty display label")
+        single_label = ""
+    elif len(display_labels) == 1:
+        ## When there is no choice, no need to do more complex processing
+        single_label = list(display_labels.keys())[0]
+    elif "en" in display_labels.values():
+        keys_with_en = [k for k, v in display_labels.items() if v == "en"]
+        # if operator.countOf(display_labels.values(), "en") == 1:
+        logger.debug("en keys: {}".format(keys_with_en))
+        single_label = keys_with_en[0]
+        if len(keys_with_en) > 1:
+            single_label = keys_with_en[0]
+            # single_label = keys_with_en[-1]
+            logger.warn("More than 1 @en display_label ({}) for {}! Chosen: '{}'".format(display_labels, name, single_label))
+    else:
+        # logger.debug("First display label  in dict")
+        single_label = display_labels.keys()[0]
+    # logger.debug("Decided on display_label: {}".format(single_label))
+    return single_label
+
+## TODO: Dict should be in config - ensure still uses the NodeDatatype correctly
+datatype_names:dict = {NodeDatatype.INTEGER: ["int", "integer"], NodeDatatype.FLOAT: ["float", "dec", "decimal"], NodeDatatype.STRING: ["string", "str"], NodeDatatype.LARGESTRING: ["largestring"], NodeDatatype.PARTIAL_DATE: ["partial date", "partialDate", "partialDateRestriction"], NodeDatatype.DATE: ["dateRestriction", "date"]}
+## Reverse of datatype_names (lower case) so we can easily lookup the notations we expect to receive
+_datatype_lookup:dict = {v.lower(): k for k, l in datatype_names.items() for v in l}
+## With correct case for i2b2
+_datatype_pretty:dict = {NodeDatatype.INTEGER: "Integer", NodeDatatype.FLOAT: "Float",NodeDatatype.STRING: "String", NodeDatatype.LARGESTRING: "largeString", NodeDatatype.PARTIAL_DATE: "String", NodeDatatype.DATE: "String"}
+## Node types by their (lower case) name
+_node_type_lookup:dict = {node_type._name_.lower(): node_type for node_type in NodeType}
+
+def parse_datatype(dtype:str, name:str = None) -> NodeDatatype:
+    """Convert incoming string based indication to enum, None when it isn't valid"""
+    datatype = _datatype_lookup.get(dtype.lower()) if dtype else None
+    if datatype is None:
+        logger.warn("Trying to set node '{}' with an invalid datatype: {}".format(name, dtype))
+    return datatype
+
+def datatype_pretty(datatype:NodeDatatype) -> str:
+    """ String version of datatype. With correct case for i2b2 """
+    pretty_dt = ""
+    if datatype is not None:
+        pretty_dt = _datatype_pretty[datatype]
+    return pretty_dt
+
+def datatype_xml(datatype:NodeDatatype, units:dict, fetch_timestamp:str) -> str:
+    """ XML string for datatype """
+    xml_dt = "NULL"
+    if datatype is not None:
+        xml_dt = "<ValueMetadata><Version>3.02</Version><CreationDateTime>{fetch_timestamp}</CreationDateTime><DataType>{datatype_pretty}</DataType><Oktousevalues>Y</Oktousevalues>{units_xml}</ValueMetadata>".format(
+            fetch_timestamp = fetch_timestamp,
+            datatype_pretty = datatype_pretty(datatype),
+            units_xml = units_xml(datatype, units)
+            )
+        ## Only a few combinations of datatype and units, so many nodes share the same string
+        xml_dt = sys.intern(xml_dt)
+    return xml_dt
+
+def units_xml(datatype:NodeDatatype, units:dict) -> str:
+    """XML section of ValueMetaData for unit"""
+    xml_units = ""
+    if units is not None and len(units) > 0:
+        if datatype in [NodeDatatype.INTEGER, NodeDatatype.FLOAT]:
+            first_item = True
+            xml_units = "<UnitValues>"
+            for unit_name in units.keys():
+                if first_item == True:
+                    xml_units += "<NormalUnits>{}</NormalUnits>".format(unit_name)
+                    first_item = False
+                else:
+                    xml_units += "<EqualUnits>{}</EqualUnits>".format(unit_name)
+            xml_units += "</UnitValues>"
+    return xml_units
+
+def node_fingerprint(own_values:list, child_fingerprints:list) -> str:
+    """Fingerprint of a node's own content and the fingerprints of its children (in order) - so it changes with anything in the subtree (Merkle tree)"""
+    return hashlib.sha1(json.dumps([own_values, child_fingerprints]).encode()).hexdigest()
+
+## Columns of each (schema, table) written for the nodes, in order
+table_cols:dict = {
+    ("i2b2metadata", "i2b2"): ["c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_tablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "m_applied_path", "update_date", "download_date", "import_date", "sourcesystem_cd", "valuetype_cd", "m_exclusion_cd", "c_path", "c_symbol"],
+    ("i2b2metadata", "table_access"): ["c_table_cd", "c_table_name", "c_protected_access", "c_ontology_protection", "c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_dimtablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "c_entry_date", "c_change_date", "c_status_cd", "valuetype_cd"],
+    ("i2b2demodata", "concept_dimension"): ["concept_path", "concept_cd", "name_char", "concept_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"],
+    ("i2b2demodata", "modifier_dimension"): ["modifier_path", "modifier_cd", "name_char", "modifier_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"]
+}
+## Compiled row plans (see MetaNode._row_plan), per (schema, table, columns) - the column config doesn't change while running
+_row_plans:dict = {}
+## How each column's value is found in a row plan
+_FIXED_VALUE = 1
+_PROPERTY = 2
+_FIRST_PROPERTY = 3
+
+def memoized_property(method):
+    """A property which is only calculated on first access, then kept in the instance's _cache
+    The cache must be cleared whenever something the value is derived from changes (see MetaNode._invalidate)
+    """
+    cache_key = method.__name__
+    @functools.wraps(method)
+    def getter(self):
+        if cache_key not in self._cache:
+            self._cache[cache_key] = method(self)
+        return self._cache[cache_key]
+    return property(getter)
+
+class RowView(object):
+    """The properties of a node as used for its csv lines (see MetaNode._csv_row), in place of the node's __dict__
+    A property is only evaluated when the table's row plan reads it, and then only once for this view
+    """
+    __slots__ = ("node", "_values")
+
+    def __init__(self, node) -> None:
+        self.node = node
+        self._values = {}
+
+    def get(self, key:str, default = None):
+        """Like dict.get - the default is only used for names which aren't in the node's row_attributes"""
+        if key in self._values:
+            return self._values[key]
+        if key not in self.node.row_attributes:
+            return default
+        value = self._values[key] = self.node._row_value(key)
+        return value
+
+    def __setitem__(self, key:str, value) -> None:
+        """Override a value for the following lines"""
+        self._values[key] = value
 
 class MetaNode(object):
     """All CoMetaR nodes. Those with a notation will be extended by ConceptNode or ModifierNode
@@ -36,34 +206,42 @@ class MetaNode(object):
     skos:prefLabel "Gesundheitsfragebogen: EQ-5D VAS"@de ;
     skos:prefLabel "Health questionnaire EQ-5D VAS"@en ;
     pref_labels = {"Gesundheitsfragebogen: EQ-5D VAS": "de", "Health questionnaire EQ-5D VAS": "en"}
+
+    NOTE: Slotted (no instance __dict__) to keep very large trees compact in memory, every slot is set in __init__
     """
+    __slots__ = (
+        "_parent_node", "_child_nodes", "_name", "_cache", "node_uri", "_pref_labels", "_display_labels", "descriptions", "_notations", "alt_labels",
+        "dwh_display_status", "fetch_timestamp", "_node_type", "status", "_datatype", "units", "sourcesystem_cd"
+    )
 
-    parent_node = None
-    child_nodes:list = None
+    _parent_node:object
+    ## Insertion ordered and deduplicated (only the keys are used)
+    _child_nodes:dict
+    _name:str
+    ## Memoized derived values (see memoized_property)
+    _cache:dict
 
     ## Used as title  (k is title, v is tag)
-    pref_labels:dict[str:str] = None
+    _pref_labels:dict[str:str]
     ## Used in sidebar/tree  (k is label, v is tag)
-    _display_labels:dict[str:str] = None
+    _display_labels:dict[str:str]
     ## Main body text for node  (k is text, v is tag)
-    descriptions:dict[str:str] = None
+    descriptions:dict[str:str]
     ## Codes (k is notation, v is tag)
-    _notations:dict[str:str] = None
+    _notations:dict[str:str]
     ## Optionnaly displayed in CoMetaR top right  (k is label, v is tag)
-    alt_labels:dict[str:str] = None
+    alt_labels:dict[str:str]
 
     ## i2b2hidden
-    dwh_display_status:str = None
-    ## Where a modifier is applicable
-    _applied_path:str = None
-    ## When the object is created
-    fetch_timestamp:str = None
-    _node_type:NodeType = None
-    status:NodeStatus = None
-    _datatype:NodeDatatype = None
+    dwh_display_status:str
+    ## When the object is created (shared by all nodes of the same fetch)
+    fetch_timestamp:str
+    _node_type:NodeType
+    status:NodeStatus
+    _datatype:NodeDatatype
     ## Can be multiple units listed in CoMetaR - can (optionally) be tagged eg as UCUM, SI, etc
     ## TODO: Possibly use a Unit class?
-    units:dict[str:str] = None
+    units:dict[str:str]
 
     @property
     def top_level_node(self) -> bool:
@@ -74,7 +252,7 @@ class MetaNode(object):
             return True
         else:
             return False
-    @property
+    @memoized_property
     def ancestor_count(self) -> int:
         """ Dynamically calculated
         Dependant on parent (eventually) not existing"""
@@ -126,7 +304,7 @@ class MetaNode(object):
         if self.top_level_node:
             return "FA"
         return va_part1 + va_part2
-    @property
+    @memoized_property
     def element_path(self) -> str:
         """Dynamically calculated"""
         sep = app.config["i2b2_path_separator"]
@@ -141,7 +319,7 @@ class MetaNode(object):
             pnp = self.parent_node.element_path
             built_path = "{pnp}{sep}{np}{sep}".format(pnp = pnp, np = np, sep = sep)
         return built_path.replace("\\\\", "\\").replace("//", "/")
-    @property
+    @memoized_property
     def c_hlevel(self) -> int:
         """Dynamically calculated"""
         if self.node_type == NodeType.MODIFIER:
@@ -161,25 +339,11 @@ class MetaNode(object):
     @property
     def pref_label(self) -> str:
         """ Get English pref_label (or German if no English) """
-        # logger.debug("Searching for the right display label from dict: {}".format(self.pref_labels))
-        if not self.pref_labels or len(self.pref_labels) == 0:
-            single_label = ""
-        elif "en" in self.pref_labels.values():
-            keys_with_en = [k for k, v in self.pref_labels.items() if v == "en"]
-            if len(keys_with_en) == 1:
-                single_label = keys_with_en[0]
-            else:
-                logger.warn("More than 1 @en pref labels! '{}'".format(self.pref_labels))
-                single_label = keys_with_en[0]
-        else:
-            single_label = self.pref_labels.keys()[0]
-        # logger.debug("Decided on pref_label: {}".format(single_label))
-        return single_label
+        return choose_pref_label(self.pref_labels)
     @pref_labels.setter
     def pref_labels(self, pref_labels):
         """Ensure no "None" key in dict"""
-        self._pref_labels = pref_labels
-        self._pref_labels.pop(None, None)
+        self._pref_labels = _compact_tagged(pref_labels)
 
     @property
     def datatype(self) -> NodeDatatype:
@@ -188,59 +352,22 @@ class MetaNode(object):
     @datatype.setter
     def datatype(self, dtype:str):
         """Convert incoming string based indication to enum"""
-        ## TODO: Dict should be in config - ensure still uses the NodeDatatype correctly
-        types = {NodeDatatype.INTEGER: ["int", "integer"], NodeDatatype.FLOAT: ["float", "dec", "decimal"], NodeDatatype.STRING: ["string", "str"], NodeDatatype.LARGESTRING: ["largestring"], NodeDatatype.PARTIAL_DATE: ["partial date", "partialDate", "partialDateRestriction"], NodeDatatype.DATE: ["dateRestriction", "date"]}
-        ## Reverse the "types" dict so we can easily lookup the notations we expect to receive
-        incoming_type_representations = {v.lower():k for k, l in types.items() for v in l}
-        # logger.debug("Reversed types dict: {}\n \
-        #     Type for node '{}': {}\
-        # ".format(
-        #     incoming_type_representations,
-        #     self.name,
-        #     dtype
-        #     ))
-        if dtype and dtype.lower() in incoming_type_representations.keys():
-            self._datatype = incoming_type_representations.get(dtype.lower(), None)
-        else:
-            logger.warn("Trying to set node '{}' with an invalid datatype: {}".format(self.name, dtype))
-            self._datatype = None
-        # logger.debug("datetype for node '{}' set to: {}".format(self.name, self._datatype))
+        self._datatype = parse_datatype(dtype, self.name)
     @property
     def datatype_pretty(self) -> str:
         """ String version of datatype. With correct case for i2b2 """
-        pretty_dt = ""
-        if self.datatype is not None:
-            dt_prettify = {NodeDatatype.INTEGER: "Integer", NodeDatatype.FLOAT: "Float",NodeDatatype.STRING: "String", NodeDatatype.LARGESTRING: "largeString", NodeDatatype.PARTIAL_DATE: "String", NodeDatatype.DATE: "String"}
-            pretty_dt = dt_prettify[self.datatype]
-        return pretty_dt
+        return datatype_pretty(self.datatype)
     @property
     def datatype_xml(self) -> str:
         """ XML string for datatype """
-        xml_dt = "NULL"
-        if self.datatype is not None:
-            xml_dt = "<ValueMetadata><Version>3.02</Version><CreationDateTime>{fetch_timestamp}</CreationDateTime><DataType>{datatype_pretty}</DataType><Oktousevalues>Y</Oktousevalues>{units_xml}</ValueMetadata>".format(
-                fetch_timestamp = self.fetch_timestamp,
-                datatype_pretty = self.datatype_pretty,
-                units_xml = self.units_xml
-                )
-        return xml_dt
+        return datatype_xml(self.datatype, self.units, self.fetch_timestamp)
 
     @property
     def units_xml(self) -> str:
         """XML section of ValueMetaData for unit"""
-        xml_units = ""
-        if self.units is not None and len(self.units) > 0:
-            if self.datatype in [NodeDatatype.INTEGER, NodeDatatype.FLOAT]:
-                first_item = True
-                xml_units = "<UnitValues>"
-                for unit_name in self.units.keys():
-                    if first_item == True:
-                        xml_units += "<NormalUnits>{}</NormalUnits>".format(unit_name)
-                        first_item = False
-                    else:
-                        xml_units += "<EqualUnits>{}</EqualUnits>".format(unit_name)
-                xml_units += "</UnitValues>"
-                logger.debug("Units for node '{}': {}".format(self.name, xml_units))
+        xml_units = units_xml(self.datatype, self.units)
+        if xml_units != "":
+            logger.debug("Units for node '{}': {}".format(self.name, xml_units))
         return xml_units
 
     @property
@@ -264,7 +391,7 @@ class MetaNode(object):
             return "modifier_path"
         else:
             return "concept_path"
-    @property
+    @memoized_property
     def applied_path(self) -> str:
         """Path where the modifier is applicable"""
         if self.node_type != NodeType.MODIFIER:
@@ -292,34 +419,12 @@ class MetaNode(object):
     @property
     def display_label(self) -> str:
         """ Get English display_label (or German if no English) """
-        ## TODO: The preferred language should be configurable - so might not be English
-        logger.debug("Searching for the right display label for '{}' from dict: {}".format(self.name, self.display_labels))
-        if not self.display_labels or len(self.display_labels) == 0:
-            # logger.debug("Empty display label")
-            single_label = ""
-        elif len(self.display_labels) == 1:
-            ## When there is no choice, no need to do more complex processing
-            single_label = list(self.display_labels.keys())[0]
-        elif "en" in self.display_labels.values():
-            keys_with_en = [k for k, v in self.display_labels.items() if v == "en"]
-            # if operator.countOf(self.display_labels.values(), "en") == 1:
-            logger.debug("en keys: {}".format(keys_with_en))
-            single_label = keys_with_en[0]
-            if len(keys_with_en) > 1:
-                single_label = keys_with_en[0]
-                # single_label = keys_with_en[-1]
-                logger.warn("More than 1 @en display_label ({}) for {}! Chosen: '{}'".format(self.display_labels, self.name, single_label))
-        else:
-            # logger.debug("First display label  in dict")
-            single_label = self.display_labels.keys()[0]
-        # logger.debug("Decided on display_label: {}".format(single_label))
-        return single_label
+        return choose_display_label(self.display_labels, self.name)
     @display_labels.setter
     def display_labels(self, display_labels: dict):
         """Simple"""
-        self._display_labels = display_labels
         ## Ensure there is not a "None" key
-        self._display_labels.pop(None, None)
+        self._display_labels = _compact_tagged(display_labels)
 
     @property
     def description(self) -> str:
@@ -334,7 +439,7 @@ class MetaNode(object):
     def concept_long(self) -> str:
         """Concept path"""
         return self.element_path
-    @property
+    @memoized_property
     def concept_long_hash8(self) -> str:
         """Concept path"""
         import base64
@@ -378,11 +483,42 @@ class MetaNode(object):
         else:
             ## Multi notations - NOTE: repeated logic must be matched in NotationNode to calculate the correct path
             new_notations = {}
-            for notation_name, notation_tag in notations.items():
+            for notation_index, (notation_name, notation_tag) in enumerate(notations.items()):
                 ## For the actual notations
-                new_notations[notation_name] = NotationNode(self, notation_name, notation_tag)
+                new_notations[notation_name] = NotationNode(self, notation_name, notation_tag, notation_index)
             self._notations = new_notations
 
+    @property
+    def parent_node(self):
+        """The node above this one, None for a top level node"""
+        return self._parent_node
+    @parent_node.setter
+    def parent_node(self, parent_node):
+        """The paths and levels of this node and all below it depend on the parent"""
+        self._parent_node = parent_node
+        self._invalidate()
+
+    @property
+    def name(self) -> str:
+        return self._name
+    @name.setter
+    def name(self, name:str):
+        """The paths of this node and all below it depend on the name"""
+        self._name = name
+        self._invalidate()
+
+    @property
+    def child_nodes(self):
+        """The children in the order they were added (a view, use add_child to add more)"""
+        if self._child_nodes is None:
+            return None
+        return self._child_nodes.keys()
+    @child_nodes.setter
+    def child_nodes(self, child_nodes:list):
+        """Only the notation paths depend on the children (whether there are any)"""
+        self._child_nodes = dict.fromkeys(child_nodes) if child_nodes is not None else None
+        self._invalidate(descendants = False)
+
     @property
     def node_type(self) -> NodeType:
         """Return raw node_type enum"""
@@ -394,6 +530,11 @@ class MetaNode(object):
     @node_type.setter
     def node_type(self, node_type:str):
         """Set node_type enum NodeType"""
+        self._set_node_type(node_type)
+        ## Levels and applied paths below a modifier depend on the type
+        self._invalidate()
+    def _set_node_type(self, node_type:str) -> None:
+        """Set the NodeType from its name (everything below a modifier is a modifier), without clearing any memoized values"""
         if self.parent_node is not None and self.parent_node.node_type is NodeType.MODIFIER:
             self._node_type = NodeType.MODIFIER
         elif node_type is None:
@@ -422,28 +563,26 @@ class MetaNode(object):
     @property
     def meta_csv(self) -> dict:
         """csv data with same format as i2b2metadata i2b2 and table_access tables"""
-        d = self.__dict__()
-        # logger.debug("computed members: {}".format(d))
-        i2b2_cols = ["c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_tablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "m_applied_path", "update_date", "download_date", "import_date", "sourcesystem_cd", "valuetype_cd", "m_exclusion_cd", "c_path", "c_symbol"]
+        d = RowView(self)
+        i2b2_cols = table_cols[("i2b2metadata", "i2b2")]
         ## meta_inserts' dict can have 2 entries, i2b2 and table_access
         lines = {"i2b2": [], "table_access": []}
         ## ontology can have multiple entries when there are multiple notations
         ## Always insert the base node
-        lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = i2b2_cols, d = d, table_name = "i2b2", schema_name = "i2b2metadata"))
+        lines["i2b2"].append(MetaNode._csv_row(ordered_cols = i2b2_cols, d = d, table_name = "i2b2", schema_name = "i2b2metadata"))
         logger.debug("self.notations for '{}': {}".format(self.name, self.notations))
         if self.notations and len(self.notations) >= 2:
             ## If multiple notations, use NotationNode objects to populate the additional csv lines
             for notation_obj in self.notations.values():
-                lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = i2b2_cols, d = notation_obj.__dict__(), table_name = "i2b2", schema_name = "i2b2metadata"))
+                lines["i2b2"].append(MetaNode._csv_row(ordered_cols = i2b2_cols, d = RowView(notation_obj), table_name = "i2b2", schema_name = "i2b2metadata"))
             simplified_lines = {}
             simplified_lines["i2b2"] = [v[0:6] for v in lines["i2b2"]]
             logger.debug("Multiple notations for '{}'...\n{}".format(self.name, simplified_lines))
 
-        ta_cols = ["c_table_cd", "c_table_name", "c_protected_access", "c_ontology_protection", "c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_dimtablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "c_entry_date", "c_change_date", "c_status_cd", "valuetype_cd"]
+        ta_cols = table_cols[("i2b2metadata", "table_access")]
         if self.top_level_node:
             d["c_hlevel"] = 1
-            logger.debug("Using self dict: {}".format(d))
-            lines["table_access"] = [MetaNode._data_to_csv(ordered_cols = ta_cols, d = d, table_name = "table_access", schema_name = "i2b2metadata")]
+            lines["table_access"] = [MetaNode._csv_row(ordered_cols = ta_cols, d = d, table_name = "table_access", schema_name = "i2b2metadata")]
         # else:
         #     lines["table_access"] = None
         return lines
@@ -453,166 +592,357 @@ class MetaNode(object):
         if not self.notations or len(self.notations) == 0:
             ## When this is just a container/folder, there is nothing to do
             return None
-        d = self.__dict__()
-        # logger.debug("computed members: {}".format(d))
+        d = RowView(self)
 
         if self.node_type == NodeType.CONCEPT:
             concept_type_table = "concept_dimension"
-            cols = ["concept_path", "concept_cd", "name_char", "concept_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"]
+            cols = table_cols[("i2b2demodata", "concept_dimension")]
         elif self.node_type == NodeType.MODIFIER:
             concept_type_table = "modifier_dimension"
-            cols = ["modifier_path", "modifier_cd", "name_char", "modifier_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"]
+            cols = table_cols[("i2b2demodata", "modifier_dimension")]
         else:
             logger.error("This node ({}) should be a concept or modifier, its niether! {}".format(self.node_uri, self.node_type))
             return None
         ## data inserts occur once for each notation, but not for the containing concept (unless its a single notation)
         lines = {"concept_dimension": [], "modifier_dimension": []}
         if len(self.notations) == 1:
-            lines[concept_type_table].append(MetaNode._data_to_csv(ordered_cols = cols, d = d, table_name = concept_type_table, schema_name = "i2b2demodata"))
+            lines[concept_type_table].append(MetaNode._csv_row(ordered_cols = cols, d = d, table_name = concept_type_table, schema_name = "i2b2demodata"))
         else:
             for notation_obj in self.notations.values():
                 if notation_obj.notation is not None and notation_obj.notation != "":
-                    lines[concept_type_table].append(MetaNode._data_to_csv(ordered_cols = cols, d = notation_obj.__dict__(), table_name = concept_type_table, schema_name = "i2b2demodata"))
+                    lines[concept_type_table].append(MetaNode._csv_row(ordered_cols = cols, d = RowView(notation_obj), table_name = concept_type_table, schema_name = "i2b2demodata"))
         return lines
 
-    def __init__(self, node_uri, name, node_type, pref_labels, display_labels, notations, descriptions, alt_labels = None, datatype = None, dwh_display_status = None, parent_node = None, units = None, sourcesystem_cd = "UNKNOWN") -> None:
-        """Initialise an instance with data"""
+    def __init__(self, node_uri, name, node_type, pref_labels, display_labels, notations, descriptions, alt_labels = None, datatype = None, dwh_display_status = None, parent_node = None, units = None, sourcesystem_cd = "UNKNOWN", fetch_timestamp:str = None) -> None:
+        """Initialise an instance with data
+
+        :param fetch_timestamp: Shared by all nodes of a fetch (see current_fetch_timestamp), a new one is made when not supplied
+        """
+        ## A new node has nothing memoized, so its values are set without the setters clearing them
+        self._cache = {}
+        self._parent_node = parent_node
+        self._child_nodes = {}
+        self._name = name
+        self._notations = None
+        self._node_type = None
+        self._datatype = None
+        self.status = None
         if parent_node is not None:
-            self.parent_node = parent_node
-            self.parent_node.add_child(self)
-            logger.debug("Node has parent ({}): {}".format(self.parent_node, self.parent_node.node_uri))
-        self.child_nodes = []
+            parent_node.add_child(self)
         self.node_uri = node_uri
-        self.name = name
-        self.node_type = node_type
+        self._set_node_type(node_type)
         self.pref_labels = pref_labels
         self.display_labels = display_labels
         self.notations = notations
-        self.descriptions = descriptions
+        ## Only the text is used, so without any text there is no need to keep the dict
+        self.descriptions = descriptions if descriptions and any(k is not None for k in descriptions) else None
         self.alt_labels = alt_labels
         self.datatype = datatype
-        self.units = units
-        self.dwh_display_status = dwh_display_status
-        self.sourcesystem_cd = sourcesystem_cd
-        ## TODO: take time format from config
-        self.fetch_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.0")
-        logger.info("New MetaNode object created! ({})".format(self.node_uri))
+        ## The same few units, display statuses and sources occur over and over
+        self.units = {sys.intern(k): v for k, v in units.items()} if units else units
+        self.dwh_display_status = sys.intern(dwh_display_status) if dwh_display_status else dwh_display_status
+        self.sourcesystem_cd = sys.intern(sourcesystem_cd) if sourcesystem_cd else sourcesystem_cd
+        self.fetch_timestamp = fetch_timestamp if fetch_timestamp is not None else current_fetch_timestamp()
+        logger.debug("New MetaNode object created! ({})".format(self.node_uri))
+
+    @classmethod
+    def from_records(cls, records:list, nodes:list = None, fetch_timestamp:str = None) -> list:
+        """Create the nodes of a batch of records at once (eg a page of query results), the same as creating each with __init__ but much faster for large trees
+
+        Each record is a dict with the arguments of __init__, except the parent node which is given by its number ("parent_index", None for a top node) in nodes
+        The new nodes are appended to nodes, so parents must come before their children (in this or an earlier batch)
+        NOTE: The nodes' paths and levels must not be read until all batches are created, they aren't cleared again when children are added
+        Nothing is logged per node, and the lookups and shared values (units, display statuses, sources) are only worked out once per batch
+
+        :param nodes: The nodes created so far, the list is extended
+        :return: nodes
+        """
+        if nodes is None:
+            nodes = []
+        if fetch_timestamp is None:
+            fetch_timestamp = current_fetch_timestamp()
+        ## Values worked out for this batch, the nodes share them
+        shared:dict = {}
+        datatypes:dict = {}
+        for record in records:
+            node = cls.__new__(cls)
+            parent_node = nodes[record["parent_index"]] if record.get("parent_index") is not None else None
+            node._cache = {}
+            node._parent_node = parent_node
+            node._child_nodes = {}
+            node._name = record["name"]
+            node._notations = None
+            node.status = None
+            node.node_uri = record["node_uri"]
+            node_type = record["node_type"]
+            if parent_node is not None and parent_node._node_type is NodeType.MODIFIER:
+                node._node_type = NodeType.MODIFIER
+            else:
+                node._node_type = _node_type_lookup.get(node_type.lower()) if node_type is not None else None
+                if node._node_type is None:
+                    logger.error("Node ({}) must have a type! {}".format(node._name, node_type))
+            node._pref_labels = _compact_tagged(record["pref_labels"])
+            node._display_labels = _compact_tagged(record["display_labels"])
+            node.notations = record["notations"]
+            descriptions = record["descriptions"]
+            node.descriptions = descriptions if descriptions and any(k is not None for k in descriptions) else None
+            node.alt_labels = record.get("alt_labels")
+            dtype = record.get("datatype")
+            if dtype not in datatypes:
+                datatypes[dtype] = parse_datatype(dtype, node._name)
+            node._datatype = datatypes[dtype]
+            units = record.get("units")
+            if units:
+                units_key = ("units", tuple(units.items()))
+                if units_key not in shared:
+                    shared[units_key] = {sys.intern(k): v for k, v in units.items()}
+                units = shared[units_key]
+            node.units = units
+            dwh_display_status = record.get("dwh_display_status")
+            node.dwh_display_status = shared.setdefault(dwh_display_status, dwh_display_status)
+            sourcesystem_cd = record.get("sourcesystem_cd", "UNKNOWN")
+            node.sourcesystem_cd = shared.setdefault(sourcesystem_cd, sourcesystem_cd)
+            node.fetch_timestamp = fetch_timestamp
+            ## Nothing is memoized while the nodes are being built, so the parent's values aren't cleared (see add_child)
+            if parent_node is not None:
+                parent_node._child_nodes[node] = None
+            nodes.append(node)
+        return nodes
 
     def add_child(self, child_node) -> None:
         """Add a child of this node to the list"""
         logger.debug("Adding child: {}".format(child_node))
-        self.child_nodes.append(child_node)
-        ## Deduplicate:
-        self.child_nodes = list(set(self.child_nodes))
+        ## Deduplicated, keeping the order
+        if child_node in self._child_nodes:
+            return
+        self._child_nodes[child_node] = None
+        if len(self._child_nodes) == 1:
+            ## Only the notation paths depend on the children, and only on whether there are any
+            self._invalidate(descendants = False)
 
-    def whole_tree_csv(self, lines:dict = None) -> dict:
-        """dict with 4 lists for each table in: i2b2metadata{table_access,i2b2}, i2b2demodata{concept_dimension,modifier_dimension}
-        
-        Recursive. Call with lines = None (or omit the parameter), its used when getting child nodes
+    def _invalidate(self, descendants:bool = True) -> None:
+        """Clear the memoized values of this node and its notations
+        With descendants, also for every node below this one as their values are derived from it
         """
-        logger.info("Adding csv lines for '{}' ({}): {}".format(self.name, self.node_type_pretty, self.node_uri))
-        # time.sleep(4)
-        if lines is None:
-            lines = {"i2b2metadata":{"table_access": [], "i2b2": []},"i2b2demodata":{"concept_dimension": [], "modifier_dimension": []}}
-        if self.top_level_node:
-            logger.debug("#### ~~~~ STARTING whole tree CSV ~~~~ ####")
-            logger.debug("Starting point for meta_csv: {}".format(lines["i2b2metadata"]))
-            logger.debug("Starting point for data_csv: {}".format(lines["i2b2demodata"]))
-            # time.sleep(2)
+        nodes = [self]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            node._cache = {}
+            if node._notations is not None:
+                for notation_obj in node._notations.values():
+                    if isinstance(notation_obj, NotationNode):
+                        notation_obj._cache = {}
+            if descendants and node._child_nodes is not None:
+                nodes.extend(node._child_nodes)
+
+    @property
+    def fingerprint_values(self) -> list:
+        """Everything the node's own csv lines are made from (see node_fingerprint), except the fetch time - unchanged content has the same fingerprint in every fetch"""
+        return [
+            self.node_uri, self.name, self.node_type_pretty, self.pref_label, self.display_label, self.description,
+            datatype_xml(self.datatype, self.units, ""),
+            bool(self.dwh_display_status and self.dwh_display_status.lower() == "i2b2hidden"),
+            self.sourcesystem_cd,
+            list(self._notations.keys()) if self._notations else []
+        ]
+    @property
+    def fingerprint(self) -> str:
+        """Fingerprint of this node and everything below it (see node_fingerprint)
+
+        Worked out bottom up for the whole subtree on each access (without recursion), the children can change at any time
+        """
+        ## Fingerprints of the children of the nodes waiting for them, in reverse order
+        child_fingerprints = {}
+        for node in reversed(list(self.iter_tree_nodes())):
+            fingerprint = node_fingerprint(node.fingerprint_values, child_fingerprints.pop(node, [])[::-1])
+            if node is self:
+                return fingerprint
+            child_fingerprints.setdefault(node.parent_node, []).append(fingerprint)
+
+    def iter_tree_nodes(self):
+        """Generator of this node and every node below it, each parent before its children (in order)
+
+        Iterative with an explicit stack, very deep trees don't reach the recursion limit
+        """
+        nodes = [self]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            yield node
+            if node._child_nodes is not None and len(node._child_nodes) > 0:
+                nodes.extend(reversed(node._child_nodes))
+
+    def iter_tree_rows(self):
+        """Generator of the csv lines of the whole tree (see iter_tree_nodes) as (schema, table, line) tuples, one line at a time
+        For writing or loading them as they're generated, without keeping all of them
+        """
+        logger.debug("#### ~~~~ STARTING whole tree CSV for '{}' ~~~~ ####".format(self.name))
+        for node in self.iter_tree_nodes():
+            yield from node.iter_node_rows()
+        logger.debug("#### ~~~~ FINISHED whole tree CSV for '{}' ~~~~ ####".format(self.name))
 
+    def iter_node_rows(self):
+        """Generator of the csv lines of only this node (and its notations) as (schema, table, line) tuples"""
+        logger.info("Adding csv lines for '{}' ({}): {}".format(self.name, self.node_type_pretty, self.node_uri))
         i2b2metadata_csv = self.meta_csv
         if i2b2metadata_csv is not None:
-            if i2b2metadata_csv.get("table_access") is not None:
-                lines["i2b2metadata"]["table_access"].extend(i2b2metadata_csv["table_access"])
-            if i2b2metadata_csv.get("i2b2") is not None:
-                lines["i2b2metadata"]["i2b2"].extend(i2b2metadata_csv["i2b2"])
-        logger.debug("Added meta_csv: {}".format(i2b2metadata_csv))
-
+            for table_name in ["i2b2", "table_access"]:
+                for line in i2b2metadata_csv.get(table_name) or []:
+                    yield ("i2b2metadata", table_name, line)
         i2b2demodata_csv = self.data_csv
         if i2b2demodata_csv is not None:
-            if i2b2demodata_csv.get("concept_dimension") is not None:
-                lines["i2b2demodata"]["concept_dimension"].extend(i2b2demodata_csv["concept_dimension"])
-            if i2b2demodata_csv.get("modifier_dimension") is not None:
-                lines["i2b2demodata"]["modifier_dimension"].extend(i2b2demodata_csv["modifier_dimension"])
-        logger.debug("Added data_csv: {}".format(i2b2demodata_csv))
-
-        if self.child_nodes is not None and len(self.child_nodes) > 0:
-            logger.debug("Getting CSV for children: {}".format(self.child_nodes))
-            for child in self.child_nodes:
-                lines = child.whole_tree_csv(lines)
-        if self.top_level_node:
-            logger.debug("#### ~~~~ FINISHED whole tree CSV ~~~~ ####")
-            # logger.debug("Finished meta_csv: {}".format(lines["i2b2metadata"]))
-            # logger.debug("Finished data_csv: {}".format(lines["i2b2demodata"]))
-            logger.debug("Finished meta_csv - (i2b2: {}) (table_access: {})".format(len(lines["i2b2metadata"]["i2b2"]), len(lines["i2b2metadata"]["table_access"])))
-            logger.debug("Finished data_csv - (concept_dimension: {}) (modifier_dimension: {})".format(len(lines["i2b2demodata"]["concept_dimension"]), len(lines["i2b2demodata"]["concept_dimension"])))
-            logger.debug("#### ~~~~ FINISHED whole tree CSV ~~~~ ####")
+            for table_name in ["concept_dimension", "modifier_dimension"]:
+                for line in i2b2demodata_csv.get(table_name) or []:
+                    yield ("i2b2demodata", table_name, line)
+
+    def whole_tree_csv(self, lines:dict = None) -> dict:
+        """dict with 4 lists for each table in: i2b2metadata{table_access,i2b2}, i2b2demodata{concept_dimension,modifier_dimension}
+
+        All lines of iter_tree_rows, added to lines when supplied
+        """
+        if lines is None:
+            lines = {"i2b2metadata":{"table_access": [], "i2b2": []},"i2b2demodata":{"concept_dimension": [], "modifier_dimension": []}}
+        for schema_name, table_name, line in self.iter_tree_rows():
+            lines[schema_name][table_name].append(line)
+        logger.debug("Finished meta_csv - (i2b2: {}) (table_access: {})".format(len(lines["i2b2metadata"]["i2b2"]), len(lines["i2b2metadata"]["table_access"])))
+        logger.debug("Finished data_csv - (concept_dimension: {}) (modifier_dimension: {})".format(len(lines["i2b2demodata"]["concept_dimension"]), len(lines["i2b2demodata"]["modifier_dimension"])))
         return lines
 
     @classmethod
-    def _data_to_csv(cls, ordered_cols:list, d:dict, delim:str = ";", table_name:str = None, schema_name:str = None) -> list:
-        """Generate a csv line given the columns and data provided"""
-        first = True
+    def _csv_row(cls, ordered_cols:list, d, table_name:str = None, schema_name:str = None) -> list:
+        """Generate a csv line given the columns and data provided, from the table's compiled row plan
+
+        :param d: The node's RowView (or its __dict__), only the properties in the plan are read from it
+        """
+        plan_key = (schema_name, table_name, tuple(ordered_cols))
+        plan = _row_plans.get(plan_key)
+        if plan is None:
+            plan = _row_plans[plan_key] = cls._row_plan(ordered_cols, table_name, schema_name)
         line = []
-        d["ontology_tablename"] = app.config["ontology_tablename"]
-        for col_name in ordered_cols:
-            new_value = ""
-            real_property_options = None
-            real_property = None
-            ## Inject fixed values for some columns (see sql inserts) OR
-            ## Lookup name map as sql cols can differ from attribute/property names in code. Also can implement preference list to avoid empty values
-            if schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), ""))
-            elif schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
-                # logger.info("Mapping SQL column '{}' to object attribute '{}'".format(col_name, [y for x,y in app.config["sql_col_object_property_map"].items() if col_name in x]))
-                real_property_options = app.config["sql_col_object_property_map"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), "")
-            elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), ""))
-            elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
-                real_property_options = app.config["sql_col_object_property_map"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), "")
-            elif col_name in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get(col_name, ""))
-            elif col_name in app.config["sql_col_object_property_map"]:
-                real_property_options = app.config["sql_col_object_property_map"].get(col_name, "")
-                # logger.debug("Mapping SQL col '{}' from fuseki properties in map '{}' (Type: {})".format(col_name, real_property_options, type(real_property_options)))
+        for value_type, value in plan:
+            if value_type is _FIXED_VALUE:
+                line.append(value)
+            elif value_type is _PROPERTY:
+                line.append(str(d.get(value, "")))
             else:
-                new_value = str(d.get(col_name, ""))
-                logger.debug("Matched and available col_name ({}) name for '{}', value: {}".format(col_name, d["pref_label"], new_value))
-            if real_property_options and type(real_property_options) is str:
-                real_property = real_property_options
-            elif real_property_options and type(real_property_options) is list:
-                real_property = ""
-                for attempt_property in real_property_options:
-                    if d.get(attempt_property, None) is not None and str(d.get(attempt_property, "")) != "":
-                    # if attempt_property in d and str(d.get(attempt_property, "")) != "":
-                        logger.debug("Found non-empty useful value with prop '{}': '{}'".format(attempt_property, str(d.get(attempt_property, ""))))
-                        real_property = attempt_property
+                ## The first property with a useful value, otherwise the fallback
+                attempt_properties, new_value = value
+                for attempt_property in attempt_properties:
+                    attempt_value = d.get(attempt_property, None)
+                    if attempt_value is not None and str(attempt_value) != "":
+                        new_value = str(attempt_value)
                         break
-                    else:
-                        logger.debug("Found empty/useless value with prop '{}': {}".format(attempt_property, str(d.get(attempt_property, ""))))
-                        pass
-            if real_property:
-                new_value = str(d.get(real_property, ""))
-                logger.debug("mismatched sql({})/object({}) name for '{}', value: {}".format(col_name, real_property, d["pref_label"], new_value))
-            if first:
-                first = False
-                line = [new_value]
-            else:
                 line.append(new_value)
         return line
 
+    @classmethod
+    def _row_plan(cls, ordered_cols:list, table_name:str = None, schema_name:str = None) -> tuple:
+        """Resolve where each column's value comes from (in the same order as support/benchmark_tree.py reference_csv_row, which looks it up for every line):
+        a fixed value or mapped properties for schema-table-column, then table-column, then column - otherwise the property named as the column
+
+        Each entry is (_FIXED_VALUE, literal), (_PROPERTY, property name) or (_FIRST_PROPERTY, (property names to try in order, fallback literal))
+        """
+        fixed_value_cols = app.config["fixed_value_cols"]
+        property_map = app.config["sql_col_object_property_map"]
+        ## Not node properties, but the same for every row
+        constant_properties = {"ontology_tablename": app.config["ontology_tablename"]}
+        plan = []
+        for col_name in ordered_cols:
+            col_keys = [col_name]
+            if table_name:
+                col_keys.insert(0, "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name))
+                if schema_name:
+                    col_keys.insert(0, "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name))
+            entry = (_PROPERTY, col_name)
+            for col_key in col_keys:
+                if col_key in fixed_value_cols:
+                    entry = (_FIXED_VALUE, str(fixed_value_cols.get(col_key, "")))
+                    break
+                elif col_key in property_map:
+                    real_property_options = property_map.get(col_key, "")
+                    if real_property_options and type(real_property_options) is str:
+                        entry = (_PROPERTY, real_property_options)
+                    elif real_property_options and type(real_property_options) is list:
+                        entry = (_FIRST_PROPERTY, real_property_options)
+                    else:
+                        entry = (_FIXED_VALUE, "")
+                    break
+            if entry[0] is _PROPERTY and entry[1] in constant_properties:
+                entry = (_FIXED_VALUE, str(constant_properties[entry[1]]))
+            elif entry[0] is _FIRST_PROPERTY:
+                ## A useful constant ends the list, it is the fallback for the properties before it
+                attempt_properties = []
+                fallback = ""
+                for attempt_property in entry[1]:
+                    if attempt_property not in constant_properties:
+                        attempt_properties.append(attempt_property)
+                    elif constant_properties[attempt_property] is not None and str(constant_properties[attempt_property]) != "":
+                        fallback = str(constant_properties[attempt_property])
+                        break
+                entry = (_FIRST_PROPERTY, (tuple(attempt_properties), fallback))
+            plan.append(entry)
+        logger.debug("Compiled row plan for '{}.{}': {}".format(schema_name, table_name, plan))
+        return tuple(plan)
+
+    ## All properties which are useful for the csv lines
+    row_attributes = frozenset([
+        "c_table_cd", "c_hlevel", "concept_long", "concept_long_hash8", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname",
+        "description", "descriptions", "applied_path", "fetch_timestamp", "notation", "notations", "sourcesystem_cd", "display_label"
+    ])
+
+    def _row_value(self, key:str):
+        """Value of one of the row_attributes (see RowView)"""
+        return getattr(self, key, None)
+
     def __dict__(self):
         """Return all properties which are useful as well as any regular attributes"""
-        all_attributes = [
-            "c_table_cd", "c_hlevel", "concept_long", "concept_long_hash8", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname",
-            "description", "descriptions", "applied_path", "fetch_timestamp", "notation", "notations", "sourcesystem_cd", "display_label"
-        ]
-        d = {k: getattr(self, k, None) for k in all_attributes}
-        return d
+        d = RowView(self)
+        return {k: d.get(k) for k in self.row_attributes}
+
 
+class MetaNodeStore(object):
+    """Tree store (see meta._use_tree_backend) for MetaNode objects - the added nodes are created in batches (see MetaNode.from_records)"""
+    ## Nodes created at once
+    batch_size = 1000
+
+    def __init__(self, fetch_timestamp:str = None) -> None:
+        self.fetch_timestamp = fetch_timestamp if fetch_timestamp is not None else current_fetch_timestamp()
+        ## Created nodes, by their number
+        self.nodes = []
+        self._records = []
+        ## Number of each tree's top node
+        self.top_nodes = []
+
+    def __len__(self) -> int:
+        return len(self.nodes) + len(self._records)
+
+    def add_node(self, node_uri:str, name:str, node_type:str, parent_index:int, pref_labels:dict, display_labels:dict, notations:dict, descriptions:dict, datatype:str = None, dwh_display_status:str = None, units:dict = None, sourcesystem_cd:str = "UNKNOWN") -> int:
+        """Add a node under the parent (None for a top node), return its number - its object is created with the next batch"""
+        index = len(self)
+        if parent_index is None:
+            self.top_nodes.append(index)
+        self._records.append({
+            "node_uri": node_uri, "name": name, "node_type": node_type, "parent_index": parent_index, "pref_labels": pref_labels, "display_labels": display_labels,
+            "notations": notations, "descriptions": descriptions, "datatype": datatype, "dwh_display_status": dwh_display_status, "units": units, "sourcesystem_cd": sourcesystem_cd
+        })
+        if len(self._records) >= self.batch_size:
+            self._create_nodes()
+        return index
+
+    def _create_nodes(self) -> None:
+        MetaNode.from_records(self._records, self.nodes, self.fetch_timestamp)
+        self._records = []
+
+    def finish(self) -> None:
+        """Create the nodes still waiting for their batch"""
+        self._create_nodes()
+
+    def tree(self, top_index:int) -> MetaNode:
+        """The top node of a tree"""
+        return self.nodes[top_index]
 
 class NotationNode(object):
     """Sometimes we have multiple notations, each needs a node in i2b2 but is mostly inherited from the parent concept"""
+    __slots__ = ("_cache", "containing_node", "_notation", "tag", "index")
 
     @property
     def visual_attribute(self) -> str:
@@ -621,7 +951,7 @@ class NotationNode(object):
             return "MH"
         else:
             return "LH"
-    @property
+    @memoized_property
     def element_path(self) -> str:
         """Dynamically calculated
             - multi container only used if node has children (should it also be used for multiple notations? Something doesn't work, so maybe!)
@@ -640,18 +970,18 @@ class NotationNode(object):
             notation_path = r"{pnp}{sep}{ni}{sep}".format(
                 pnp = pnp,
                 sep = sep,
-                ni = list(self.containing_node.notations.values()).index(self)
+                ni = self.index
                 )
         else:
             notation_path = r"{pnp}{impc}{sep}{ni}{sep}".format(
                 pnp = pnp,
                 sep = sep,
                 impc = impc,
-                ni = list(self.containing_node.notations.values()).index(self) - 1
+                ni = self.index
                 )
         ## Remove duplicate slashes - if they they were at start and end of concatenated strings, then they will be doubled (back-slashes will be escaped too)
         return notation_path.replace("\\\\", "\\").replace("//", "/")
-    @property
+    @memoized_property
     def c_hlevel(self) -> int:
         """Dynamically calculated. \MULTI\ is +1, actual notations are +2"""
         ## TODO: or when containing_node notations length is 1?
@@ -683,7 +1013,7 @@ class NotationNode(object):
         """Concept path"""
         # logger.debug("NOTATION! Getting concept_long/element_path '{}' for: {}".format(self.element_path, self.notation))
         return self.element_path
-    @property
+    @memoized_property
     def concept_long_hash8(self) -> str:
         """Concept path"""
         import base64
@@ -693,22 +1023,35 @@ class NotationNode(object):
         hash8 = base64.urlsafe_b64encode(hasher[:8]).decode('ascii')[:8]
         return hash8
 
-    def __init__(self, containing_node, notation = None, tag = None) -> None:
-        """We want to know which instance is our parent, then we can extend it's attributes"""
+    def __init__(self, containing_node, notation = None, tag = None, index:int = None) -> None:
+        """We want to know which instance is our parent, then we can extend it's attributes
+
+        :param index: Position of the notation in the containing node's notations (without the "multi" container) - used in the path
+        """
+        ## Memoized derived values, cleared by the containing node (see MetaNode._invalidate)
+        self._cache = {}
         self.containing_node = containing_node
         self._notation = notation
-        self.tag = tag
+        self.tag = sys.intern(tag) if type(tag) is str else tag
+        self.index = index
+
+    ## All properties which are useful for the csv lines - no sourcesystem_cd, the notation lines don't get one
+    # parent_attributes = ["pref_label", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "applied_path", "fetch_timestamp"]
+    # notation_attributes = ["c_hlevel", "visual_attribute", "concept_long", "concept_long_hash8", "notation"]
+    row_attributes = frozenset([
+        "c_hlevel", "concept_long", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "descriptions",
+        "applied_path", "fetch_timestamp", "concept_long_hash8", "notation", "notations", "display_label"])
+
+    def _row_value(self, key:str):
+        """Value of one of the row_attributes (see RowView), extended from the containing node when this doesn't have it"""
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            return getattr(self.containing_node, key, None)
 
     def __dict__(self):
         """Return all properties which are useful as well as any regular attributes"""
-        # parent_attributes = ["pref_label", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "applied_path", "fetch_timestamp"]
-        # notation_attributes = ["c_hlevel", "visual_attribute", "concept_long", "concept_long_hash8", "notation"]
-        # all_attributes = [*parent_attributes, *notation_attributes]
-        all_attributes = [
-            "c_hlevel", "concept_long", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "descriptions",
-            "applied_path", "fetch_timestamp", "concept_long_hash8", "notation", "notations", "display_label"]
-        d1 = {k: getattr(self.containing_node, k, None) for k in all_attributes if not hasattr(self, k)}
-        d2 = {k: getattr(self, k, None) for k in all_attributes if hasattr(self, k)}
-        return {**d1, **d2}
+        d = RowView(self)
+        return {k: d.get(k) for k in self.row_attributes}
 
 ##End
@@ -0,0 +1,167 @@
+""" SqliteTree.py
+Node store for the metadata trees of a source in a local SQLite database, so the built trees aren't held in memory
+
+NOTE: Only the built trees are kept out of memory, the fetched data they are built from still is (see meta._use_tree_backend)
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+
+from .ColumnarTree import ColumnarTree, _node_paths, _visual_attribute, _hash8
+
+## Columns of the nodes table, in the order of the records read from it
+_COLUMNS = [
+    "id", "parent", "depth", "node_type", "child_count", "hidden", "node_uri", "name", "pref_label", "display_label", "description", "datatype_xml", "value_metadata", "sourcesystem_cd", "notations",
+    "element_path", "c_hlevel", "applied_path", "concept_long_hash8", "visual_attribute"
+]
+_NOTATIONS = _COLUMNS.index("notations")
+
+class SqliteTree(ColumnarTree):
+    """All nodes of a source's trees in an SQLite database file, read back in blocks with only the most recently used blocks kept
+
+    Used exactly like a ColumnarTree (nodes are added parent first, then finish), its columns read the node from the database
+    The memory used doesn't grow with the number of nodes: the blocks kept, the nodes waiting to be written and the ancestors of the last added node
+    """
+    ## Nodes written and read at once
+    block_size = 1024
+
+    def __init__(self, store_file:str, fetch_timestamp:str = None, hot_nodes:int = 8192) -> None:
+        """
+        :param store_file: Path of the database, it is removed straight away - the open database is only used by this store and vanishes with it
+        :param hot_nodes: Nodes kept in memory once read (in blocks of block_size)
+        """
+        super().__init__(fetch_timestamp)
+        self.db = sqlite3.connect(store_file, check_same_thread = False)
+        os.remove(store_file)
+        ## Nothing has to survive a crash, the trees are built again
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE nodes ({})".format(", ".join(["id INTEGER PRIMARY KEY"] + _COLUMNS[1:])))
+        self._count = 0
+        ## Added nodes which aren't in the database yet, and their parents' final number of children
+        self._pending_nodes = []
+        self._pending_child_counts = []
+        ## [number, depth, type code, children] of the last added node and its ancestors
+        self._open = []
+        ## Blocks of node records read from the database, least recently used first
+        self._blocks = OrderedDict()
+        self._max_blocks = max(1, hot_nodes // self.block_size)
+        for position, column in enumerate(_COLUMNS):
+            if column not in ["id", "notations"]:
+                setattr(self, column, _Column(self, position))
+
+    def add_node(self, node_uri:str, name:str, node_type:str, parent_index:int, pref_labels:dict, display_labels:dict, notations:dict, descriptions:dict, datatype:str = None, dwh_display_status:str = None, units:dict = None, sourcesystem_cd:str = "UNKNOWN") -> int:
+        """Add a node under the parent (None for a top node), see ColumnarTree.add_node
+
+        The parent has to be the last added node or one of its ancestors (as when building the trees depth first)
+        """
+        index = self._count
+        while len(self._open) > 0 and self._open[-1][0] != parent_index:
+            self._close_node()
+        if parent_index is None:
+            self.top_nodes.append(index)
+            depth = 0
+            parent_type = None
+        elif len(self._open) == 0:
+            raise ValueError("Node '{}' added below node {}, which isn't one of the ancestors of the last added node".format(node_uri, parent_index))
+        else:
+            depth = self._open[-1][1] + 1
+            parent_type = self._open[-1][2]
+            self._open[-1][3] += 1
+        type_code, name, pref_label, display_label, description, node_datatype_xml, node_value_metadata, hidden, sourcesystem_cd = self._node_values(
+            name, node_type, parent_type, pref_labels, display_labels, descriptions, datatype, dwh_display_status, units, sourcesystem_cd)
+        self._pending_nodes.append((
+            index, parent_index if parent_index is not None else -1, depth, type_code, 0, hidden, node_uri, name, pref_label, display_label, description,
+            node_datatype_xml, node_value_metadata, sourcesystem_cd, json.dumps(list(notations.keys()) if notations else [])
+        ))
+        self._open.append([index, depth, type_code, 0])
+        self._count += 1
+        if len(self._pending_nodes) >= self.block_size:
+            self._write_pending()
+        return index
+
+    def _close_node(self) -> None:
+        """No more children are added to the last open node"""
+        index, _, _, child_count = self._open.pop()
+        if child_count > 0:
+            self._pending_child_counts.append((child_count, index))
+
+    def _write_pending(self) -> None:
+        """Write the added nodes (and the children counts) to the database"""
+        if len(self._pending_nodes) > 0:
+            self.db.executemany("INSERT INTO nodes ({}) VALUES ({})".format(", ".join(_COLUMNS[:_NOTATIONS + 1]), ", ".join(["?"] * (_NOTATIONS + 1))), self._pending_nodes)
+            self._pending_nodes = []
+        if len(self._pending_child_counts) > 0:
+            self.db.executemany("UPDATE nodes SET child_count = ? WHERE id = ?", self._pending_child_counts)
+            self._pending_child_counts = []
+
+    def _record(self, index:int) -> list:
+        """All columns of a node, from the block of nodes it is in"""
+        block = index // self.block_size
+        if block in self._blocks:
+            self._blocks.move_to_end(block)
+        else:
+            self._write_pending()
+            records = []
+            for row in self.db.execute("SELECT {} FROM nodes WHERE id >= ? AND id < ? ORDER BY id".format(", ".join(_COLUMNS)), (block * self.block_size, (block + 1) * self.block_size)):
+                record = list(row)
+                record[_NOTATIONS] = json.loads(record[_NOTATIONS])
+                records.append(record)
+            self._blocks[block] = records
+            if len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last = False)
+        return self._blocks[block][index - block * self.block_size]
+
+    def notations(self, index:int) -> list:
+        """The notations of a node"""
+        return self._record(index)[_NOTATIONS]
+
+    def finish(self) -> None:
+        """Calculate the derived columns for all nodes (see ColumnarTree.finish), a block at a time in the order they were added
+
+        Only the paths of the current node's ancestors are needed, they are the nodes before it with a smaller depth
+        """
+        while len(self._open) > 0:
+            self._close_node()
+        self._write_pending()
+        self._blocks.clear()
+        sep = app.config["i2b2_path_separator"]
+        ipp = app.config["i2b2_path_prefix"]
+        ## (type code, element_path, c_hlevel, applied_path) of the ancestors of the current node, by depth
+        ancestors = []
+        for start in range(0, self._count, self.block_size):
+            updates = []
+            for index, parent, depth, type_code, child_count, hidden, name, notations in self.db.execute(
+                    "SELECT id, parent, depth, node_type, child_count, hidden, name, notations FROM nodes WHERE id >= ? AND id < ? ORDER BY id", (start, start + self.block_size)).fetchall():
+                del ancestors[depth:]
+                if parent < 0:
+                    element_path, c_hlevel, applied_path = _node_paths(name, type_code, None, None, None, None, depth, sep, ipp)
+                else:
+                    parent_type, parent_path, parent_hlevel, parent_applied_path = ancestors[-1]
+                    element_path, c_hlevel, applied_path = _node_paths(name, type_code, parent_type, parent_path, parent_hlevel, parent_applied_path, depth, sep, ipp)
+                ancestors.append((type_code, element_path, c_hlevel, applied_path))
+                updates.append((element_path, c_hlevel, applied_path, _hash8(element_path), _visual_attribute(parent < 0, type_code, child_count, len(json.loads(notations)), hidden), index))
+            self.db.executemany("UPDATE nodes SET element_path = ?, c_hlevel = ?, applied_path = ?, concept_long_hash8 = ?, visual_attribute = ? WHERE id = ?", updates)
+        self.db.commit()
+
+class _Column(object):
+    """A column of an SqliteTree, indexed by the node number like the columns of a ColumnarTree"""
+    __slots__ = ("store", "position")
+
+    def __init__(self, store:SqliteTree, position:int) -> None:
+        self.store = store
+        self.position = position
+
+    def __getitem__(self, index:int):
+        return self.store._record(index)[self.position]
+
+    def __len__(self) -> int:
+        return self.store._count
+
+##End
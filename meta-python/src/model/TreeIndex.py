@@ -0,0 +1,82 @@
+""" TreeIndex.py
+Hash indexes over the csv lines of a source (from its built trees or its csv files), for finding nodes and conflicts before loading
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+from .MetaNode import table_cols
+
+## Tables (in the csv lines of the nodes) with the path and code columns which are indexed
+index_cols:dict = {
+    ("i2b2metadata", "i2b2"): ("c_fullname", "c_basecode"),
+    ("i2b2demodata", "concept_dimension"): ("concept_path", "concept_cd"),
+    ("i2b2demodata", "modifier_dimension"): ("modifier_path", "modifier_cd")
+}
+## Position of the path and code in each table's lines
+_col_positions:dict = {table_name: (table_cols[(schema_name, table_name)].index(path_col), table_cols[(schema_name, table_name)].index(code_col)) for (schema_name, table_name), (path_col, code_col) in index_cols.items()}
+
+class TreeIndex(object):
+    """Path, notation and URI indexes over the csv lines of the nodes
+
+    Each line is indexed with a reference to where it's from - the node URI for the lines of a tree, "<csv file>:<line number>" for the lines of a csv file
+
+    paths: {c_fullname: reference} - the first line with the path
+    notations: {concept_cd or modifier_cd: [references]} - each reference once
+    uris: {node_uri: node} - the first node with the URI, nodes below several parents are in the trees more than once (only for trees)
+    duplicate_paths: [(path, reference, other_reference)] - paths of more than one node or line, only one of them can be loaded
+    """
+
+    def __init__(self, trees:list = None) -> None:
+        self.paths:dict = {}
+        self.notations:dict = {}
+        self.uris:dict = {}
+        self.duplicate_paths:list = []
+        for tree in trees or []:
+            self.add_tree(tree)
+
+    def add_tree(self, tree) -> None:
+        """Index every node of the tree (see MetaNode.iter_tree_nodes)"""
+        for node in tree.iter_tree_nodes():
+            self.add_node(node)
+
+    def add_node(self, node) -> None:
+        """Index the node by its URI and the paths and codes of its csv lines"""
+        node_uri = node.node_uri
+        self.uris.setdefault(node_uri, node)
+        for _, table_name, line in node.iter_node_rows():
+            self.add_line(table_name, line, node_uri)
+
+    def add_line(self, table_name:str, line:list, reference:str) -> None:
+        """Index the path and code of a csv line of the table (lines of other tables are ignored)"""
+        if table_name not in _col_positions:
+            return
+        path_position, code_position = _col_positions[table_name]
+        if table_name == "i2b2":
+            path = line[path_position]
+            indexed_reference = self.paths.setdefault(path, reference)
+            if indexed_reference != reference:
+                self.duplicate_paths.append((path, indexed_reference, reference))
+        else:
+            code = line[code_position]
+            if code is None or code == "":
+                return
+            code_references = self.notations.setdefault(code, [])
+            if reference not in code_references:
+                code_references.append(reference)
+
+    def conflicts(self, loaded_rows:list) -> list:
+        """Conflicts of the indexed lines with each other and with the rows already loaded from other sources
+
+        :param loaded_rows: (table_name, path, code, sourcesystem_cd) of loaded rows with any of the paths or codes (see meta.loaded_paths_and_codes)
+        :return: list of dicts with the "conflict" type and its details (with the references of the lines, see TreeIndex):
+            duplicate_path - more than one line with the path
+            path_loaded - the path is already loaded (in the table) from another source
+            notation_loaded - the concept/modifier code is already loaded from another source
+        """
+        conflicts = [{"conflict": "duplicate_path", "path": path, "reference": reference, "other_reference": other_reference} for path, reference, other_reference in self.duplicate_paths]
+        for table_name, path, code, sourcesystem_cd in loaded_rows:
+            if path in self.paths:
+                conflicts.append({"conflict": "path_loaded", "table": table_name, "path": path, "reference": self.paths[path], "sourcesystem_cd": sourcesystem_cd})
+            if table_name != "i2b2" and code in self.notations:
+                conflicts.append({"conflict": "notation_loaded", "table": table_name, "notation": code, "references": self.notations[code], "sourcesystem_cd": sourcesystem_cd})
+        return conflicts
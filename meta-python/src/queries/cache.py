@@ -0,0 +1,115 @@
+""" cache.py
+Disk cache for sparql query results, so a re-run against an unchanged dataset doesn't need to query fuseki again
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+## Bytes used by each source's cache directory (counted once, then tracked as files are added/removed)
+cache_sizes:dict = {}
+cache_lock = threading.Lock()
+
+def cache_directory(source_id:str) -> str:
+    """Directory holding the cached results for the source"""
+    return os.path.join(app.config["dynamic_metadata_directory"], ".sparql-cache", source_id)
+
+def get(connection:dict, sparql_query:str):
+    """Return the cached result rows for the query (read lazily, one row per line), or None if not cached (or caching is disabled for the connection)"""
+    if not connection.get("response_cache"):
+        return None
+    cache_file = _cache_file(connection, sparql_query)
+    try:
+        f = open(cache_file, "r")
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warn("Could not read cached result '{}', it will be fetched again: {}".format(cache_file, e))
+        return None
+    ## Update the modified time, it is used as the "last used" time for eviction
+    os.utime(cache_file)
+    logger.debug("Using cached result: {}".format(cache_file))
+    return _read_rows(f)
+
+def store(connection:dict, sparql_query:str, rows):
+    """Pass the result rows through while saving them (one json row per line)
+
+    The result is only cached once all rows have been read, then the least recently used results are evicted if over the size limit
+    """
+    if not connection.get("response_cache"):
+        yield from rows
+        return
+    cache_file = _cache_file(connection, sparql_query)
+    temp_file = "{}.{}.tmp".format(cache_file, threading.get_ident())
+    f = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        f = open(temp_file, "w")
+    except Exception as e:
+        logger.warn("Could not cache result '{}': {}".format(cache_file, e))
+    try:
+        for row in rows:
+            if f is not None:
+                f.write(json.dumps(row))
+                f.write("\n")
+            yield row
+    except BaseException:
+        ## Incomplete result (error or the rows weren't all read), don't cache it
+        if f is not None:
+            f.close()
+            os.remove(temp_file)
+        raise
+    if f is None:
+        return
+    try:
+        f.close()
+        os.replace(temp_file, cache_file)
+        _evict(connection["source_id"], connection["response_cache"]["max_bytes"], os.path.getsize(cache_file))
+    except Exception as e:
+        logger.warn("Could not cache result '{}': {}".format(cache_file, e))
+
+def purge(source_id:str) -> bool:
+    """Remove all cached results for the source"""
+    source_cache = cache_directory(source_id)
+    with cache_lock:
+        cache_sizes.pop(source_id, None)
+        if os.path.isdir(source_cache):
+            logger.info("Removing cached sparql results for source '{}': {}".format(source_id, source_cache))
+            shutil.rmtree(source_cache)
+            return True
+    return False
+
+def _cache_file(connection:dict, sparql_query:str) -> str:
+    """Cache key is the endpoint, the version of the dataset and the query"""
+    key = hashlib.sha256("{}\n{}\n{}".format(connection["prepared_request"].url, connection["response_cache"]["version"], sparql_query).encode()).hexdigest()
+    return os.path.join(cache_directory(connection["source_id"]), "{}.jsonl".format(key))
+
+def _evict(source_id:str, max_bytes:int, added_bytes:int) -> None:
+    """Delete the least recently used results until the source's cache fits in max_bytes"""
+    with cache_lock:
+        if source_id not in cache_sizes:
+            cache_sizes[source_id] = sum([entry.stat().st_size for entry in os.scandir(cache_directory(source_id)) if entry.is_file()])
+        else:
+            cache_sizes[source_id] += added_bytes
+        if cache_sizes[source_id] <= max_bytes:
+            return
+        entries = sorted([entry for entry in os.scandir(cache_directory(source_id)) if entry.is_file()], key = lambda entry: entry.stat().st_mtime)
+        cache_sizes[source_id] = sum([entry.stat().st_size for entry in entries])
+        for entry in entries:
+            if cache_sizes[source_id] <= max_bytes:
+                break
+            cache_sizes[source_id] -= entry.stat().st_size
+            os.remove(entry.path)
+            logger.debug("Evicted cached result: {}".format(entry.path))
+
+def _read_rows(f):
+    """Yield the rows of an open cache file, closing it afterwards"""
+    with f:
+        for line in f:
+            yield json.loads(line)
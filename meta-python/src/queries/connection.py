@@ -9,8 +9,14 @@ logger = logging.getLogger(__name__)
 import psycopg2
 import psycopg2.sql
 import requests
+import requests.adapters
 import SPARQLWrapper
 import sys
+import threading
+
+## Shared sessions (and their connection pools), one per fuseki endpoint - reused by every fetch from that endpoint
+request_sessions:dict = {}
+request_sessions_lock = threading.Lock()
 
 def get_fuseki_connection(fuseki_endpoint:str, connection_type:str = "requests", source_id:str = "UNKNOWN"):
     """Run the respective function to get the connection of the type requested"""
@@ -35,14 +41,31 @@ def _get_sparql_wrapper(fuseki_endpoint:str):
     return sparql
 
 def _get_requests_connection(fuseki_endpoint:str) -> dict:
-    """Get session and prepared request, also supply a default timeout"""
-    connection = {"session": _get_request_session(), "prepared_request": _get_prepped_request(fuseki_endpoint), "timeout": (3, 60)}
+    """Get the endpoint's shared session and a prepared request, also supply the (connect, read) timeout from config"""
+    client_config = _client_config()
+    timeout = (float(client_config.get("connect_timeout", 3)), float(client_config.get("read_timeout", 60)))
+    connection = {"session": _get_request_session(fuseki_endpoint), "prepared_request": _get_prepped_request(fuseki_endpoint), "timeout": timeout}
     return connection
 
-def _get_request_session():
-    """Create a session to utilise connection pooling - possibly more later"""
-    new_session = requests.Session()
-    return new_session
+def _get_request_session(fuseki_endpoint:str):
+    """Get the session for the endpoint, creating it the first time - its pooled connections are kept alive between fetches"""
+    with request_sessions_lock:
+        session = request_sessions.get(fuseki_endpoint)
+        if session is None:
+            client_config = _client_config()
+            pool_size = int(client_config.get("pool_size", 10))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size, pool_block = True)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+            request_sessions[fuseki_endpoint] = session
+            logger.debug("Created session for '{}' with a pool of {} connections".format(fuseki_endpoint, pool_size))
+    return session
+
+def _client_config() -> dict:
+    """Settings for the fuseki http client from config"""
+    return app.config.get("fuseki_client") or {}
 
 def _get_prepped_request(fuseki_endpoint:str):
     """Create a prepared request for the fuseki endpoint"""
@@ -0,0 +1,79 @@
+""" namespaces.py
+Resolve between full URIs and their shorthand (CURIE) form, using the "generator_mappings" of the config
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import re
+
+class NamespaceResolver(object):
+    """Longest-prefix resolution of URIs to CURIEs (eg "http://loinc.org/owl#1-1" to "L:1-1") and back, compiled once from the mappings
+
+    Resolved URIs and CURIEs are remembered (the same nodes and notations are resolved over and over), up to memo_size of each before starting again
+    """
+    memo_size = 65536
+
+    def __init__(self, mappings:dict) -> None:
+        """
+        :param mappings: {namespace URI: shorthand prefix (including the ":")}, more than one namespace can have the same prefix
+        """
+        self.mappings = mappings
+        ## Longest first, so the first alternative that matches is the longest namespace
+        namespaces = sorted(mappings.keys(), key = len, reverse = True)
+        self._namespace_pattern = re.compile("|".join(re.escape(namespace) for namespace in namespaces)) if len(namespaces) > 0 else None
+        ## The first configured namespace of each prefix is used for its full URIs
+        self._namespaces:dict = {}
+        for namespace, prefix in mappings.items():
+            self._namespaces.setdefault(prefix, namespace)
+        self._curies:dict = {}
+        self._uris:dict = {}
+
+    def curie(self, uri:str) -> str:
+        """The URI with its namespace replaced by the shorthand prefix, unchanged when there is no mapping for it"""
+        curie = self._curies.get(uri)
+        if curie is None:
+            match = self._namespace_pattern.match(uri) if self._namespace_pattern is not None else None
+            curie = self.mappings[match.group()] + uri[match.end():] if match else uri
+            if len(self._curies) >= self.memo_size:
+                self._curies.clear()
+            self._curies[uri] = curie
+        return curie
+
+    def uri(self, curie:str) -> str:
+        """The full URI of the CURIE, unchanged when its prefix isn't known"""
+        uri = self._uris.get(curie)
+        if uri is None:
+            namespace = self.namespace(curie)
+            uri = namespace + curie[curie.index(":") + 1:] if namespace is not None else curie
+            if len(self._uris) >= self.memo_size:
+                self._uris.clear()
+            self._uris[curie] = uri
+        return uri
+
+    def prefix(self, curie:str) -> str:
+        """The shorthand prefix of the CURIE (eg "S:" of a notation), None if it isn't one of the mapped prefixes"""
+        if ":" not in curie:
+            return None
+        prefix = curie[:curie.index(":") + 1]
+        return prefix if prefix in self._namespaces else None
+
+    def namespace(self, curie:str) -> str:
+        """The namespace URI of the CURIE's prefix, None if it isn't known"""
+        prefix = self.prefix(curie)
+        return self._namespaces[prefix] if prefix is not None else None
+
+## Compiled from the mappings in the config the first time it is needed
+_resolver:NamespaceResolver = None
+_resolver_mappings:dict = None
+
+def resolver() -> NamespaceResolver:
+    """The resolver for the configured "generator_mappings" (compiled again only if the config is replaced)"""
+    global _resolver, _resolver_mappings
+    mappings = app.config.get("generator_mappings")
+    if _resolver is None or mappings is not _resolver_mappings:
+        logger.debug("Compiling the namespace resolver for {} mappings".format(len(mappings or {})))
+        _resolver = NamespaceResolver(mappings or {})
+        _resolver_mappings = mappings
+    return _resolver
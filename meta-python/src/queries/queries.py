@@ -7,13 +7,26 @@ from flask import current_app as app
 import logging
 logger = logging.getLogger(__name__)
 
+import csv
 import json
 import os
+from queries import cache, namespaces
 import re
+import urllib.parse
 
 ## For caching the queries
 sparql_skeletons:dict = None
 
+## Accept header for each result format, the streamed formats (tsv, csv) fall back to json if the endpoint doesn't support them
+result_formats:dict = {
+    "tsv": "text/tab-separated-values, application/sparql-results+json;q=0.5",
+    "csv": "text/csv, application/sparql-results+json;q=0.5",
+    "json": "application/sparql-results+json",
+}
+## Escape sequences in the literals of tsv results
+_RE_TSV_ESCAPE = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)")
+_tsv_escapes:dict = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", "\"": "\"", "'": "'", "\\": "\\"}
+
 def run_sql_file(db_conn, filename) -> bool:
     """Use the database connection and filename supplied to run the SQL in the resources dir"""
     ## TODO: Concat resources dir (from config) with filename
@@ -40,58 +53,196 @@ def top_elements(connection) -> dict:
     """Query fuseki/sparql for the parent element names and types"""
     logger.debug("Fetching top-level elements")
     sparql_query = _get_skeleton("query_top_elements")
-
-    fuseki_endpoint = connection["prepared_request"].url
-    ## Simple request using session (for connection pooling/reuse)
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
-    logger.debug("Response (session): {}".format(response.text))
-
-    data = response.json()
-    jsonString = json.dumps(data)
+    bindings = _run_query(connection, sparql_query)
 
     elements:dict = {}
-    for child in data["results"]["bindings"]:
-        elements[child["element"]["value"]] = child["type"]["value"]
+    for child in bindings:
+        elements[child["element"]] = child["type"]
     logger.debug("Found top-level elements: {}".format(elements))
-    logger.debug(jsonString)
     return elements
 
 def getChildren(connection, node_name):
     """Get all child elements of the given element"""
     logger.debug("fetching node children for {}".format(node_name))
     sparql_query = _get_skeleton("query_child_elements").replace("TOPELEMENT", "<"+node_name+">")
-
-    fuseki_endpoint = connection["prepared_request"].url
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
-
-    data = response.json()
-    jsonString = json.dumps(data)
+    bindings = _run_query(connection, sparql_query)
 
     children:dict = {}
-    for child in data["results"]["bindings"]:
-        children[child["element"]["value"]] = child["type"]["value"]
+    for child in bindings:
+        children[child["element"]] = child["type"]
     logger.debug("Found children for '{}': {}".format(node_name, children))
-    logger.debug(jsonString)
     return children
 
 def getAttributes(connection, node_uri):
     """Use single query to get all the useful attributes of the node"""
     logger.debug("fetching node attributes/properties for {}".format(node_uri))
     sparql_query = _get_skeleton("query_attributes").replace("<CONCEPT>", "<"+node_uri+">")
+    ## Read all rows (only the first is used) so the response is finished with
+    bindings = list(_run_query(connection, sparql_query))
+    return _element_attributes(node_uri, bindings[0] if len(bindings) > 0 else None)
+
+def all_children(connection, parent_uris:list = None) -> dict:
+    """Get the child elements of every element in a single query - {parent_uri: {child_uri: type}}
+
+    :param parent_uris: Only get the children of these elements (bound with VALUES), None for every element
+    """
+    logger.debug("Fetching all parent/child relations (for {} parents)".format("all" if parent_uris is None else len(parent_uris)))
+    sparql_query = _get_skeleton("query_child_elements_all")
+    if parent_uris is not None:
+        sparql_query = sparql_query.replace("#PARENTS", _values_block("parent", parent_uris))
+    relation_count = 0
+    children:dict = {}
+    for child in _run_query(connection, sparql_query):
+        children.setdefault(child["parent"], {})[child["element"]] = child["type"]
+        relation_count += 1
+    logger.info("Found {} relations for {} parent elements".format(relation_count, len(children)))
+    return children
+
+def all_attributes(connection, node_uris:list = None) -> dict:
+    """Get the attributes of every concept and collection in a single query - {node_uri: attributes}
+
+    :param node_uris: Only get the attributes of these nodes (bound with VALUES), None for every node
+    """
+    logger.debug("Fetching attributes/properties of all nodes (for {} nodes)".format("all" if node_uris is None else len(node_uris)))
+    sparql_query = _get_skeleton("query_attributes_all")
+    if node_uris is not None:
+        sparql_query = sparql_query.replace("#ELEMENTS", _values_block("element", node_uris))
+    elements:dict = {}
+    for binding in _run_query(connection, sparql_query):
+        ## Same as getAttributes, only the first result is used when a node has several (eg 2 @en labels)
+        if binding["element"] not in elements:
+            elements[binding["element"]] = _element_attributes(binding["element"], binding)
+    logger.info("Found attributes for {} nodes".format(len(elements)))
+    return elements
+
+def dataset_version(connection) -> str:
+    """A cheap fingerprint of the dataset, which changes when the dataset changes
+
+    Combines the number of modification dates (dcterms:modified, prov:generatedAtTime, prov:endedAtTime, changeset dates and dc:date) with the latest of them
+    Only the triples of these properties are read (through the predicate index), not the whole dataset
+    NOTE: A change which doesn't add or update one of the dates isn't noticed, fetch with force then
+    """
+    sparql_query = _get_skeleton("query_dataset_version")
+    bindings = list(_run_query(connection, sparql_query))
+    if len(bindings) == 0:
+        logger.warn("No dataset version returned for source: {}".format(connection["source_id"]))
+        return None
+    if bindings[0].get("dates", "0") == "0":
+        ## Nothing to tell the versions apart by
+        logger.warn("No modification dates in the dataset of source '{}', its version is unknown".format(connection["source_id"]))
+        return None
+    version = "{}-{}".format(bindings[0].get("dates", ""), bindings[0].get("modified", ""))
+    logger.debug("Dataset version for '{}': {}".format(connection["source_id"], version))
+    return version
+
+def _values_block(variable:str, uris:list) -> str:
+    """SPARQL VALUES block binding the variable to each of the uris"""
+    return "VALUES ?{} {{ {} }}".format(variable, " ".join(["<"+uri+">" for uri in uris]))
+
+def values_size(uri:str) -> int:
+    """Bytes the uri adds to a VALUES block (see _values_block) in the url-encoded query of the request"""
+    return len(urllib.parse.quote_plus("<"+uri+"> "))
 
+def _run_query(connection, sparql_query:str):
+    """Run the query against the fuseki endpoint and yield the result rows - each as {variable: value} (unbound variables are left out)
+
+    The rows are parsed while the response is streamed when fuseki returns tsv or csv (see result_formats)
+    """
+    cached_rows = cache.get(connection, sparql_query)
+    if cached_rows is not None:
+        yield from cached_rows
+        return
     fuseki_endpoint = connection["prepared_request"].url
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
+    result_format = connection.get("result_format", "json")
+    headers = {"Accept": result_formats.get(result_format, result_formats["json"])}
+    timeout = connection["timeout"]
+    if connection.get("deadline"):
+        ## Don't wait for fuseki past the end of the processing time
+        connection["deadline"].check("Fetching from fuseki")
+        timeout = connection["deadline"].timeout(timeout)
+    ## Simple request using session (for connection pooling/reuse)
+    with connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, headers=headers, timeout=timeout, stream=True) as response:
+        content_type = response.headers.get("Content-Type", "")
+        logger.debug("Response content type (requested '{}'): {}".format(result_format, content_type))
+        ## The sparql result formats are always utf-8
+        response.encoding = "utf-8"
+        if content_type.startswith("text/tab-separated-values"):
+            rows = _tsv_rows(response)
+        elif content_type.startswith("text/csv"):
+            rows = _csv_rows(response)
+        else:
+            rows = _json_rows(response)
+        yield from cache.store(connection, sparql_query, rows)
 
+def _json_rows(response):
+    """Rows from a sparql json result (the whole response is read at once)"""
     data = response.json()
-    jsonString = json.dumps(data)
+    logger.debug("Result rows (json): {}".format(len(data["results"]["bindings"])))
+    for binding in data["results"]["bindings"]:
+        yield {k: v["value"] for k, v in binding.items()}
+
+def _tsv_rows(response):
+    """Rows from a sparql tsv result, parsed line by line as the response arrives"""
+    lines = _text_lines(response)
+    header = next(lines, "")
+    variables = [variable.lstrip("?$") for variable in header.split("\t")]
+    for line in lines:
+        if line == "":
+            continue
+        yield {variable: _tsv_term_value(term) for variable, term in zip(variables, line.split("\t")) if term != ""}
+
+def _csv_rows(response):
+    """Rows from a sparql csv result, parsed line by line as the response arrives
+
+    NOTE: csv can't tell an unbound variable from an empty string, both are left out of the row
+    """
+    reader = csv.reader(_text_lines(response, keep_ends = True))
+    variables = next(reader, [])
+    for values in reader:
+        yield {variable: value for variable, value in zip(variables, values) if value != ""}
+
+def _text_lines(response, keep_ends:bool = False):
+    """Split the streamed response into lines (only on \\n, the content can contain other unicode line breaks)"""
+    pending = ""
+    for chunk in response.iter_content(chunk_size = 65536, decode_unicode = True):
+        pending += chunk
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n" if keep_ends else line.rstrip("\r")
+    if pending != "":
+        yield pending
+
+def _tsv_term_value(term:str) -> str:
+    """The value of an RDF term written in tsv results (eg <uri>, "literal"@en, "1"^^<type>, 1, _:blank)"""
+    if term.startswith("<") and term.endswith(">"):
+        return term[1:-1]
+    if term.startswith("\""):
+        ## Remove any language tag or datatype after the closing quote
+        literal = term[1 : term.rindex("\"")]
+        if "\\" in literal:
+            literal = _RE_TSV_ESCAPE.sub(_tsv_unescape, literal)
+        return literal
+    if term.startswith("_:"):
+        return term[2:]
+    return term
+
+def _tsv_unescape(match) -> str:
+    """Replacement for a single escape sequence"""
+    escaped = match.group(1)
+    if len(escaped) > 1:
+        return chr(int(escaped[1:], 16))
+    return _tsv_escapes.get(escaped, escaped)
 
+def _element_attributes(node_uri:str, binding:dict) -> dict:
+    """Build the attributes of the node from a single (attributes query) result row"""
     try:
         element:dict = {}
         element["name"] = getName(node_uri)
         singles_from_query = ["prefLabel", "displayLabel", "display", "datatype", "description"]
         for attrib in singles_from_query:
-            if attrib in data["results"]["bindings"][0] and data["results"]["bindings"][0][attrib]["value"] != "":
-                element[attrib] = _clean_label(data["results"]["bindings"][0][attrib]["value"])
+            if attrib in binding and binding[attrib] != "":
+                element[attrib] = _clean_label(binding[attrib])
             else:
                 logger.warn("No '{}' available for node: {}".format(attrib, node_uri))
                 element[attrib] = None
@@ -99,10 +250,9 @@ def getAttributes(connection, node_uri):
         lists_from_query = ["notations", "units"]
         ## NOTE: List delimiter in query is hard-coded as semi-colon ; TODO: Use a config and .replace()
         for attrib in lists_from_query:
-            if attrib in data["results"]["bindings"][0]:
+            if attrib in binding:
                 ## TODO: Adjust query to get the tag and add that as the value
-                element[attrib] = {_clean_label(k):None for k in data["results"]["bindings"][0][attrib]["value"].strip("[]").split(";")}
-                # element[attrib] = _clean_label(data["results"]["bindings"][0][attrib]["value"])
+                element[attrib] = {_clean_label(k):None for k in binding[attrib].strip("[]").split(";")}
             else:
                 logger.warn("No '{}' available for node: {}".format(attrib, node_uri))
                 element[attrib] = None
@@ -110,7 +260,6 @@ def getAttributes(connection, node_uri):
     except Exception as e:
         logger.error("Error processing attributes from query for concept: {}!\n{}".format(node_uri, e))
     finally:
-        logger.debug(jsonString)
         logger.debug("Node data: {}".format(element))
     return element
 
@@ -132,9 +281,7 @@ def _clean_label(label:str) -> str:
 def getName(element_uri:str, include_prefix:bool = True) -> str:
     """Get the name portion of the element - replace prefix url with shorthand where possible"""
     ## TODO: Automate getting @prefix definitions from fuseki
-    name = element_uri
-    for k, v in app.config["generator_mappings"].items():
-        name = name.replace(k, v)
+    name = namespaces.resolver().curie(element_uri)
     if not include_prefix:
         name = name.split(":")[1]
     logger.debug("Name of element ({}): {}".format(element_uri, name))
@@ -10,6 +10,7 @@ app.logger = logging.getLogger(__name__)
 from io import StringIO
 import json
 import os
+from queries import namespaces
 import re
 import requests
 # import pycurl
@@ -424,9 +425,7 @@ def _clean_label(label:str) -> str:
 def getName(element_uri:str, include_prefix:bool = True) -> str:
     """Get the name portion of the element - replace prefix url with shorthand where possible"""
     ## TODO: Automate getting @prefix definitions from fuseki
-    name = element_uri
-    for k, v in app.config["generator_mappings"].items():
-        name = name.replace(k, v)
+    name = namespaces.resolver().curie(element_uri)
     if not include_prefix:
         name = name.split(":")[1]
     app.logger.debug("Name of element ({}): {}".format(element_uri, name))
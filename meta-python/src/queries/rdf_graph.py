@@ -0,0 +1,103 @@
+""" rdf_graph.py
+The same data as the sparql queries, but taken from an RDF export (eg Turtle/N-Triples) of CoMetaR loaded in memory with rdflib
+Mirrors the skeleton queries in resources, so the trees are the same as those fetched from fuseki
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+from queries import queries
+import rdflib
+from rdflib.namespace import RDF, SKOS
+import rdflib.util
+
+DZL = rdflib.Namespace("http://data.dzl.de/ont/dwh#")
+DWH = rdflib.Namespace("http://sekmi.de/histream/dwh#")
+DC = rdflib.Namespace("http://purl.org/dc/elements/1.1/")
+## Not the real rdf namespace term, but what CoMetaR (and the skeleton queries) use for modifiers
+RDF_HAS_PART = rdflib.URIRef(str(RDF) + "hasPart")
+
+## Same as the IF(...) chain in query_attributes
+restriction_datatypes:dict = {
+    DWH.integerRestriction: "integer",
+    DWH.floatRestriction: "float",
+    DWH.partialDateRestriction: "partialDate",
+    DWH.largeStringRestriction: "largeString",
+    DWH.dateRestriction: "date",
+}
+
+def load_graph(dump_path:str) -> rdflib.Graph:
+    """Parse the dump file, the format is guessed from the file extension (turtle if unknown)"""
+    logger.info("Loading RDF dump: {}".format(dump_path))
+    graph = rdflib.Graph()
+    graph.parse(dump_path, format = rdflib.util.guess_format(dump_path) or "turtle")
+    logger.info("Loaded {} triples from: {}".format(len(graph), dump_path))
+    return graph
+
+def top_elements(graph:rdflib.Graph) -> dict:
+    """Top-level element names and types (see query_top_elements)"""
+    elements:dict = {}
+    for element in graph.objects(None, DZL.topLevelNode):
+        if (element, RDF.type, SKOS.Concept) in graph:
+            elements[str(element)] = "concept"
+    for element in graph.objects(None, DZL.topLevelNode):
+        if (element, RDF.type, SKOS.Collection) in graph:
+            elements[str(element)] = "collection"
+    for element in graph.subjects(SKOS.topConceptOf, DZL.Scheme):
+        if (element, RDF.type, SKOS.Concept) in graph:
+            elements[str(element)] = "concept"
+    logger.debug("Found top-level elements: {}".format(elements))
+    return elements
+
+def all_children(graph:rdflib.Graph) -> dict:
+    """The child elements of every element - {parent_uri: {child_uri: type}} (see query_child_elements_all)"""
+    concepts = set(graph.subjects(RDF.type, SKOS.Concept))
+    collections = set(graph.subjects(RDF.type, SKOS.Collection))
+    ## Same order as the UNION in the query
+    relations = [
+        (concepts, SKOS.narrower, concepts, "concept"),
+        (concepts, RDF_HAS_PART, concepts, "modifier"),
+        (collections, SKOS.member, collections, "collection"),
+        (collections, SKOS.member, concepts, "concept"),
+    ]
+    children:dict = {}
+    for parent_types, predicate, element_types, element_type in relations:
+        for parent, element in graph.subject_objects(predicate):
+            if parent in parent_types and element in element_types:
+                children.setdefault(str(parent), {})[str(element)] = element_type
+    logger.info("Found relations for {} parent elements".format(len(children)))
+    return children
+
+def all_attributes(graph:rdflib.Graph) -> dict:
+    """The attributes of every concept and collection - {node_uri: attributes} (see query_attributes_all)"""
+    nodes = list(dict.fromkeys([*graph.subjects(RDF.type, SKOS.Concept), *graph.subjects(RDF.type, SKOS.Collection)]))
+    elements:dict = {}
+    for node in nodes:
+        elements[str(node)] = queries._element_attributes(str(node), _attribute_row(graph, node))
+    logger.info("Found attributes for {} nodes".format(len(elements)))
+    return elements
+
+def _attribute_row(graph:rdflib.Graph, node:rdflib.URIRef) -> dict:
+    """Build the same result row as query_attributes returns for the node"""
+    row:dict = {}
+    row["prefLabel"] = _tagged_literal(graph, node, SKOS.prefLabel)
+    row["displayLabel"] = _tagged_literal(graph, node, DZL.displayLabel)
+    row["description"] = _tagged_literal(graph, node, DC.description)
+    display = graph.value(node, DWH.display)
+    if display is not None:
+        row["display"] = str(display)
+    row["notations"] = "[{}]".format("; ".join(dict.fromkeys([str(notation) for notation in graph.objects(node, SKOS.notation)])))
+    row["units"] = "[{}]".format("; ".join(dict.fromkeys([str(unit) for unit in graph.objects(node, DZL.unit)])))
+    restriction = graph.value(node, DWH.restriction)
+    if restriction is not None:
+        row["datatype"] = restriction_datatypes.get(restriction, "string")
+    return row
+
+def _tagged_literal(graph:rdflib.Graph, node:rdflib.URIRef, predicate:rdflib.URIRef) -> str:
+    """English literal, otherwise German, otherwise empty (like the coalesce in the query)"""
+    literals = {}
+    for literal in graph.objects(node, predicate):
+        if isinstance(literal, rdflib.Literal) and literal.language in ["en", "de"]:
+            literals.setdefault(literal.language, str(literal))
+    return literals.get("en", literals.get("de", ""))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+""" benchmark_tree.py
+
+Measure the memory and time used to build a (synthetic) metadata tree and to generate its CSV data.
+Good for checking that very large ontologies still fit comfortably in the meta container.
+
+Run as a script from anywhere, optionally with the size of the tree:
+```python3 meta-python/support/benchmark_tree.py --nodes 100000 --fanout 10```
+Tracing the memory slows everything down a lot, use --time-only for realistic durations
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+## Per node logging would dominate the measurements (and nodes without a datatype always warn)
+logging.basicConfig(level = logging.ERROR)
+logger = logging.getLogger(__name__)
+
+support_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(support_dir, "..", "src"))
+
+from flask import Flask, current_app as app
+from model import ColumnarTree, MetaNode, SqliteTree
+
+def get_app() -> Flask:
+    """App with the same config as the meta container (the model reads it from the app context)"""
+    app = Flask(__name__)
+    for conf_file in ["i2b2meta_user_config.yaml", "config.yaml"]:
+        with open(os.path.join(support_dir, "config", conf_file), "r") as yaml_file:
+            app.config.update(yaml.safe_load(yaml_file))
+    return app
+
+def node_data(node_count:int, fanout:int, notation_every:int) -> list:
+    """Data of (about) node_count nodes, each node with up to fanout children - similar to what is fetched from CoMetaR
+
+    Every notation_every'th node has several notations, every other node has a single one
+    The nodes are numbered breadth first (so the trees are balanced), with the number of their parent (None for the top nodes)
+    """
+    nodes = []
+    for i in range(node_count):
+        if i % notation_every == 0:
+            notations = {"S:{}-1".format(i): None, "S:{}-2".format(i): None, "L:{}-3".format(i): None}
+        else:
+            notations = {"S:{}".format(i): None}
+        nodes.append({
+            "parent": (i - fanout) // fanout if i >= fanout else None,
+            "node_uri": "http://data.dzl.de/ont/dwh#node{}".format(i),
+            "name": "node{}".format(i),
+            "node_type": "concept",
+            "pref_labels": {"Node number {}".format(i): "en"},
+            "display_labels": {None: "en"},
+            "notations": notations,
+            "dwh_display_status": None,
+            "datatype": "integer" if i % 3 == 0 else None,
+            "units": {"mg": None, "g": None} if i % 3 == 0 else None,
+            "descriptions": {"Description of node {}".format(i): "en"},
+            "sourcesystem_cd": "benchmark"
+        })
+    return nodes
+
+def build_tree(nodes:list, fetch_timestamp:str) -> list:
+    """Build the trees of MetaNode objects"""
+    top_nodes = []
+    meta_nodes = []
+    for data in nodes:
+        parent_node = meta_nodes[data["parent"]] if data["parent"] is not None else None
+        node = MetaNode.MetaNode(
+            parent_node = parent_node,
+            fetch_timestamp = fetch_timestamp,
+            **{k: v for k, v in data.items() if k != "parent"}
+        )
+        if parent_node is None:
+            top_nodes.append(node)
+        meta_nodes.append(node)
+    return top_nodes
+
+def build_records(nodes:list, fetch_timestamp:str) -> list:
+    """Build the same trees of MetaNode objects in batches with MetaNode.from_records (parents are before their children, as in build_columnar)"""
+    store = MetaNode.MetaNodeStore(fetch_timestamp)
+    return build_columnar(nodes, fetch_timestamp, store)
+
+def build_columnar(nodes:list, fetch_timestamp:str, store:object = None) -> list:
+    """Build the same trees in a ColumnarTree (or the supplied store) - its nodes have to be added depth first (parents before their children, one tree after the other)"""
+    if store is None:
+        store = ColumnarTree.ColumnarTree(fetch_timestamp)
+    children = {}
+    for i, data in enumerate(nodes):
+        children.setdefault(data["parent"], []).append(i)
+    ## Node number and its number in the store
+    pending = [(i, None) for i in reversed(children.get(None, []))]
+    while len(pending) > 0:
+        i, parent_index = pending.pop()
+        data = nodes[i]
+        index = store.add_node(parent_index = parent_index, **{k: v for k, v in data.items() if k != "parent"})
+        pending.extend((child, index) for child in reversed(children.get(i, [])))
+    store.finish()
+    return [store.tree(top_index) for top_index in store.top_nodes]
+
+def build_sqlite(nodes:list, fetch_timestamp:str) -> list:
+    """Build the same trees in an SqliteTree (in a temporary directory)"""
+    return build_columnar(nodes, fetch_timestamp, SqliteTree.SqliteTree(os.path.join(tempfile.mkdtemp(), "tree-store.sqlite"), fetch_timestamp))
+
+def measure(label:str, function, *args):
+    """Run the function, print the time taken and (when tracing) the memory it allocated - still in use, and at its peak"""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    result = function(*args)
+    duration = time.perf_counter() - start_time
+    if tracemalloc.is_tracing():
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        print("{:<24} {:>8.2f} s {:>10.1f} MiB kept {:>10.1f} MiB peak".format(label, duration, (current_memory - start_memory) / 2**20, (peak_memory - start_memory) / 2**20))
+    else:
+        print("{:<24} {:>8.2f} s".format(label, duration))
+    return result
+
+def tree_csv(trees:list) -> int:
+    """Generate the CSV data of all trees, return the number of rows"""
+    rows = 0
+    for tree in trees:
+        for _ in tree.iter_tree_rows():
+            rows += 1
+    return rows
+
+def all_nodes(trees:list) -> list:
+    """Every node of the trees (and their notations with a node of their own)"""
+    nodes = []
+    for tree in trees:
+        for node in tree.iter_tree_nodes():
+            nodes.append(node)
+            if node.notations and len(node.notations) >= 2:
+                nodes.extend(node.notations.values())
+    return nodes
+
+def reference_csv_row(ordered_cols:list, d:dict, table_name:str = None, schema_name:str = None) -> list:
+    """The csv line of the columns from a node's __dict__, looking up every column in the config again for each line
+
+    This was MetaNode's row emitter before the compiled row plans (MetaNode._csv_row), kept here as the reference they're compared with
+    """
+    first = True
+    line = []
+    d["ontology_tablename"] = app.config["ontology_tablename"]
+    for col_name in ordered_cols:
+        new_value = ""
+        real_property_options = None
+        real_property = None
+        ## Inject fixed values for some columns (see sql inserts) OR
+        ## Lookup name map as sql cols can differ from attribute/property names in code. Also can implement preference list to avoid empty values
+        if schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
+            new_value = str(app.config["fixed_value_cols"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), ""))
+        elif schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
+            # logger.info("Mapping SQL column '{}' to object attribute '{}'".format(col_name, [y for x,y in app.config["sql_col_object_property_map"].items() if col_name in x]))
+            real_property_options = app.config["sql_col_object_property_map"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), "")
+        elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
+            new_value = str(app.config["fixed_value_cols"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), ""))
+        elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
+            real_property_options = app.config["sql_col_object_property_map"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), "")
+        elif col_name in app.config["fixed_value_cols"]:
+            new_value = str(app.config["fixed_value_cols"].get(col_name, ""))
+        elif col_name in app.config["sql_col_object_property_map"]:
+            real_property_options = app.config["sql_col_object_property_map"].get(col_name, "")
+            # logger.debug("Mapping SQL col '{}' from fuseki properties in map '{}' (Type: {})".format(col_name, real_property_options, type(real_property_options)))
+        else:
+            new_value = str(d.get(col_name, ""))
+            logger.debug("Matched and available col_name ({}) name for '{}', value: {}".format(col_name, d["pref_label"], new_value))
+        if real_property_options and type(real_property_options) is str:
+            real_property = real_property_options
+        elif real_property_options and type(real_property_options) is list:
+            real_property = ""
+            for attempt_property in real_property_options:
+                if d.get(attempt_property, None) is not None and str(d.get(attempt_property, "")) != "":
+                # if attempt_property in d and str(d.get(attempt_property, "")) != "":
+                    logger.debug("Found non-empty useful value with prop '{}': '{}'".format(attempt_property, str(d.get(attempt_property, ""))))
+                    real_property = attempt_property
+                    break
+                else:
+                    logger.debug("Found empty/useless value with prop '{}': {}".format(attempt_property, str(d.get(attempt_property, ""))))
+                    pass
+        if real_property:
+            new_value = str(d.get(real_property, ""))
+            logger.debug("mismatched sql({})/object({}) name for '{}', value: {}".format(col_name, real_property, d["pref_label"], new_value))
+        if first:
+            first = False
+            line = [new_value]
+        else:
+            line.append(new_value)
+    return line
+
+def compare_row_emitters(trees:list) -> None:
+    """Time generating the lines of every table for every node with reference_csv_row and the compiled MetaNode._csv_row, and check they're the same"""
+    node_dicts = [node.__dict__() for node in all_nodes(trees)]
+    reference_lines = measure("  reference_csv_row", lambda: [reference_csv_row(ordered_cols = cols, d = d, table_name = table_name, schema_name = schema_name) for d in node_dicts for (schema_name, table_name), cols in MetaNode.table_cols.items()])
+    compiled_lines = measure("  _csv_row", lambda: [MetaNode.MetaNode._csv_row(ordered_cols = cols, d = d, table_name = table_name, schema_name = schema_name) for d in node_dicts for (schema_name, table_name), cols in MetaNode.table_cols.items()])
+    if reference_lines != compiled_lines:
+        print("Row emitters DIFFER: {} of {} lines".format(sum(1 for a, b in zip(reference_lines, compiled_lines) if a != b), len(reference_lines)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark building metadata trees and generating their CSV data")
+    parser.add_argument("--nodes", type = int, default = 20000, help = "Number of nodes in the trees")
+    parser.add_argument("--fanout", type = int, default = 8, help = "Children of each node (and number of trees)")
+    parser.add_argument("--notation-every", type = int, default = 10, help = "Every n'th node has multiple notations")
+    parser.add_argument("--time-only", action = "store_true", help = "Don't trace the memory (which slows everything down)")
+    args = parser.parse_args()
+
+    with get_app().app_context():
+        if not args.time_only:
+            tracemalloc.start()
+        print("Nodes: {}, fanout: {}, multiple notations every {} nodes".format(args.nodes, args.fanout, args.notation_every))
+        nodes = node_data(args.nodes, args.fanout, args.notation_every)
+        fetch_timestamp = MetaNode.current_fetch_timestamp()
+        trees = measure("Build trees", build_tree, nodes, fetch_timestamp)
+        rows = measure("Generate CSV data", tree_csv, trees)
+        print("CSV rows: {}".format(rows))
+        record_trees = measure("Build trees in batches", build_records, nodes, fetch_timestamp)
+        if [list(tree.iter_tree_rows()) for tree in trees] != [list(tree.iter_tree_rows()) for tree in record_trees]:
+            print("CSV data of the trees built in batches DIFFERS")
+        columnar_trees = measure("Build columnar trees", build_columnar, nodes, fetch_timestamp)
+        columnar_rows = measure("Generate CSV data", tree_csv, columnar_trees)
+        if [list(tree.iter_tree_rows()) for tree in trees] != [list(tree.iter_tree_rows()) for tree in columnar_trees]:
+            print("Columnar CSV data DIFFERS ({} rows)".format(columnar_rows))
+        sqlite_trees = measure("Build SQLite trees", build_sqlite, nodes, fetch_timestamp)
+        sqlite_rows = measure("Generate CSV data", tree_csv, sqlite_trees)
+        if any(list(tree.iter_tree_rows()) != list(sqlite_tree.iter_tree_rows()) for tree, sqlite_tree in zip(trees, sqlite_trees)):
+            print("SQLite CSV data DIFFERS ({} rows)".format(sqlite_rows))
+        print("Row emitters (all tables for every node):")
+        compare_row_emitters(trees)